@@ -16,6 +16,8 @@ from routes.demo import demo_bp, init_demo
 from routes.debug import debug_bp, init_debug
 from routes.marketplace import marketplace_bp, init_marketplace
 from routes.admin import admin_bp, init_admin
+from routes.leaderboard import leaderboard_bp, init_leaderboard
+from services.background_tasks import start_background_tasks
 
 def create_app():
     """Application factory"""
@@ -64,6 +66,10 @@ def create_app():
     init_debug(db)
     init_marketplace(db)
     init_admin(db)
+    init_leaderboard(db)
+    
+    # Start scheduled jobs
+    start_background_tasks(db)
     
     # Register blueprints
     app.register_blueprint(auth_bp, url_prefix='/api/auth')
@@ -76,6 +82,7 @@ def create_app():
     app.register_blueprint(debug_bp, url_prefix='/api/debug')
     app.register_blueprint(marketplace_bp, url_prefix='/api/marketplace')
     app.register_blueprint(admin_bp, url_prefix='/api/admin')
+    app.register_blueprint(leaderboard_bp, url_prefix='/api/leaderboard')
     
     # Health check endpoint
     @app.route('/api/health', methods=['GET'])
@@ -99,6 +106,7 @@ def create_app():
                 'emissions': '/api/emissions',
                 'credits': '/api/credits',
                 'predictions': '/api/predictions',
+                'leaderboard': '/api/leaderboard',
                 'demo': '/api/demo',
                 'health': '/api/health'
             },
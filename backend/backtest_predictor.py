@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Rolling-origin backtest of the AI predictor on synthetic fleets
+
+Usage:
+    python backtest_predictor.py --users 5000 --days 120 --workers 4
+"""
+
+import argparse
+from services.backtesting import run_backtest, reference_check, format_table
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest AIPredictor on a synthetic fleet')
+    parser.add_argument('--users', type=int, default=1000, help='Households in the fleet')
+    parser.add_argument('--days', type=int, default=120, help='Days of history per household')
+    parser.add_argument('--window', type=int, default=60, help='Training window in days')
+    parser.add_argument('--horizon', type=int, default=30, help='Forecast horizon in days')
+    parser.add_argument('--step', type=int, default=7, help='Days between cutoffs')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--chunk-size', type=int, default=250, help='Households per worker task')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-reference', action='store_true', help='Skip the looped AIPredictor check')
+    args = parser.parse_args()
+
+    print("\n" + "=" * 70)
+    print("📈 AI PREDICTOR BACKTEST")
+    print("=" * 70)
+
+    report = run_backtest(
+        num_users=args.users,
+        days=args.days,
+        window=args.window,
+        horizon=args.horizon,
+        step=args.step,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        seed=args.seed
+    )
+
+    print(f"   Households: {report['users']}  |  Cutoffs/household: {report['cutoffs_per_user']}  |  Forecasts: {report['forecasts']}")
+    print(f"   Wall time: {report['wall_seconds']}s  ({report['forecasts_per_second']} forecasts/s)")
+
+    print("\n⏱️  LATENCY")
+    print(format_table(report['latency']))
+
+    print("\n🎯 ACCURACY")
+    print(format_table(report['accuracy']))
+
+    if not args.skip_reference:
+        reference = reference_check(window=args.window, horizon=args.horizon, seed=args.seed)
+        print("\n🔍 REFERENCE (looped AIPredictor)")
+        print(format_table([reference]))
+
+    print()
+
+if __name__ == "__main__":
+    main()
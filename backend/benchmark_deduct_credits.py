@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark deduct_credits against the previous one-update-per-lot loop
+
+Each run deducts an amount spanning every lot of a fresh user. Uses (and
+drops) a scratch database on the configured server.
+
+Usage:
+    python benchmark_deduct_credits.py --lots 5 20 100 --repeat 20
+"""
+
+import argparse
+import time
+import numpy as np
+from datetime import datetime
+from bson import ObjectId
+from pymongo import MongoClient
+from config import Config
+from models.credit import Credit
+from utils.transactions import supports_transactions
+
+def legacy_deduct(collection, user_oid, amount_kg_co2):
+    """The pre-ledger implementation: read all lots, then one write per lot"""
+    active_credits = list(collection.find({
+        'user_id': user_oid,
+        'status': 'active',
+        'expiry_date': {'$gte': datetime.utcnow()}
+    }).sort('expiry_date', 1))
+
+    total_available = sum(c['amount_kg_co2'] for c in active_credits)
+    if total_available < amount_kg_co2:
+        raise ValueError('Insufficient credits')
+
+    remaining = amount_kg_co2
+    for credit in active_credits:
+        if remaining <= 0:
+            break
+        if credit['amount_kg_co2'] <= remaining:
+            collection.update_one({'_id': credit['_id']}, {'$set': {
+                'status': 'transferred', 'transferred_at': datetime.utcnow()
+            }})
+            remaining -= credit['amount_kg_co2']
+        else:
+            collection.update_one({'_id': credit['_id']}, {'$set': {
+                'amount_kg_co2': credit['amount_kg_co2'] - remaining
+            }})
+            remaining = 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark credit deduction')
+    parser.add_argument('--lots', type=int, nargs='+', default=[5, 20, 100])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--db', default='carbon_benchmark', help='Scratch database (dropped)')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    client.drop_database(args.db)
+    db = client[args.db]
+    credit_model = Credit(db)
+
+    print(f"Transactions: {'yes' if supports_transactions(client) else 'no (standalone fallback)'}")
+    print(f"{'lots':>6} {'legacy ms':>12} {'ledger ms':>12} {'speedup':>9}")
+
+    for lot_count in args.lots:
+        # Take all but half of the last lot: every lot is touched
+        amount = lot_count * 10.0 - 5.0
+        legacy, ledger = [], []
+
+        for _ in range(args.repeat):
+            user_id = str(ObjectId())
+            for _ in range(lot_count):
+                credit_model.purchase_credit(user_id, 'solar', 10.0)
+            started = time.perf_counter()
+            legacy_deduct(credit_model.collection, ObjectId(user_id), amount)
+            legacy.append((time.perf_counter() - started) * 1000)
+
+            user_id = str(ObjectId())
+            for _ in range(lot_count):
+                credit_model.purchase_credit(user_id, 'solar', 10.0)
+            started = time.perf_counter()
+            credit_model.deduct_credits(user_id, amount)
+            ledger.append((time.perf_counter() - started) * 1000)
+
+        legacy_ms, ledger_ms = np.median(legacy), np.median(ledger)
+        print(f"{lot_count:>6} {legacy_ms:>12.2f} {ledger_ms:>12.2f} {legacy_ms / ledger_ms:>8.1f}x")
+
+    client.drop_database(args.db)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark leaderboard refresh and rank lookups on a synthetic fleet
+
+The refresh is timed end to end (fleet load from Mongo plus build) on a
+scratch database seeded with the fleet, which is dropped first. The build
+and lookups are also timed on in-memory arrays.
+
+Usage:
+    python benchmark_leaderboard.py --households 1000000
+"""
+
+import argparse
+import time
+import numpy as np
+from datetime import datetime
+from bson import ObjectId
+from pymongo import MongoClient
+from config import Config
+from services import cohorts
+from services.carbon_limit_service import CarbonLimitService
+from services.leaderboard import Leaderboard
+
+def seed_fleet(db, occupants, area, percentages, chunk=10000):
+    """One user, one emission reading this year and a credit balance per household"""
+    now = datetime.utcnow()
+    for start in range(0, len(percentages), chunk):
+        users, emissions, balances = [], [], []
+        for o, a, p in zip(occupants[start:start + chunk].tolist(),
+                           area[start:start + chunk].tolist(),
+                           percentages[start:start + chunk].tolist()):
+            user_id = ObjectId()
+            limit = CarbonLimitService.calculate_annual_limit(a, o)
+            users.append({'_id': user_id, 'household': {'occupants': o, 'area_sqm': a}})
+            emissions.append({'user_id': user_id, 'timestamp': now, 'total_co2_kg': limit * p / 100 + 10})
+            balances.append({'_id': user_id, 'available_kg': 10.0})
+        db.users.insert_many(users, ordered=False)
+        db.emissions.insert_many(emissions, ordered=False)
+        db.credit_balances.insert_many(balances, ordered=False)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark leaderboard build and lookups')
+    parser.add_argument('--households', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--db', default='carbon_benchmark', help='Scratch database (dropped)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n = args.households
+    user_ids = np.array([f'{i:024x}' for i in range(n)], dtype=object)
+    occupants = rng.integers(1, 8, n)
+    area = rng.uniform(30, 250, n)
+    percentages = np.round(rng.gamma(4, 20, n), 2)
+    labels = cohorts.cohort_labels()
+
+    client = MongoClient(Config.MONGO_URI)
+    client.drop_database(args.db)
+    db = client[args.db]
+    seed_fleet(db, occupants, area, percentages)
+
+    leaderboard = Leaderboard()
+    refreshes = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        summary = leaderboard.refresh(db)
+        refreshes.append(((time.perf_counter() - started) * 1000, summary['load_ms'], summary['build_ms']))
+    client.drop_database(args.db)
+
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        boards = Leaderboard.build(user_ids, cohorts.assign_cohorts(occupants, area), percentages, labels)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    queries = rng.gamma(4, 20, args.lookups)
+    query_cohorts = [labels[i] for i in rng.integers(0, len(labels), args.lookups)]
+    started = time.perf_counter()
+    for value, cohort in zip(queries, query_cohorts):
+        Leaderboard.rank_in(boards[cohort], value)
+    lookup_us = (time.perf_counter() - started) / args.lookups * 1e6
+
+    started = time.perf_counter()
+    for cohort in query_cohorts[:10000]:
+        boards[cohort]['user_ids'][:10]
+    top_us = (time.perf_counter() - started) / 10000 * 1e6
+
+    print(f"Households: {n}")
+    print("Cohorts: " + ', '.join(f"{label}={len(boards[label]['percentages'])}" for label in labels))
+    total, load, build = min(refreshes)
+    print(f"Refresh: best {total:.2f} ms (load {load:.2f} ms, build {build:.2f} ms), "
+          f"median {np.median([r[0] for r in refreshes]):.2f} ms")
+    print(f"Build (in memory): best {min(timings):.2f} ms, median {np.median(timings):.2f} ms")
+    print(f"Rank lookup: {lookup_us:.2f} us per query")
+    print(f"Top-10 slice: {top_us:.2f} us per query")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Benchmark the in-memory order book matching engine
+
+Submits a stream of random limit orders around a drifting mid price to
+one book and reports throughput and per-order latency (matching only,
+no persistence).
+
+Usage:
+    python benchmark_order_book.py --orders 200000
+"""
+
+import argparse
+import time
+import numpy as np
+from services.order_book import OrderBook, BUY, SELL
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark order book matching')
+    parser.add_argument('--orders', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--cancel-ratio', type=float, default=0.1, help='Share of submissions followed by a cancel')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n = args.orders
+    mid = 10 + np.cumsum(rng.normal(0, 0.01, n))
+    # Tick size 0.05 Rs; orders land up to 1 Rs either side of the mid
+    prices = np.round(np.round((mid + rng.normal(0, 0.4, n)) / 0.05) * 0.05, 2)
+    amounts = np.round(rng.gamma(2, 10, n), 2) + 0.01
+    sides = np.where(rng.random(n) < 0.5, BUY, SELL)
+    users = [f'user{u}' for u in rng.integers(0, args.users, n)]
+    cancels = rng.random(n) < args.cancel_ratio
+
+    book = OrderBook('solar')
+    latencies = np.empty(n)
+    fills = 0
+    filled_kg = 0.0
+    cancelled = 0
+
+    started = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter()
+        order, order_fills, status = book.submit(str(i), sides[i], users[i], float(prices[i]), float(amounts[i]))
+        if cancels[i] and status == 'resting':
+            book.cancel(order.order_id)
+            cancelled += 1
+        latencies[i] = time.perf_counter() - t0
+        fills += len(order_fills)
+        filled_kg += sum(f.amount_kg_co2 for f in order_fills)
+    elapsed = time.perf_counter() - started
+
+    depth = book.depth(5)
+    print(f"Orders: {n}, fills: {fills} ({filled_kg:,.0f} kg), cancels: {cancelled}, resting: {len(book.orders)}")
+    print(f"Throughput: {n / elapsed:,.0f} orders/s ({elapsed:.2f} s)")
+    print(f"Latency: p50 {np.percentile(latencies, 50) * 1e6:.1f} us, "
+          f"p99 {np.percentile(latencies, 99) * 1e6:.1f} us, max {latencies.max() * 1e6:.1f} us")
+    print(f"Best bid {book.best(BUY)}, best ask {book.best(SELL)}")
+    print(f"Top bids: {[(round(l['price_per_kg'], 2), l['amount_kg_co2']) for l in depth['bids']]}")
+    print(f"Top asks: {[(round(l['price_per_kg'], 2), l['amount_kg_co2']) for l in depth['asks']]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark the settlement engine against one-payment-at-a-time settlement
+
+Seeds sellers with reserved listings and queues paid purchases from
+random buyers, then settles one set of payments through the per-payment
+path (what complete_purchase used to do) and an equal set through the
+batched engine, and reports settlements per second for both. Uses (and
+drops) a scratch database on the configured server; batching needs a
+replica set.
+
+Usage:
+    python benchmark_settlement.py --payments 2000 --sellers 50 --buyers 500
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import MongoClient
+from config import Config
+from models.credit import Credit
+from models.marketplace_listing import MarketplaceListing
+from models.payment import Payment
+from services.settlement_engine import SettlementEngine
+from utils.transactions import supports_transactions
+
+def seed(db, sellers, buyers, payments, amount):
+    """Listings with enough reserved credits for every payment, and queued payments"""
+    credit_model = Credit(db)
+    listing_model = MarketplaceListing(db)
+    payment_model = Payment(db)
+    # Payments pick listings at random, so each one must cover them all
+    listed = payments * amount
+
+    listings = []
+    for _ in range(sellers):
+        seller_id = str(ObjectId())
+        credit_model.purchase_credit(seller_id, 'solar', listed)
+        listing_id = ObjectId()
+        expires_at = datetime.utcnow() + timedelta(days=MarketplaceListing.LISTING_DAYS)
+        credit_model.reserve_credits(seller_id, listed, listing_id, expires_at, 'solar')
+        listings.append(listing_model.create_listing(seller_id, 'solar', listed, 10.0, listing_id, expires_at))
+
+    buyer_ids = [str(ObjectId()) for _ in range(buyers)]
+    for _ in range(payments):
+        listing = random.choice(listings)
+        payment = payment_model.create_payment(
+            random.choice(buyer_ids), listing['listing_id'], amount, amount * 10.0, 'card'
+        )
+        payment_model.queue_settlement(payment['payment_id'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batched payment settlement')
+    parser.add_argument('--payments', type=int, default=2000, help='Payments per mode')
+    parser.add_argument('--sellers', type=int, default=50)
+    parser.add_argument('--buyers', type=int, default=500)
+    parser.add_argument('--amount', type=float, default=1.5, help='kg CO2 per payment')
+    parser.add_argument('--db', default='carbon_benchmark', help='Scratch database (dropped)')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    client.drop_database(args.db)
+    db = client[args.db]
+    random.seed(0)
+
+    print(f"Transactions: {'yes' if supports_transactions(client) else 'no (engine settles one at a time)'}")
+    print(f"{args.payments} payments per mode across {args.sellers} listings and {args.buyers} buyers")
+
+    seed(db, args.sellers, args.buyers, args.payments, args.amount)
+    engine = SettlementEngine(db)
+    started = time.perf_counter()
+    settled = 0
+    while True:
+        claimed = engine._claim(100)
+        if not claimed:
+            break
+        settled += engine._settle_sequential(claimed)[0]
+    single_rate = settled / (time.perf_counter() - started)
+    print(f"One at a time: {settled} settled, {single_rate:,.0f} settlements/s")
+
+    client.drop_database(args.db)
+    seed(db, args.sellers, args.buyers, args.payments, args.amount)
+    metrics = SettlementEngine(db).run(max_batches=args.payments)
+    print(f"Batched:       {metrics['settled']} settled in {metrics['batches']} batches, "
+          f"{metrics['settlements_per_sec']:,.0f} settlements/s ({metrics['conflicts']} conflicts)")
+    print(f"Speedup: {metrics['settlements_per_sec'] / single_rate:.1f}x")
+
+    client.drop_database(args.db)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Load-test GET /api/emissions/status and report latency percentiles
+
+Usage (server running, user seeded via seed_user.py):
+    python benchmark_status_endpoint.py --requests 2000 --concurrency 32
+"""
+
+import argparse
+import time
+import requests
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+def parse_server_timing(header):
+    """Parse 'db;dur=1.2, compute;dur=0.1' into a dict"""
+    stages = {}
+    for part in (header or '').split(','):
+        name, _, dur = part.strip().partition(';dur=')
+        if name and dur:
+            stages[name] = float(dur)
+    return stages
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the carbon status endpoint')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--email', default='user@carbon.com')
+    parser.add_argument('--password', default='user123')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    login = requests.post(f"{args.url}/api/auth/login", json={
+        'email': args.email,
+        'password': args.password
+    })
+    login.raise_for_status()
+    headers = {'Authorization': f"Bearer {login.json()['access_token']}"}
+    session = requests.Session()
+
+    def call(_):
+        started = time.perf_counter()
+        response = session.get(f"{args.url}/api/emissions/status", headers=headers)
+        elapsed = (time.perf_counter() - started) * 1000
+        return elapsed, response.status_code, parse_server_timing(response.headers.get('Server-Timing'))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(call, range(args.requests)))
+    wall = time.perf_counter() - started
+
+    latencies = np.array([r[0] for r in results])
+    errors = sum(1 for r in results if r[1] != 200)
+
+    print(f"Requests: {args.requests}  Concurrency: {args.concurrency}  Errors: {errors}")
+    print(f"Throughput: {args.requests / wall:.1f} req/s")
+    print(f"Client latency  p50: {np.percentile(latencies, 50):.2f} ms  p99: {np.percentile(latencies, 99):.2f} ms")
+
+    for stage in ('db', 'compute', 'total'):
+        values = [r[2][stage] for r in results if stage in r[2]]
+        if values:
+            print(f"Server {stage:<8} p50: {np.percentile(values, 50):.2f} ms  p99: {np.percentile(values, 99):.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Check that every marketplace listing search shape is served by an index
+
+Seeds a scratch database with synthetic listings, runs explain on the
+first-page aggregation and the cursor-page query for each filter and sort
+combination, and fails if any plan contains a COLLSCAN. The scratch
+database is dropped afterwards.
+
+Usage:
+    python check_listing_query_plans.py --listings 20000
+"""
+
+import argparse
+import itertools
+import random
+import sys
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import MongoClient
+from config import Config
+from models.marketplace_listing import MarketplaceListing, LISTING_SORTS
+
+FILTER_SHAPES = [
+    {},
+    {'credit_type': 'solar'},
+    {'max_price': 12},
+    {'min_amount': 50},
+    {'credit_type': 'wind', 'max_price': 12, 'min_amount': 50}
+]
+
+def stages(plan):
+    """All stage names in an explain document"""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from stages(value)
+
+def seed(model, count):
+    now = datetime.utcnow()
+    statuses = ['active'] * 6 + ['sold', 'cancelled', 'expired']
+    docs = []
+    for _ in range(count):
+        amount = round(random.uniform(1, 500), 2)
+        price = round(random.uniform(5, 20), 2)
+        created = now - timedelta(minutes=random.randint(0, 60 * 24 * 60))
+        docs.append({
+            'seller_id': ObjectId(),
+            'credit_type': random.choice(list(Config.CREDIT_TYPES)),
+            'amount_kg_co2': amount,
+            'original_amount': amount,
+            'price_per_kg': price,
+            'total_price': amount * price,
+            'status': random.choice(statuses),
+            'created_at': created,
+            'expires_at': created + timedelta(days=MarketplaceListing.LISTING_DAYS),
+            'views': 0,
+            'sold_amount': 0.0
+        })
+    model.collection.insert_many(docs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Explain marketplace listing queries and reject COLLSCANs')
+    parser.add_argument('--listings', type=int, default=20000)
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch database')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    db = client[client.get_database().name + '_plan_check']
+    client.drop_database(db.name)
+
+    try:
+        model = MarketplaceListing(db)
+        seed(model, args.listings)
+
+        failures = 0
+        for filters, sort in itertools.product(FILTER_SHAPES, LISTING_SORTS):
+            query, credit_type, order = model.search_query(filters, sort)
+            pipeline = model.first_page_pipeline(query, credit_type, order, Config.MARKETPLACE_PAGE_SIZE)
+            first = db.command('explain', {
+                'aggregate': model.collection.name,
+                'pipeline': pipeline,
+                'cursor': {}
+            }, verbosity='queryPlanner')
+
+            # A cursor page starting from the first listing of the first page
+            sample = next(model.collection.aggregate(pipeline))['listings']
+            plans = [('first page', first)]
+            if sample:
+                cursor = model._encode_cursor(sample[0], sort)
+                query, credit_type, order = model.search_query(filters, sort, cursor)
+                if credit_type:
+                    query['credit_type'] = credit_type
+                plans.append(('cursor page', model.collection.find(query).sort(order).limit(
+                    Config.MARKETPLACE_PAGE_SIZE + 1).explain()))
+
+            for label, plan in plans:
+                used = set(stages(plan))
+                ok = 'COLLSCAN' not in used
+                failures += not ok
+                print(f"{'✅' if ok else '❌'} {sort:<12} {label:<12} {filters} -> {', '.join(sorted(used))}")
+
+        if failures:
+            print(f"❌ {failures} plan(s) fall back to a collection scan")
+            sys.exit(1)
+        print("✅ All listing search plans use an index")
+    finally:
+        if not args.keep:
+            client.drop_database(db.name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Check that marketplace list views issue a fixed number of queries
+
+Seeds a scratch database with sellers, listings and a buyer's completed
+purchases, then counts the queries sent to MongoDB (via command
+monitoring) for a listings page, a cursor page, listing details and the
+trades view. Fails if any view exceeds its budget, e.g. because seller
+or listing lookups went back to one query per row. The scratch database
+is dropped afterwards.
+
+Usage:
+    python check_marketplace_query_counts.py --page-size 100
+"""
+
+import argparse
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import MongoClient, monitoring
+from config import Config
+from models.marketplace_listing import MarketplaceListing
+from services.marketplace_service import MarketplaceService
+
+# Commands that are a round-trip of their own (getMore only continues a cursor)
+QUERY_COMMANDS = {'find', 'aggregate', 'count', 'distinct', 'insert', 'update', 'delete', 'findAndModify'}
+
+# view -> most queries it may send, whatever the page size
+QUERY_BUDGETS = {
+    'listings page': 2,
+    'listings cursor page': 2,
+    'listing details': 3,
+    'trades': 4
+}
+
+class CommandCounter(monitoring.CommandListener):
+    """Records the queries sent to one database, by command name"""
+
+    def __init__(self, database):
+        self.database = database
+        self.commands = []
+
+    def started(self, event):
+        if event.database_name == self.database and event.command_name in QUERY_COMMANDS:
+            self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+def seed(db, sellers, listings, purchases):
+    now = datetime.utcnow()
+    seller_ids = [ObjectId() for _ in range(sellers)]
+    db.users.insert_many([
+        {'_id': seller_id, 'email': f'seller{i}@example.com', 'created_at': now}
+        for i, seller_id in enumerate(seller_ids)
+    ])
+
+    docs = []
+    for i in range(listings):
+        amount = round(random.uniform(1, 500), 2)
+        price = round(random.uniform(5, 20), 2)
+        docs.append({
+            'seller_id': seller_ids[i % sellers],
+            'credit_type': random.choice(list(Config.CREDIT_TYPES)),
+            'amount_kg_co2': amount,
+            'original_amount': amount,
+            'price_per_kg': price,
+            'total_price': amount * price,
+            'status': 'active',
+            'created_at': now - timedelta(minutes=i),
+            'expires_at': now + timedelta(days=MarketplaceListing.LISTING_DAYS),
+            'views': 0,
+            'sold_amount': 0.0
+        })
+    listing_ids = db.marketplace_listings.insert_many(docs).inserted_ids
+
+    buyer_id = ObjectId()
+    db.payments.insert_many([
+        {
+            'transaction_id': f'TXN{uuid.uuid4().hex[:12].upper()}',
+            'buyer_id': buyer_id,
+            'listing_id': listing_ids[i % len(listing_ids)],
+            'amount_kg_co2': 1.0,
+            'total_amount': 10.0,
+            'payment_method': 'card',
+            'status': 'completed',
+            'created_at': now,
+            'completed_at': now
+        }
+        for i in range(purchases)
+    ])
+    return str(buyer_id), str(listing_ids[0])
+
+def main():
+    parser = argparse.ArgumentParser(description='Count MongoDB queries per marketplace list view')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--sellers', type=int, default=100)
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch database')
+    args = parser.parse_args()
+
+    uri = Config.MONGO_URI
+    name = MongoClient(uri).get_database().name + '_query_count_check'
+    counter = CommandCounter(name)
+    client = MongoClient(uri, event_listeners=[counter])
+    db = client[name]
+    client.drop_database(name)
+
+    try:
+        buyer_id, listing_id = seed(db, args.sellers, args.page_size * 2, args.page_size)
+        page = MarketplaceService(db).get_marketplace_listings(limit=args.page_size)
+
+        views = {
+            'listings page': lambda service: service.get_marketplace_listings(limit=args.page_size),
+            'listings cursor page': lambda service: service.get_marketplace_listings(
+                limit=args.page_size, cursor=page['next_cursor']),
+            'listing details': lambda service: service.get_listing_details(listing_id),
+            'trades': lambda service: service.get_user_trades(buyer_id)
+        }
+
+        failures = 0
+        for view, run in views.items():
+            counter.commands.clear()
+            run(MarketplaceService(db))
+            count = len(counter.commands)
+            ok = count <= QUERY_BUDGETS[view]
+            failures += not ok
+            print(f"{'✅' if ok else '❌'} {view:<22} {count} queries (budget {QUERY_BUDGETS[view]}): "
+                  f"{', '.join(counter.commands)}")
+
+        if failures:
+            print(f"❌ {failures} view(s) over their query budget")
+            sys.exit(1)
+        print(f"✅ All marketplace views stay within their query budgets at {args.page_size} rows")
+    finally:
+        if not args.keep:
+            client.drop_database(name)
+
+if __name__ == "__main__":
+    main()
@@ -46,3 +46,105 @@ class Config:
     # Status Thresholds
     STATUS_SAFE_THRESHOLD = 0.70  # 70% of limit
     STATUS_WARNING_THRESHOLD = 1.0  # 100% of limit
+    
+    # Forecast response cache (entries, in-process LRU)
+    FORECAST_CACHE_MAX_ENTRIES = int(os.getenv('FORECAST_CACHE_MAX_ENTRIES', 2048))
+    
+    # Background model training
+    TRAINING_WORKERS = int(os.getenv('TRAINING_WORKERS', 2))
+    TRAINING_MAX_QUEUED = int(os.getenv('TRAINING_MAX_QUEUED', 50))
+    
+    # Forecast model: 'per_user' (AIPredictor) or 'pooled' (PooledPredictor)
+    FORECAST_MODEL = os.getenv('FORECAST_MODEL', 'per_user')
+    POOLED_MODEL_MAX_AGE_HOURS = float(os.getenv('POOLED_MODEL_MAX_AGE_HOURS', 24))
+    
+    # Fleet breach-risk scanner (interval 0 disables the schedule)
+    BREACH_SCAN_INTERVAL_SECONDS = int(os.getenv('BREACH_SCAN_INTERVAL_SECONDS', 3600))
+    BREACH_SCAN_HORIZON_DAYS = int(os.getenv('BREACH_SCAN_HORIZON_DAYS', 90))
+    BREACH_SCAN_RATE_WINDOW_DAYS = int(os.getenv('BREACH_SCAN_RATE_WINDOW_DAYS', 14))
+    BREACH_SCAN_WRITE_BATCH = int(os.getenv('BREACH_SCAN_WRITE_BATCH', 5000))
+    BREACH_SCAN_MAX_ENTRIES = int(os.getenv('BREACH_SCAN_MAX_ENTRIES', 10000))
+    
+    # Status snapshot reconciler (rebuilds oldest snapshots from source data)
+    STATUS_RECONCILE_INTERVAL_SECONDS = int(os.getenv('STATUS_RECONCILE_INTERVAL_SECONDS', 300))
+    STATUS_RECONCILE_BATCH = int(os.getenv('STATUS_RECONCILE_BATCH', 500))
+    
+    # Fleet recalculation of stored limits/statuses after limit, threshold or
+    # emission factor changes (check interval 0 disables the schedule)
+    RECALC_CHECK_INTERVAL_SECONDS = int(os.getenv('RECALC_CHECK_INTERVAL_SECONDS', 60))
+    RECALC_BATCH_SIZE = int(os.getenv('RECALC_BATCH_SIZE', 500))
+    RECALC_BATCH_PAUSE_SECONDS = float(os.getenv('RECALC_BATCH_PAUSE_SECONDS', 0.05))
+    RECALC_LEASE_SECONDS = int(os.getenv('RECALC_LEASE_SECONDS', 300))
+    
+    # Peer cohorts: household size bands by occupant count, as inclusive upper
+    # bounds ("1,2,4" -> 1, 2, 3-4, 5+), optionally split by floor area
+    # ("80,150" -> 0-80, 80-150, 150+ sq.m; empty for no area split)
+    COHORT_OCCUPANT_BOUNDS = [int(b) for b in os.getenv('COHORT_OCCUPANT_BOUNDS', '1,2,4').split(',')]
+    COHORT_AREA_BOUNDS = [float(b) for b in os.getenv('COHORT_AREA_BOUNDS', '').split(',') if b.strip()]
+    
+    # Peer comparison aggregates (quantile sketches per cohort, updated
+    # incrementally from new readings)
+    COHORT_STATS_INTERVAL_SECONDS = int(os.getenv('COHORT_STATS_INTERVAL_SECONDS', 300))
+    COHORT_STATS_SKETCH_ACCURACY = float(os.getenv('COHORT_STATS_SKETCH_ACCURACY', 0.01))
+    COHORT_STATS_MIN_PEERS = int(os.getenv('COHORT_STATS_MIN_PEERS', 5))
+    
+    # Leaderboard (in-process sorted arrays, refreshed periodically)
+    LEADERBOARD_REFRESH_SECONDS = int(os.getenv('LEADERBOARD_REFRESH_SECONDS', 600))
+    LEADERBOARD_MAX_TOP = int(os.getenv('LEADERBOARD_MAX_TOP', 100))
+    
+    # Active credit lot details returned per page by /api/credits/active
+    CREDIT_SUMMARY_PAGE_SIZE = int(os.getenv('CREDIT_SUMMARY_PAGE_SIZE', 50))
+    CREDIT_SUMMARY_MAX_PAGE_SIZE = int(os.getenv('CREDIT_SUMMARY_MAX_PAGE_SIZE', 500))
+    
+    # Credit expiry sweeper (moves expired lots out of 'active')
+    CREDIT_EXPIRY_SWEEP_INTERVAL_SECONDS = int(os.getenv('CREDIT_EXPIRY_SWEEP_INTERVAL_SECONDS', 300))
+    CREDIT_EXPIRY_SWEEP_BATCH = int(os.getenv('CREDIT_EXPIRY_SWEEP_BATCH', 500))
+    CREDIT_EXPIRY_SWEEP_MAX_BATCHES = int(os.getenv('CREDIT_EXPIRY_SWEEP_MAX_BATCHES', 100))
+    
+    # Listing expiry sweeper (moves listings past expires_at out of 'active')
+    LISTING_EXPIRY_SWEEP_INTERVAL_SECONDS = int(os.getenv('LISTING_EXPIRY_SWEEP_INTERVAL_SECONDS', 60))
+    LISTING_EXPIRY_SWEEP_BATCH = int(os.getenv('LISTING_EXPIRY_SWEEP_BATCH', 500))
+    LISTING_EXPIRY_SWEEP_MAX_BATCHES = int(os.getenv('LISTING_EXPIRY_SWEEP_MAX_BATCHES', 20))
+    
+    # Marketplace listing search pages
+    MARKETPLACE_PAGE_SIZE = int(os.getenv('MARKETPLACE_PAGE_SIZE', 20))
+    MARKETPLACE_MAX_PAGE_SIZE = int(os.getenv('MARKETPLACE_MAX_PAGE_SIZE', 100))
+    
+    # Marketplace listing view counters (buffered in memory, flushed in bulk)
+    VIEW_FLUSH_INTERVAL_SECONDS = int(os.getenv('VIEW_FLUSH_INTERVAL_SECONDS', 10))
+    VIEW_FLUSH_MAX_LISTINGS = int(os.getenv('VIEW_FLUSH_MAX_LISTINGS', 1000))
+    VIEW_BUFFER_MAX_LISTINGS = int(os.getenv('VIEW_BUFFER_MAX_LISTINGS', 50000))
+    
+    # Settlement engine (drains paid marketplace payments in batches)
+    SETTLEMENT_INTERVAL_SECONDS = int(os.getenv('SETTLEMENT_INTERVAL_SECONDS', 5))
+    SETTLEMENT_BATCH_SIZE = int(os.getenv('SETTLEMENT_BATCH_SIZE', 200))
+    SETTLEMENT_MAX_BATCHES = int(os.getenv('SETTLEMENT_MAX_BATCHES', 50))
+    SETTLEMENT_LEASE_SECONDS = int(os.getenv('SETTLEMENT_LEASE_SECONDS', 300))
+    
+    # OHLCV candles of settled trades (latest candles per series kept in memory)
+    CANDLE_TAIL_SIZE = int(os.getenv('CANDLE_TAIL_SIZE', 500))
+    CANDLE_TAIL_REFRESH_SECONDS = float(os.getenv('CANDLE_TAIL_REFRESH_SECONDS', 5))
+    CANDLE_MAX_POINTS = int(os.getenv('CANDLE_MAX_POINTS', 1000))
+    
+    # Payment QR codes (rendered off-request, stored once per payload)
+    QR_RENDER_WORKERS = int(os.getenv('QR_RENDER_WORKERS', 2))
+    QR_RENDER_TIMEOUT_SECONDS = float(os.getenv('QR_RENDER_TIMEOUT_SECONDS', 5))
+    QR_CODE_RETENTION_DAYS = int(os.getenv('QR_CODE_RETENTION_DAYS', 30))
+    
+    # Public listings response cache (per worker; bumped on listing writes)
+    MARKETPLACE_CACHE_TTL_SECONDS = float(os.getenv('MARKETPLACE_CACHE_TTL_SECONDS', 5))
+    MARKETPLACE_CACHE_MAX_ENTRIES = int(os.getenv('MARKETPLACE_CACHE_MAX_ENTRIES', 512))
+    
+    # Marketplace order book depth snapshots (price levels per side)
+    ORDER_BOOK_DEPTH_LEVELS = int(os.getenv('ORDER_BOOK_DEPTH_LEVELS', 10))
+    ORDER_BOOK_MAX_DEPTH = int(os.getenv('ORDER_BOOK_MAX_DEPTH', 50))
+    
+    # Order book fills not paid for within the window are cancelled
+    # (their amount goes back to the listing)
+    ORDER_BOOK_PAYMENT_WINDOW_SECONDS = int(os.getenv('ORDER_BOOK_PAYMENT_WINDOW_SECONDS', 900))
+    UNPAID_FILL_SWEEP_INTERVAL_SECONDS = int(os.getenv('UNPAID_FILL_SWEEP_INTERVAL_SECONDS', 60))
+    UNPAID_FILL_SWEEP_BATCH = int(os.getenv('UNPAID_FILL_SWEEP_BATCH', 200))
+    
+    # Credits held for sell listings; released/consumed reservations are
+    # kept this long (TTL index) for auditing
+    CREDIT_RESERVATION_RETENTION_DAYS = int(os.getenv('CREDIT_RESERVATION_RETENTION_DAYS', 7))
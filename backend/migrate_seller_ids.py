@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Convert stored user and listing ids from string to ObjectId
+
+Listings used to store seller_id, and payments buyer_id and listing_id,
+as id strings, unlike the other collections (credits, balances, users),
+which use ObjectId. New documents store ObjectIds; run this once to
+convert older ones so lookups can be batched, joined and served by the
+ObjectId-keyed indexes. Safe to re-run: only string ids are touched.
+
+Usage:
+    python migrate_seller_ids.py
+    python migrate_seller_ids.py --dry-run
+"""
+
+import argparse
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+from config import Config
+
+# collection -> id fields stored as strings by older documents
+FIELDS = {
+    'marketplace_listings': ['seller_id'],
+    'payments': ['buyer_id', 'listing_id']
+}
+
+def convert(collection, field, batch, dry_run):
+    """
+    Convert one field of a collection
+
+    Returns:
+        (converted, invalid) document counts
+    """
+    converted = 0
+    invalid = 0
+    operations = []
+
+    def flush():
+        nonlocal converted
+        if operations:
+            # Matched on the string value, so a document changed meanwhile isn't overwritten
+            converted += collection.bulk_write(operations, ordered=False).modified_count
+            operations.clear()
+
+    for doc in collection.find({field: {'$type': 'string'}}, {field: 1}):
+        value = doc[field]
+        if not ObjectId.is_valid(value):
+            invalid += 1
+            print(f"⚠️  {collection.name} {doc['_id']} has an invalid {field}: {value!r}")
+            continue
+        if dry_run:
+            converted += 1
+            continue
+
+        operations.append(UpdateOne(
+            {'_id': doc['_id'], field: value},
+            {'$set': {field: ObjectId(value)}}
+        ))
+        if len(operations) >= batch:
+            flush()
+    flush()
+
+    return converted, invalid
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert listing and payment id strings to ObjectId')
+    parser.add_argument('--batch', type=int, default=1000, help='Documents converted per bulk write')
+    parser.add_argument('--dry-run', action='store_true', help='Only count the documents to convert')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    db = client.get_database()
+
+    action = 'to convert' if args.dry_run else 'converted'
+    for name, fields in FIELDS.items():
+        for field in fields:
+            converted, invalid = convert(db[name], field, args.batch, args.dry_run)
+            print(f"{name}.{field}: {action} {converted}, invalid ids: {invalid}")
+
+if __name__ == "__main__":
+    main()
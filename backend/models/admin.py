@@ -1,6 +1,7 @@
 from pymongo import MongoClient
 from datetime import datetime
 import bcrypt
+from utils.indexes import ensure_index
 
 class Admin:
     """Admin model for platform management"""
@@ -8,7 +9,7 @@ class Admin:
     def __init__(self, db):
         self.collection = db.admins
         # Create indexes
-        self.collection.create_index('email', unique=True)
+        ensure_index(self.collection, 'email', unique=True)
     
     def create_admin(self, email, password, name="Admin"):
         """
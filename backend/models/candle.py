@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from utils.indexes import ensure_index
+
+# Bucket widths of the stored candle series
+INTERVALS = {
+    '1m': timedelta(minutes=1),
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1)
+}
+
+_EPOCH = datetime(1970, 1, 1)
+_END_OF_TIME = datetime(9999, 12, 31)
+
+def bucket_start(at, interval):
+    """Start of the bucket containing `at`"""
+    width = INTERVALS[interval]
+    return at - (at - _EPOCH) % width
+
+def merge(candle, partial):
+    """
+    Merge a partial candle into another (in place)
+
+    Open and close follow the earliest and latest trade times, so
+    partials can arrive in any order.
+    """
+    if candle.get('o_at') is None or partial['o_at'] < candle['o_at']:
+        candle['o'], candle['o_at'] = partial['o'], partial['o_at']
+    if candle.get('c_at') is None or partial['c_at'] >= candle['c_at']:
+        candle['c'], candle['c_at'] = partial['c'], partial['c_at']
+    candle['h'] = max(candle.get('h', partial['h']), partial['h'])
+    candle['l'] = min(candle.get('l', partial['l']), partial['l'])
+    candle['v'] = candle.get('v', 0) + partial['v']
+    candle['n'] = candle.get('n', 0) + partial['n']
+    candle['q'] = candle.get('q', 0) + partial['q']
+    return candle
+
+class Candle:
+    """
+    Model for OHLCV candles of marketplace trades
+
+    One compact document per (credit_type, interval, bucket start t):
+    o/h/l/c price per kg, v volume (kg CO2), n trades, q turnover (Rs),
+    plus the times of the opening and closing trades. Candles are
+    updated incrementally as payments settle, never recomputed from
+    payments; buckets without trades are not stored.
+    """
+
+    def __init__(self, db):
+        self.collection = db.candles
+        ensure_index(self.collection, [('credit_type', 1), ('interval', 1), ('t', 1)], unique=True)
+
+    @staticmethod
+    def aggregate(trades):
+        """
+        Fold trades into partial candles for every interval
+
+        Args:
+            trades: [(credit_type, price_per_kg, amount_kg_co2, at)]
+
+        Returns:
+            {(credit_type, interval, bucket start): partial candle}
+        """
+        partials = {}
+        for credit_type, price, amount, at in trades:
+            trade = {'o': price, 'o_at': at, 'c': price, 'c_at': at, 'h': price, 'l': price,
+                     'v': amount, 'n': 1, 'q': price * amount}
+            for interval in INTERVALS:
+                key = (credit_type, interval, bucket_start(at, interval))
+                if key in partials:
+                    merge(partials[key], trade)
+                else:
+                    partials[key] = dict(trade)
+        return partials
+
+    @staticmethod
+    def _merge_update(partial):
+        """Pipeline update merging a partial candle into the stored one"""
+        return [{'$set': {
+            'o': {'$cond': [{'$lt': [partial['o_at'], {'$ifNull': ['$o_at', _END_OF_TIME]}]}, partial['o'], '$o']},
+            'o_at': {'$min': ['$o_at', partial['o_at']]},
+            'c': {'$cond': [{'$gte': [partial['c_at'], {'$ifNull': ['$c_at', _EPOCH]}]}, partial['c'], '$c']},
+            'c_at': {'$max': ['$c_at', partial['c_at']]},
+            'h': {'$max': ['$h', partial['h']]},
+            'l': {'$min': ['$l', partial['l']]},
+            'v': {'$add': [{'$ifNull': ['$v', 0]}, partial['v']]},
+            'n': {'$add': [{'$ifNull': ['$n', 0]}, partial['n']]},
+            'q': {'$add': [{'$ifNull': ['$q', 0]}, partial['q']]}
+        }}]
+
+    def record(self, partials):
+        """Merge partial candles into the stored series with one bulk_write"""
+        operations = [
+            UpdateOne(
+                {'credit_type': credit_type, 'interval': interval, 't': t},
+                self._merge_update(partial),
+                upsert=True
+            )
+            for (credit_type, interval, t), partial in partials.items()
+        ]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    def get_range(self, credit_type, interval, start=None, end=None, limit=1000):
+        """
+        Stored candles of one series, oldest first
+
+        Without a start the latest `limit` candles up to `end` are returned.
+        """
+        query = {'credit_type': credit_type, 'interval': interval}
+        if start is not None or end is not None:
+            query['t'] = {}
+            if start is not None:
+                query['t']['$gte'] = bucket_start(start, interval)
+            if end is not None:
+                query['t']['$lte'] = end
+
+        if start is not None:
+            return list(self.collection.find(query, {'_id': 0}).sort('t', 1).limit(limit))
+        candles = list(self.collection.find(query, {'_id': 0}).sort('t', -1).limit(limit))
+        candles.reverse()
+        return candles
+
+    @staticmethod
+    def format_candle(candle):
+        """Format candle for API response"""
+        return {
+            't': candle['t'].isoformat(),
+            'open': candle['o'],
+            'high': candle['h'],
+            'low': candle['l'],
+            'close': candle['c'],
+            'volume_kg': round(candle['v'], 4),
+            'trades': candle['n'],
+            'turnover': round(candle['q'], 2)
+        }
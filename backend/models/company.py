@@ -1,14 +1,15 @@
 from bson import ObjectId
 from datetime import datetime
 import secrets
+from utils.indexes import ensure_index
 
 class Company:
     """Model for external companies selling credits"""
     
     def __init__(self, db):
         self.collection = db.companies
-        self.collection.create_index('email', unique=True)
-        self.collection.create_index('api_key', unique=True)
+        ensure_index(self.collection, 'email', unique=True)
+        ensure_index(self.collection, 'api_key', unique=True)
     
     def create_company(self, name, email, description, contact_person):
         """
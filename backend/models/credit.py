@@ -1,20 +1,69 @@
 from datetime import datetime, timedelta
 from bson import ObjectId
 import uuid
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from config import Config
+from utils.indexes import drop_legacy_index, ensure_index
+from utils.transactions import run_in_transaction
+from models.status_snapshot import StatusSnapshot
+from models.payment import Payment
+
+# Slack allowed when comparing the running balance (a float sum)
+BALANCE_EPSILON = 1e-6
+MAX_DEDUCT_ATTEMPTS = 5
+
+class LotConflict(Exception):
+    """A credit lot was modified by a concurrent deduction"""
 
 class Credit:
-    """Credit model for renewable energy carbon credits"""
+    """
+    Credit model for renewable energy carbon credits
+    
+    Lots live in 'credits'. Every change to a user's credits is also
+    appended to the 'credit_transactions' ledger and applied with $inc to
+    the user's 'credit_balances' document, so balance reads are a single
+    primary-key lookup. The balance can always be rebuilt from the ledger
+    (see rebuild_credit_balances.py).
+    
+    Credits put up for sale are held in 'credit_reservations' (one per
+    listing) and counted in the balance's reserved_kg until the listing is
+    sold, cancelled or expires.
+    """
     
     def __init__(self, db):
         self.collection = db.credits
+        self.transactions = db.credit_transactions
+        self.balances = db.credit_balances
+        self.reservations = db.credit_reservations
         # Create indexes
-        self.collection.create_index([('user_id', 1), ('status', 1)])
-        self.collection.create_index('expiry_date')
+        ensure_index(self.collection, [('user_id', 1), ('status', 1)])
+        # Only active lots are ever looked up by expiry: FIFO consumption
+        # per user and the expiry sweeper
+        ensure_index(self.collection, [('user_id', 1), ('expiry_date', 1)],
+                     name='active_lots_by_user', partialFilterExpression={'status': 'active'})
+        drop_legacy_index(self.collection, 'expiry_date_1')
+        ensure_index(self.collection, 'expiry_date',
+                     name='active_lots_by_expiry', partialFilterExpression={'status': 'active'})
+        ensure_index(self.transactions, [('user_id', 1), ('created_at', 1)])
+        ensure_index(self.reservations, [('user_id', 1), ('expires_at', 1)],
+                     name='pending_reservations_by_user', partialFilterExpression={'status': 'pending'})
+        ensure_index(self.reservations, 'expires_at',
+                     name='pending_reservations_by_expiry', partialFilterExpression={'status': 'pending'})
+        # Released and consumed reservations are removed after the retention period
+        ensure_index(self.reservations, 'closed_at', name='closed_reservations_ttl',
+                     expireAfterSeconds=Config.CREDIT_RESERVATION_RETENTION_DAYS * 86400)
+    
+    def _client(self):
+        return self.collection.database.client
     
     def purchase_credit(self, user_id, credit_type, amount_kg_co2):
         """
         Purchase renewable energy credits
         
+        The lot, its ledger entry and the balance increment are written in
+        one transaction.
+        
         Args:
             user_id: User ID
             credit_type: 'solar', 'wind', or 'bio'
@@ -23,27 +72,53 @@ class Credit:
         Returns:
             credit_id
         """
+        user_oid = ObjectId(user_id)
+        self._ensure_balance(user_oid)
+        
         credit_doc = {
-            'user_id': ObjectId(user_id),
+            'user_id': user_oid,
             'credit_type': credit_type,
             'amount_kg_co2': amount_kg_co2,
             'purchase_date': datetime.utcnow(),
             'expiry_date': datetime.utcnow() + timedelta(days=365),  # Valid for 1 year
             'status': 'active',
-            'transaction_id': str(uuid.uuid4())
+            'transaction_id': str(uuid.uuid4()),
+            'version': 0
         }
         
-        result = self.collection.insert_one(credit_doc)
-        return str(result.inserted_id)
+        def write(session):
+            credit_id = self.collection.insert_one(credit_doc, session=session).inserted_id
+            self._log(session, user_oid, 'purchase', amount_kg_co2, credit_id, credit_type)
+            self.balances.update_one(
+                {'_id': user_oid},
+                {
+                    '$inc': {'available_kg': amount_kg_co2},
+                    '$min': {'next_expiry': credit_doc['expiry_date']},
+                    '$currentDate': {'updated_at': True}
+                },
+                upsert=True,
+                session=session
+            )
+            StatusSnapshot(self.collection.database).record_credits(
+                user_id, amount_kg_co2, self._next_expiry(user_oid, session), session
+            )
+            return credit_id
+        
+        credit_id = run_in_transaction(self._client(), write)
+        return str(credit_id)
     
     def get_active_credits(self, user_id):
-        """Get all active (non-expired) credits for a user"""
+        """
+        Get all active (non-expired) credits for a user
+        
+        Lots past their expiry are moved out of 'active' by the expiry
+        sweeper (and by get_balance), so no date predicate is needed.
+        """
         now = datetime.utcnow()
         
         credits = self.collection.find({
             'user_id': ObjectId(user_id),
-            'status': 'active',
-            'expiry_date': {'$gte': now}
+            'status': 'active'
         }).sort('purchase_date', -1)
         
         results = []
@@ -60,27 +135,107 @@ class Credit:
         
         return results
     
-    def get_total_active_credits(self, user_id):
-        """Get total amount of active credits"""
+    def get_credit_summary(self, user_id, offset=0, limit=0):
+        """
+        Totals of a user's active credits, grouped by type, in one aggregation
+        
+        Args:
+            user_id: User ID
+            offset: Lots to skip in the page of lot details
+            limit: Page size of lot details (0 for none)
+        
+        Returns:
+            {'total_offset_kg', 'credit_count', 'by_type': [{credit_type,
+            total_kg, count, next_expiry}], 'lots': [lot docs]}
+        """
         now = datetime.utcnow()
         
-        pipeline = [
+        facets = {
+            'by_type': [
+                {'$group': {
+                    '_id': '$credit_type',
+                    'total_kg': {'$sum': '$amount_kg_co2'},
+                    'count': {'$sum': 1},
+                    'next_expiry': {'$min': '$expiry_date'}
+                }},
+                {'$sort': {'_id': 1}}
+            ],
+            'totals': [
+                {'$group': {
+                    '_id': None,
+                    'total_offset_kg': {'$sum': '$amount_kg_co2'},
+                    'credit_count': {'$sum': 1}
+                }}
+            ]
+        }
+        if limit > 0:
+            facets['lots'] = [
+                {'$sort': {'purchase_date': -1, '_id': -1}},
+                {'$skip': offset},
+                {'$limit': limit},
+                {'$project': {
+                    'credit_type': 1,
+                    'amount_kg_co2': 1,
+                    'purchase_date': 1,
+                    'expiry_date': 1,
+                    'transaction_id': 1
+                }}
+            ]
+        
+        # Lots past their expiry but not yet swept are left out
+        result = next(self.collection.aggregate([
             {'$match': {
                 'user_id': ObjectId(user_id),
                 'status': 'active',
                 'expiry_date': {'$gte': now}
             }},
-            {'$group': {
-                '_id': None,
-                'total_offset_kg': {'$sum': '$amount_kg_co2'}
-            }}
-        ]
+            {'$facet': facets}
+        ]), {})
         
-        result = list(self.collection.aggregate(pipeline))
+        totals = (result.get('totals') or [{}])[0]
+        return {
+            'total_offset_kg': round(totals.get('total_offset_kg', 0), 2),
+            'credit_count': totals.get('credit_count', 0),
+            'by_type': [
+                {
+                    'credit_type': row['_id'],
+                    'total_kg': row['total_kg'],
+                    'count': row['count'],
+                    'next_expiry': row['next_expiry']
+                }
+                for row in result.get('by_type', [])
+            ],
+            'lots': result.get('lots', [])
+        }
+    
+    def get_total_active_credits(self, user_id):
+        """Get total amount of active credits (balance document read)"""
+        return self.get_balance(user_id)['available_kg']
+    
+    def get_balance(self, user_id):
+        """
+        Get the user's credit balance
+        
+        Built from the ledger on first use; lots past their expiry are
+        expired first.
+        
+        Returns:
+            {'available_kg': float, 'reserved_kg': float,
+             'next_expiry': datetime or None}
+        """
+        user_oid = ObjectId(user_id)
+        balance = self.balances.find_one({'_id': user_oid}) or self._ensure_balance(user_oid)
+        
+        next_expiry = balance.get('next_expiry')
+        if next_expiry and next_expiry < datetime.utcnow():
+            self.expire_lots(user_oid)
+            balance = self.balances.find_one({'_id': user_oid})
         
-        if result:
-            return round(result[0]['total_offset_kg'], 2)
-        return 0
+        return {
+            'available_kg': round(balance['available_kg'], 2),
+            'reserved_kg': round(balance.get('reserved_kg', 0), 2),
+            'next_expiry': balance.get('next_expiry')
+        }
     
     def get_credit_history(self, user_id):
         """Get all credit purchase history"""
@@ -105,54 +260,726 @@ class Credit:
         
         return results
     
-        return result.modified_count
-
-    def deduct_credits(self, user_id, amount_kg_co2):
+    def deduct_credits(self, user_id, amount_kg_co2, reference=None, reservation_id=None):
         """
         Deduct credits from user (for selling)
         
+        The balance is debited with a single conditional $inc, so
+        concurrent deductions can never take it below zero. Lots are then
+        consumed oldest expiry first with one version-checked bulk_write
+        in the same transaction; if another deduction touched one of the
+        lots in between, the transaction is aborted and retried.
+        
+        With a reservation the amount is taken from it (and from the
+        balance's reserved_kg); otherwise only unreserved credits can be
+        deducted.
+        
         Args:
             user_id: User ID
             amount_kg_co2: Amount to deduct
+            reference: Optional reference stored on the ledger entry
+            reservation_id: Reservation (listing id) the credits were held under
             
         Returns:
             True if successful, raises ValueError if insufficient
         """
-        # Get active credits sorted by expiry (use oldest first)
-        active_credits = list(self.collection.find({
-            'user_id': ObjectId(user_id),
-            'status': 'active',
-            'expiry_date': {'$gte': datetime.utcnow()}
-        }).sort('expiry_date', 1))
+        user_oid = ObjectId(user_id)
+        balance = self.get_balance(user_oid)
         
-        total_available = sum(c['amount_kg_co2'] for c in active_credits)
-        if total_available < amount_kg_co2:
-            raise ValueError(f'Insufficient credits. Available: {total_available}, Required: {amount_kg_co2}')
+        def write(session):
+            claimed = reservation_id is not None and self._claim_reservation(
+                session, reservation_id, user_oid, amount_kg_co2
+            )
             
-        remaining_to_deduct = amount_kg_co2
+            if claimed:
+                # Tolerance for float rounding of the running sum
+                balance_filter = {'_id': user_oid, 'available_kg': {'$gte': amount_kg_co2 - BALANCE_EPSILON}}
+                increments = {'available_kg': -amount_kg_co2, 'reserved_kg': -amount_kg_co2}
+            else:
+                balance_filter = {'_id': user_oid, '$expr': {'$gte': [
+                    self._unreserved_expr(), amount_kg_co2 - BALANCE_EPSILON
+                ]}}
+                increments = {'available_kg': -amount_kg_co2}
+            
+            result = self.balances.update_one(
+                balance_filter,
+                {'$inc': increments, '$currentDate': {'updated_at': True}},
+                session=session
+            )
+            if not result.modified_count:
+                if claimed and session is None:
+                    self._unclaim_reservation(reservation_id, amount_kg_co2)
+                available = balance['available_kg'] if claimed else round(
+                    balance['available_kg'] - balance['reserved_kg'], 2
+                )
+                raise ValueError(f"Insufficient credits. Available: {available}, Required: {amount_kg_co2}")
+            
+            if session is None:
+                try:
+                    self._consume_lots_sequential(user_oid, amount_kg_co2)
+                except Exception:
+                    # No transaction to abort: give back the balance and the
+                    # reservation (the lots were already put back), so the
+                    # ledger still matches and a retry starts from scratch
+                    self.balances.update_one(
+                        {'_id': user_oid},
+                        {'$inc': {field: -amount for field, amount in increments.items()}}
+                    )
+                    if claimed:
+                        self._unclaim_reservation(reservation_id, amount_kg_co2)
+                    raise
+            else:
+                self._consume_lots(session, user_oid, amount_kg_co2)
+            self._log(session, user_oid, 'deduct', -amount_kg_co2, reference=reference)
+            # The earliest lot may be gone now
+            StatusSnapshot(self.collection.database).record_credits(
+                user_id, -amount_kg_co2, self._next_expiry(user_oid, session), session
+            )
         
-        for credit in active_credits:
-            if remaining_to_deduct <= 0:
+        for _ in range(MAX_DEDUCT_ATTEMPTS):
+            try:
+                run_in_transaction(self._client(), write)
                 break
+            except LotConflict:
+                continue
+        else:
+            raise LotConflict('Credit lots kept changing during deduction, try again')
                 
-            if credit['amount_kg_co2'] <= remaining_to_deduct:
-                # Consume entire credit
-                self.collection.update_one(
-                    {'_id': credit['_id']},
-                    {'$set': {
-                        'status': 'transferred',
-                        'transferred_at': datetime.utcnow()
-                    }}
+        return True
+    
+    @staticmethod
+    def _unreserved_expr():
+        return {'$subtract': ['$available_kg', {'$ifNull': ['$reserved_kg', 0]}]}
+    
+    def reserve_credits(self, user_id, amount_kg_co2, reservation_id, expires_at, credit_type=None):
+        """
+        Hold credits for a sell listing
+        
+        The balance's reserved_kg is raised by one conditional update that
+        only matches while the unreserved balance covers the amount, so the
+        same credits can't be put up for sale twice.
+        
+        Args:
+            user_id: User ID
+            amount_kg_co2: Amount to hold
+            reservation_id: ObjectId of the reservation (the listing's id)
+            expires_at: When the reservation is released if still held
+            credit_type: Credit type listed
+        
+        Returns:
+            Reservation document; raises ValueError if the unreserved
+            balance is insufficient
+        """
+        user_oid = ObjectId(user_id)
+        now = datetime.utcnow()
+        
+        # Abandoned reservations would otherwise block the seller until the sweeper runs
+        self.release_expired_reservations(now, user_oid=user_oid)
+        balance = self.get_balance(user_oid)
+        
+        reservation = {
+            '_id': reservation_id,
+            'user_id': user_oid,
+            'credit_type': credit_type,
+            'amount_kg_co2': amount_kg_co2,
+            'original_amount': amount_kg_co2,
+            'status': 'pending',
+            'created_at': now,
+            'expires_at': expires_at
+        }
+        
+        def write(session):
+            result = self.balances.update_one(
+                {'_id': user_oid, '$expr': {'$gte': [
+                    self._unreserved_expr(), amount_kg_co2 - BALANCE_EPSILON
+                ]}},
+                {'$inc': {'reserved_kg': amount_kg_co2}, '$currentDate': {'updated_at': True}},
+                session=session
+            )
+            if not result.modified_count:
+                available = round(balance['available_kg'] - balance['reserved_kg'], 2)
+                raise ValueError(f'Insufficient credits. Available: {available} kg, Requested: {amount_kg_co2} kg')
+            
+            try:
+                self.reservations.insert_one(reservation, session=session)
+            except Exception:
+                if session is None:
+                    self.balances.update_one({'_id': user_oid}, {'$inc': {'reserved_kg': -amount_kg_co2}})
+                raise
+            return reservation
+        
+        return run_in_transaction(self._client(), write)
+    
+    def release_reservation(self, reservation_id, keep_kg=0):
+        """
+        Release what is left of a reservation back to the seller's
+        unreserved balance (listing cancelled or expired)
+        
+        Args:
+            reservation_id: Reservation (listing) ID
+            keep_kg: Amount to keep held for sales that are matched but
+                not yet settled; the reservation stays pending with it,
+                and its expiry is pushed past the payment window so
+                the expiry sweep re-checks it only once those sales are
+                paid for or cancelled
+        
+        Returns:
+            Amount released (0 if the reservation isn't held)
+        """
+        now = datetime.utcnow()
+        hold_until = now + timedelta(seconds=Config.ORDER_BOOK_PAYMENT_WINDOW_SECONDS)
+        
+        def write(session):
+            if keep_kg <= BALANCE_EPSILON:
+                reservation = self.reservations.find_one_and_update(
+                    {'_id': reservation_id, 'status': 'pending'},
+                    {'$set': {'status': 'released', 'closed_at': now}},
+                    session=session
                 )
-                remaining_to_deduct -= credit['amount_kg_co2']
+                released = reservation['amount_kg_co2'] if reservation else 0
             else:
-                # Partial deduction
-                self.collection.update_one(
-                    {'_id': credit['_id']},
-                    {'$set': {
-                        'amount_kg_co2': credit['amount_kg_co2'] - remaining_to_deduct
-                    }}
+                reservation = self.reservations.find_one(
+                    {'_id': reservation_id, 'status': 'pending'}, session=session
                 )
-                remaining_to_deduct = 0
-                
+                released = reservation['amount_kg_co2'] - keep_kg if reservation else 0
+                if released <= BALANCE_EPSILON:
+                    if reservation:
+                        self.reservations.update_one(
+                            {'_id': reservation_id, 'status': 'pending'},
+                            {'$max': {'expires_at': hold_until}},
+                            session=session
+                        )
+                    return 0
+                # Matched on the amount read, so a concurrent sale isn't overwritten
+                result = self.reservations.update_one(
+                    {'_id': reservation_id, 'status': 'pending', 'amount_kg_co2': reservation['amount_kg_co2']},
+                    {'$inc': {'amount_kg_co2': -released}, '$max': {'expires_at': hold_until}},
+                    session=session
+                )
+                if not result.modified_count:
+                    return 0
+            
+            if not reservation:
+                return 0
+            self.balances.update_one(
+                {'_id': reservation['user_id']},
+                {'$inc': {'reserved_kg': -released}, '$currentDate': {'updated_at': True}},
+                session=session
+            )
+            return released
+        
+        return run_in_transaction(self._client(), write)
+    
+    def release_expired_reservations(self, now=None, user_oid=None, limit=500):
+        """
+        Release reservations held past their expiry
+        
+        Amounts of the listing matched by order book fills that aren't
+        paid for yet stay reserved, or settling those fills would fail.
+        
+        Args:
+            user_oid: Only this user's reservations
+            limit: Maximum number released
+        
+        Returns:
+            (reservations released, kg released)
+        """
+        now = now or datetime.utcnow()
+        query = {'status': 'pending', 'expires_at': {'$lt': now}}
+        if user_oid is not None:
+            query['user_id'] = user_oid
+        
+        due = [reservation['_id'] for reservation in self.reservations.find(query, {'_id': 1}).limit(limit)]
+        if not due:
+            return 0, 0.0
+        keep = Payment(self.collection.database).get_unsettled_matched_kg_by_listing([str(oid) for oid in due])
+        
+        released = 0
+        released_kg = 0.0
+        for reservation_id in due:
+            amount = self.release_reservation(reservation_id, keep_kg=keep.get(str(reservation_id), 0))
+            if amount:
+                released += 1
+                released_kg += amount
+        return released, released_kg
+    
+    def _claim_reservation(self, session, reservation_id, user_oid, amount_kg_co2):
+        """
+        Take a sold amount out of a reservation
+        
+        Returns:
+            True if the reservation covered the amount
+        """
+        reservation = self.reservations.find_one_and_update(
+            {
+                '_id': reservation_id,
+                'user_id': user_oid,
+                'status': 'pending',
+                'amount_kg_co2': {'$gte': amount_kg_co2 - BALANCE_EPSILON}
+            },
+            {'$inc': {'amount_kg_co2': -amount_kg_co2}},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if not reservation:
+            return False
+        
+        if reservation['amount_kg_co2'] <= BALANCE_EPSILON:
+            self.reservations.update_one(
+                {'_id': reservation_id, 'status': 'pending'},
+                {'$set': {'status': 'consumed', 'amount_kg_co2': 0.0, 'closed_at': datetime.utcnow()}},
+                session=session
+            )
         return True
+    
+    def _unclaim_reservation(self, reservation_id, amount_kg_co2):
+        """Standalone-server rollback of _claim_reservation"""
+        self.reservations.update_one(
+            {'_id': reservation_id},
+            {'$inc': {'amount_kg_co2': amount_kg_co2}, '$set': {'status': 'pending'}, '$unset': {'closed_at': ''}}
+        )
+    
+    @staticmethod
+    def plan_fifo(lots, amount_kg_co2):
+        """
+        Split an amount across lots in the given (expiry) order
+        
+        Returns:
+            List of (lot, amount taken); raises ValueError if the lots
+            don't cover the amount
+        """
+        plan = []
+        remaining = amount_kg_co2
+        for lot in lots:
+            if remaining <= BALANCE_EPSILON:
+                break
+            take = min(lot['amount_kg_co2'], remaining)
+            plan.append((lot, take))
+            remaining -= take
+        
+        if remaining > BALANCE_EPSILON:
+            raise ValueError(f'Insufficient credits in active lots. Short by {remaining:.2f} kg')
+        return plan
+    
+    def _lot_update(self, lot, take):
+        """Version-checked update taking 'take' kg from a lot"""
+        version = {'version': lot['version']} if 'version' in lot else {'version': {'$exists': False}}
+        lot_filter = {'_id': lot['_id'], 'status': 'active', **version}
+        
+        if lot['amount_kg_co2'] - take <= BALANCE_EPSILON:
+            # Consume entire credit
+            update = {
+                '$set': {'status': 'transferred', 'transferred_at': datetime.utcnow()},
+                '$inc': {'version': 1}
+            }
+        else:
+            # Partial deduction
+            update = {'$inc': {'amount_kg_co2': -take, 'version': 1}}
+        return lot_filter, update
+    
+    def _lot_restore(self, lot, take):
+        """Standalone-server rollback of _lot_update"""
+        if lot['amount_kg_co2'] - take <= BALANCE_EPSILON:
+            update = {
+                '$set': {'status': 'active'},
+                '$unset': {'transferred_at': ''},
+                '$inc': {'version': 1}
+            }
+        else:
+            update = {'$inc': {'amount_kg_co2': take, 'version': 1}}
+        return {'_id': lot['_id']}, update
+    
+    def _active_lots(self, user_oid, session=None):
+        # Expired lots were moved out of 'active' by get_balance just before
+        return self.collection.find({
+            'user_id': user_oid,
+            'status': 'active'
+        }, session=session).sort('expiry_date', 1)
+    
+    def _consume_lots(self, session, user_oid, amount_kg_co2):
+        """
+        Take amount_kg_co2 from the user's lots, oldest expiry first, in
+        one bulk_write
+        
+        Raises:
+            LotConflict: A lot changed since it was read (aborts the transaction)
+        """
+        plan = self.plan_fifo(self._active_lots(user_oid, session), amount_kg_co2)
+        operations = [UpdateOne(*self._lot_update(lot, take)) for lot, take in plan]
+        
+        result = self.collection.bulk_write(operations, ordered=True, session=session)
+        if result.matched_count != len(operations):
+            raise LotConflict('Credit lot modified concurrently')
+    
+    def _consume_lots_sequential(self, user_oid, amount_kg_co2):
+        """
+        Standalone-server fallback for _consume_lots: without a
+        transaction a conflicting lot can't be rolled back, so lots are
+        updated one by one and the rest is re-planned on a conflict. If
+        the lots can't cover the amount, the ones already taken from are
+        put back before raising
+        """
+        remaining = amount_kg_co2
+        taken = []
+        try:
+            for _ in range(MAX_DEDUCT_ATTEMPTS):
+                for lot, take in self.plan_fifo(self._active_lots(user_oid), remaining):
+                    if not self.collection.update_one(*self._lot_update(lot, take)).matched_count:
+                        break
+                    taken.append((lot, take))
+                    remaining -= take
+                if remaining <= BALANCE_EPSILON:
+                    return
+            raise LotConflict('Credit lots kept changing during deduction, try again')
+        except Exception:
+            for lot, take in taken:
+                self.collection.update_one(*self._lot_restore(lot, take))
+            raise
+    
+    def expire_lots(self, user_id, now=None):
+        """
+        Move a user's lots past their expiry to 'expired' and debit the
+        balance by what was left on them
+        
+        Returns:
+            Amount expired (kg CO2)
+        """
+        user_oid = ObjectId(user_id)
+        now = now or datetime.utcnow()
+        
+        for _ in range(MAX_DEDUCT_ATTEMPTS):
+            due = list(self.collection.find({
+                'user_id': user_oid,
+                'status': 'active',
+                'expiry_date': {'$lt': now}
+            }))
+            try:
+                changes = self.expire_batch(due, now)
+                break
+            except LotConflict:
+                continue
+        else:
+            return 0
+        
+        return changes[user_oid][0] if user_oid in changes else 0
+    
+    def expire_batch(self, lots, now=None):
+        """
+        Expire the given lots (of any users) in one transaction: lots are
+        marked 'expired', ledger entries appended and each user's balance
+        debited, then status snapshots are updated in bulk
+        
+        Raises:
+            LotConflict: A lot changed since it was read (transaction aborted)
+        
+        Returns:
+            {user ObjectId: (kg expired, next expiry or None)}
+        """
+        if not lots:
+            return {}
+        now = now or datetime.utcnow()
+        
+        # Users still without a ledger get their opening entries first
+        self.ensure_balances(lot['user_id'] for lot in lots)
+        
+        def write(session):
+            if session is None:
+                # Standalone: apply lot by lot and only account for the ones that matched
+                expired = [
+                    lot for lot in lots
+                    if self.collection.update_one(*self._expire_update(lot, now)).modified_count
+                ]
+            else:
+                result = self.collection.bulk_write(
+                    [UpdateOne(*self._expire_update(lot, now)) for lot in lots],
+                    ordered=False,
+                    session=session
+                )
+                if result.matched_count != len(lots):
+                    raise LotConflict('Credit lot modified concurrently')
+                expired = lots
+            if not expired:
+                return {}
+            
+            self.transactions.insert_many([
+                self._entry(lot['user_id'], 'expire', -lot['amount_kg_co2'], lot['_id'], lot['credit_type'])
+                for lot in expired
+            ], session=session)
+            
+            expired_kg = {}
+            for lot in expired:
+                expired_kg[lot['user_id']] = expired_kg.get(lot['user_id'], 0) + lot['amount_kg_co2']
+            
+            next_expiry = {
+                row['_id']: row['next_expiry']
+                for row in self.collection.aggregate([
+                    {'$match': {'user_id': {'$in': list(expired_kg)}, 'status': 'active'}},
+                    {'$group': {'_id': '$user_id', 'next_expiry': {'$min': '$expiry_date'}}}
+                ], session=session)
+            }
+            
+            operations = []
+            for user_oid, amount in expired_kg.items():
+                update = {'$inc': {'available_kg': -amount}, '$currentDate': {'updated_at': True}}
+                if next_expiry.get(user_oid):
+                    update['$set'] = {'next_expiry': next_expiry[user_oid]}
+                else:
+                    update['$unset'] = {'next_expiry': ''}
+                operations.append(UpdateOne({'_id': user_oid}, update))
+            self.balances.bulk_write(operations, ordered=False, session=session)
+            
+            StatusSnapshot(self.collection.database).record_credit_changes({
+                uid: (-amount, next_expiry.get(uid)) for uid, amount in expired_kg.items()
+            }, session)
+            return {uid: (amount, next_expiry.get(uid)) for uid, amount in expired_kg.items()}
+        
+        return run_in_transaction(self._client(), write)
+    
+    def transfer_batch(self, session, transfers):
+        """
+        Move sold credits from sellers to buyers, many sales at once
+        
+        Runs inside the caller's transaction. Each sale is taken out of the
+        seller's reservation for its listing. Reservations and balances are
+        updated with one bulk_write each, sellers' lots are consumed with
+        one bulk_write per seller, and the buyers' new lots and all ledger
+        entries are written with one insert_many each. Balances must exist
+        already (see ensure_balances).
+        
+        Args:
+            session: Transaction session
+            transfers: [{'seller_oid', 'buyer_oid', 'reservation_id',
+                'credit_type', 'amount_kg_co2', 'reference'}]
+        
+        Raises:
+            LotConflict: A reservation, balance or lot no longer covers a
+                sale (aborts the transaction)
+        
+        Returns:
+            {user ObjectId: (kg change, earliest expiry of their active
+            lots afterwards or None)}
+        """
+        now = datetime.utcnow()
+        expiry_date = now + timedelta(days=365)  # Valid for 1 year
+        
+        by_reservation, by_seller, by_buyer = {}, {}, {}
+        for transfer in transfers:
+            amount = transfer['amount_kg_co2']
+            key = (transfer['reservation_id'], transfer['seller_oid'])
+            by_reservation[key] = by_reservation.get(key, 0) + amount
+            by_seller[transfer['seller_oid']] = by_seller.get(transfer['seller_oid'], 0) + amount
+            by_buyer[transfer['buyer_oid']] = by_buyer.get(transfer['buyer_oid'], 0) + amount
+        
+        result = self.reservations.bulk_write([
+            UpdateOne(
+                {
+                    '_id': reservation_id,
+                    'user_id': seller_oid,
+                    'status': 'pending',
+                    'amount_kg_co2': {'$gte': amount - BALANCE_EPSILON}
+                },
+                {'$inc': {'amount_kg_co2': -amount}}
+            )
+            for (reservation_id, seller_oid), amount in by_reservation.items()
+        ], ordered=False, session=session)
+        if result.matched_count != len(by_reservation):
+            raise LotConflict('Credit reservation no longer covers the sale')
+        self.reservations.update_many(
+            {
+                '_id': {'$in': [reservation_id for reservation_id, _ in by_reservation]},
+                'status': 'pending',
+                'amount_kg_co2': {'$lte': BALANCE_EPSILON}
+            },
+            {'$set': {'status': 'consumed', 'amount_kg_co2': 0.0, 'closed_at': now}},
+            session=session
+        )
+        
+        result = self.balances.bulk_write([
+            UpdateOne(
+                {'_id': seller_oid, 'available_kg': {'$gte': amount - BALANCE_EPSILON}},
+                {
+                    '$inc': {'available_kg': -amount, 'reserved_kg': -amount},
+                    '$currentDate': {'updated_at': True}
+                }
+            )
+            for seller_oid, amount in by_seller.items()
+        ], ordered=False, session=session)
+        if result.matched_count != len(by_seller):
+            raise LotConflict('Seller balance no longer covers the sale')
+        # Sellers' lots go before buyers' lots are added, so a user on both
+        # sides never sells credits bought in the same batch
+        for seller_oid, amount in by_seller.items():
+            self._consume_lots(session, seller_oid, amount)
+        
+        lots, entries = [], []
+        for transfer in transfers:
+            amount = transfer['amount_kg_co2']
+            lot = {
+                '_id': ObjectId(),
+                'user_id': transfer['buyer_oid'],
+                'credit_type': transfer['credit_type'],
+                'amount_kg_co2': amount,
+                'purchase_date': now,
+                'expiry_date': expiry_date,
+                'status': 'active',
+                'transaction_id': str(uuid.uuid4()),
+                'version': 0
+            }
+            lots.append(lot)
+            entries.append(self._entry(transfer['seller_oid'], 'deduct', -amount, reference=transfer['reference']))
+            entries.append(self._entry(
+                transfer['buyer_oid'], 'purchase', amount, lot['_id'], transfer['credit_type'], transfer['reference']
+            ))
+        self.collection.insert_many(lots, session=session)
+        self.transactions.insert_many(entries, session=session)
+        
+        self.balances.bulk_write([
+            UpdateOne(
+                {'_id': buyer_oid},
+                {
+                    '$inc': {'available_kg': amount},
+                    '$min': {'next_expiry': expiry_date},
+                    '$currentDate': {'updated_at': True}
+                },
+                upsert=True
+            )
+            for buyer_oid, amount in by_buyer.items()
+        ], ordered=False, session=session)
+        
+        kg_change = {seller_oid: -amount for seller_oid, amount in by_seller.items()}
+        for buyer_oid, amount in by_buyer.items():
+            kg_change[buyer_oid] = kg_change.get(buyer_oid, 0) + amount
+        # Sellers may have sold their earliest lots
+        next_expiry = {
+            row['_id']: row['next_expiry']
+            for row in self.collection.aggregate([
+                {'$match': {'user_id': {'$in': list(kg_change)}, 'status': 'active'}},
+                {'$group': {'_id': '$user_id', 'next_expiry': {'$min': '$expiry_date'}}}
+            ], session=session)
+        }
+        return {user_oid: (change, next_expiry.get(user_oid)) for user_oid, change in kg_change.items()}
+    
+    def ensure_balances(self, user_oids):
+        """Create the missing balance documents of many users"""
+        user_oids = list(set(user_oids))
+        with_balance = set(self.balances.distinct('_id', {'_id': {'$in': user_oids}}))
+        for user_oid in user_oids:
+            if user_oid not in with_balance:
+                self._ensure_balance(user_oid)
+    
+    def _expire_update(self, lot, now):
+        """Version-checked update marking a lot expired"""
+        version = {'version': lot['version']} if 'version' in lot else {'version': {'$exists': False}}
+        return (
+            {'_id': lot['_id'], 'status': 'active', **version},
+            {'$set': {'status': 'expired', 'expired_at': now}, '$inc': {'version': 1}}
+        )
+    
+    def _next_expiry(self, user_oid, session=None):
+        lot = self.collection.find_one(
+            {'user_id': user_oid, 'status': 'active'},
+            {'expiry_date': 1},
+            sort=[('expiry_date', 1)],
+            session=session
+        )
+        return lot['expiry_date'] if lot else None
+    
+    def _log(self, session, user_oid, kind, amount_kg_co2, lot_id=None, credit_type=None, reference=None):
+        """Append a ledger entry (signed amount: credits in are positive)"""
+        self.transactions.insert_one(
+            self._entry(user_oid, kind, amount_kg_co2, lot_id, credit_type, reference),
+            session=session
+        )
+    
+    def _entry(self, user_oid, kind, amount_kg_co2, lot_id=None, credit_type=None, reference=None):
+        return {
+            'user_id': user_oid,
+            'type': kind,
+            'amount_kg_co2': amount_kg_co2,
+            'lot_id': lot_id,
+            'credit_type': credit_type,
+            'reference': reference,
+            'created_at': datetime.utcnow()
+        }
+    
+    def _ensure_balance(self, user_oid):
+        """Get the balance document, creating it from the ledger if missing"""
+        balance = self.balances.find_one({'_id': user_oid})
+        if balance:
+            return balance
+        
+        self.backfill_ledger(user_oid)
+        try:
+            return self.rebuild_balance(user_oid, replace=False)
+        except DuplicateKeyError:
+            # Created concurrently
+            return self.balances.find_one({'_id': user_oid})
+    
+    def backfill_ledger(self, user_oid):
+        """
+        Write opening ledger entries for lots that predate the ledger
+        
+        Entry ids are derived from the lot, so concurrent backfills don't
+        duplicate them.
+        
+        Returns:
+            Number of entries written
+        """
+        if self.transactions.find_one({'user_id': user_oid}, {'_id': 1}):
+            return 0
+        
+        entries = [{
+            '_id': f"opening:{lot['_id']}",
+            'user_id': user_oid,
+            'type': 'opening',
+            'amount_kg_co2': lot['amount_kg_co2'],
+            'lot_id': lot['_id'],
+            'credit_type': lot['credit_type'],
+            'reference': None,
+            'created_at': lot['purchase_date']
+        } for lot in self.collection.find({'user_id': user_oid, 'status': 'active'})]
+        
+        if not entries:
+            return 0
+        try:
+            return len(self.transactions.insert_many(entries, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            return e.details['nInserted']
+    
+    def rebuild_balance(self, user_oid, replace=True):
+        """
+        Recompute the balance document from the ledger (and reserved_kg
+        from the held reservations)
+        
+        Args:
+            replace: Overwrite an existing document (otherwise insert,
+                raising DuplicateKeyError if it exists)
+        
+        Returns:
+            Balance document
+        """
+        totals = list(self.transactions.aggregate([
+            {'$match': {'user_id': user_oid}},
+            {'$group': {'_id': None, 'available_kg': {'$sum': '$amount_kg_co2'}}}
+        ]))
+        
+        reserved = list(self.reservations.aggregate([
+            {'$match': {'user_id': user_oid, 'status': 'pending'}},
+            {'$group': {'_id': None, 'reserved_kg': {'$sum': '$amount_kg_co2'}}}
+        ]))
+        
+        balance = {
+            '_id': user_oid,
+            'available_kg': totals[0]['available_kg'] if totals else 0,
+            'reserved_kg': reserved[0]['reserved_kg'] if reserved else 0,
+            'updated_at': datetime.utcnow()
+        }
+        next_expiry = self._next_expiry(user_oid)
+        if next_expiry:
+            balance['next_expiry'] = next_expiry
+        
+        if replace:
+            self.balances.replace_one({'_id': user_oid}, balance, upsert=True)
+        else:
+            self.balances.insert_one(balance)
+        return balance
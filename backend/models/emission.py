@@ -1,5 +1,9 @@
 from datetime import datetime, timedelta
 from bson import ObjectId
+from services.forecast_cache import forecast_cache
+from models.status_snapshot import StatusSnapshot
+from utils.indexes import ensure_index
+from utils.transactions import run_in_transaction
 
 class Emission:
     """Emission model for storing and querying carbon emission data"""
@@ -7,14 +11,18 @@ class Emission:
     def __init__(self, db):
         self.collection = db.emissions
         # Create indexes for efficient querying
-        self.collection.create_index([('user_id', 1), ('timestamp', -1)])
-        self.collection.create_index('timestamp')
+        ensure_index(self.collection, [('user_id', 1), ('timestamp', -1)])
+        ensure_index(self.collection, 'timestamp')
     
     def add_emission(self, user_id, electricity_kwh, electricity_co2_kg, 
-                     combustion_ppm, combustion_co2_kg, source='iot'):
+                     combustion_ppm, combustion_co2_kg, source='iot', timestamp=None):
         """
         Add a new emission record
         
+        The reading and its status snapshot delta are written in one
+        transaction, so a snapshot rebuild can't count the reading from
+        the emissions collection and then get the delta on top.
+        
         Args:
             user_id: User ID
             electricity_kwh: Electricity consumption in kWh
@@ -22,13 +30,14 @@ class Emission:
             combustion_ppm: Combustion CO2 in ppm
             combustion_co2_kg: Calculated CO2 from combustion
             source: 'iot' or 'simulated'
+            timestamp: Reading time (defaults to now)
         
         Returns:
             emission_id
         """
         emission_doc = {
             'user_id': ObjectId(user_id),
-            'timestamp': datetime.utcnow(),
+            'timestamp': timestamp or datetime.utcnow(),
             'electricity_kwh': electricity_kwh,
             'electricity_co2_kg': electricity_co2_kg,
             'combustion_ppm': combustion_ppm,
@@ -37,8 +46,21 @@ class Emission:
             'source': source
         }
         
-        result = self.collection.insert_one(emission_doc)
-        return str(result.inserted_id)
+        snapshots = StatusSnapshot(self.collection.database)
+        
+        def write(session):
+            result = self.collection.insert_one(emission_doc, session=session)
+            snapshots.record_emission(
+                user_id, electricity_co2_kg, combustion_co2_kg, emission_doc['timestamp'], session=session
+            )
+            return result.inserted_id
+        
+        emission_id = run_in_transaction(self.collection.database.client, write)
+        
+        # New data changes the forecast
+        forecast_cache.invalidate(user_id)
+        
+        return str(emission_id)
     
     def get_emissions_by_period(self, user_id, period='daily', limit=30):
         """
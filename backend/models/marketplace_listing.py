@@ -1,27 +1,62 @@
 from bson import ObjectId
+from bson.errors import InvalidId
 from datetime import datetime, timedelta
+import base64
+import json
+from pymongo import ReturnDocument, UpdateOne
+from models.marketplace_order import AMOUNT_EPSILON
+from utils.indexes import ensure_index
+
+# Listing sort orders: name -> (field, direction); _id breaks ties
+LISTING_SORTS = {
+    'price_asc': ('price_per_kg', 1),
+    'price_desc': ('price_per_kg', -1),
+    'amount_desc': ('amount_kg_co2', -1),
+    'newest': ('created_at', -1)
+}
 
 class MarketplaceListing:
     """Model for marketplace credit listings"""
     
+    LISTING_DAYS = 30
+    
     def __init__(self, db):
         self.collection = db.marketplace_listings
+        # Search indexes cover only active listings, one per sort order
+        # (with and without the credit type filter); sold, cancelled and
+        # expired listings stay out of them. Listings past expires_at are
+        # moved out of 'active' by the listing_expiry sweeper, so searches
+        # don't re-check the expiry.
+        active = {'status': 'active'}
+        ensure_index(self.collection, [('price_per_kg', 1), ('_id', 1)],
+                     name='active_by_price', partialFilterExpression=active)
+        ensure_index(self.collection, [('credit_type', 1), ('price_per_kg', 1), ('_id', 1)],
+                     name='active_by_type_price', partialFilterExpression=active)
+        ensure_index(self.collection, [('amount_kg_co2', -1), ('_id', -1)],
+                     name='active_by_amount', partialFilterExpression=active)
+        ensure_index(self.collection, [('created_at', -1), ('_id', -1)],
+                     name='active_by_newest', partialFilterExpression=active)
+        ensure_index(self.collection, 'expires_at',
+                     name='active_by_expiry', partialFilterExpression=active)
+        ensure_index(self.collection, [('seller_id', 1), ('created_at', -1)])
     
-    def create_listing(self, seller_id, credit_type, amount_kg_co2, price_per_kg):
+    def create_listing(self, seller_id, credit_type, amount_kg_co2, price_per_kg, listing_id=None, expires_at=None):
         """
         Create a new marketplace listing
         
         Args:
-            seller_id: User selling credits
+            seller_id: User selling credits (stored as an ObjectId)
             credit_type: Type of credit (solar/wind/bio)
             amount_kg_co2: Amount of credits to sell
             price_per_kg: Price per kg CO2
+            listing_id: Optional ObjectId (the credit reservation's id)
+            expires_at: Optional expiry (defaults to LISTING_DAYS from now)
         
         Returns:
             Created listing document
         """
         listing = {
-            'seller_id': seller_id,
+            'seller_id': ObjectId(seller_id),
             'credit_type': credit_type,
             'amount_kg_co2': float(amount_kg_co2),
             'original_amount': float(amount_kg_co2),
@@ -29,98 +64,310 @@ class MarketplaceListing:
             'total_price': float(amount_kg_co2 * price_per_kg),
             'status': 'active',
             'created_at': datetime.utcnow(),
-            'expires_at': datetime.utcnow() + timedelta(days=30),  # 30 day expiry
+            'expires_at': expires_at or datetime.utcnow() + timedelta(days=self.LISTING_DAYS),
             'views': 0,
             'sold_amount': 0.0
         }
+        if listing_id is not None:
+            listing['_id'] = listing_id
         
         result = self.collection.insert_one(listing)
         listing['_id'] = result.inserted_id
         
         return self._format_listing(listing)
     
-    def get_active_listings(self, filters=None):
+    def get_active_listings(self, filters=None, sort='price_asc', limit=20, cursor=None):
         """
-        Get all active marketplace listings
+        Get a page of active marketplace listings
+        
+        Pages are keyed on (sort field, _id), so each page is an index
+        range scan no matter how deep. The first page (no cursor) is one
+        aggregation that also counts listings per credit type.
         
         Args:
             filters: Optional filters (credit_type, max_price, min_amount)
+            sort: One of LISTING_SORTS
+            limit: Page size
+            cursor: next_cursor of the previous page
+        
+        Returns:
+            {'listings': [...], 'next_cursor': str or None,
+             'counts_by_type': {credit_type: n} (first page only, under
+             all filters except credit_type)}
+        """
+        query, credit_type, order = self.search_query(filters, sort, cursor)
+        
+        if cursor is None:
+            result = next(self.collection.aggregate(
+                self.first_page_pipeline(query, credit_type, order, limit)
+            ))
+            listings = result['listings']
+            counts = {row['_id']: row['count'] for row in result['counts']}
+        else:
+            if credit_type:
+                query['credit_type'] = credit_type
+            listings = list(self.collection.find(query).sort(order).limit(limit + 1))
+            counts = None
+        
+        next_cursor = None
+        if len(listings) > limit:
+            listings = listings[:limit]
+            next_cursor = self._encode_cursor(listings[-1], sort)
+        
+        return {
+            'listings': [self._format_listing(l) for l in listings],
+            'next_cursor': next_cursor,
+            'counts_by_type': counts
+        }
+    
+    def search_query(self, filters, sort, cursor=None):
+        """
+        Build the search filter
         
         Returns:
-            List of active listings
+            (filter without credit_type, credit_type or None, sort spec)
         """
+        if sort not in LISTING_SORTS:
+            raise ValueError(f"Invalid sort. Must be one of: {', '.join(LISTING_SORTS)}")
+        field, direction = LISTING_SORTS[sort]
+        filters = filters or {}
+        
         query = {
             'status': 'active',
-            'amount_kg_co2': {'$gt': 0},
-            'expires_at': {'$gt': datetime.utcnow()}
+            'amount_kg_co2': {'$gt': 0}
         }
+        if 'max_price' in filters:
+            query['price_per_kg'] = {'$lte': float(filters['max_price'])}
+        if 'min_amount' in filters:
+            query['amount_kg_co2'] = {'$gte': float(filters['min_amount'])}
         
-        if filters:
-            if 'credit_type' in filters:
-                query['credit_type'] = filters['credit_type']
-            if 'max_price' in filters:
-                query['price_per_kg'] = {'$lte': float(filters['max_price'])}
-            if 'min_amount' in filters:
-                query['amount_kg_co2'] = {'$gte': float(filters['min_amount'])}
+        if cursor is not None:
+            value, last_id = self._decode_cursor(cursor, sort)
+            op = '$gt' if direction == 1 else '$lt'
+            query['$or'] = [
+                {field: {op: value}},
+                {field: value, '_id': {op: last_id}}
+            ]
         
-        listings = list(self.collection.find(query).sort('price_per_kg', 1))
-        return [self._format_listing(l) for l in listings]
+        return query, filters.get('credit_type'), [(field, direction), ('_id', direction)]
+    
+    @staticmethod
+    def first_page_pipeline(query, credit_type, order, limit):
+        """First page plus per-type counts in one pass over the matches"""
+        page_stages = [{'$match': {'credit_type': credit_type}}] if credit_type else []
+        return [
+            {'$match': query},
+            # Before $facet, so the sort is served by the index
+            {'$sort': dict(order)},
+            {'$facet': {
+                'listings': page_stages + [{'$limit': limit + 1}],
+                'counts': [{'$group': {'_id': '$credit_type', 'count': {'$sum': 1}}}]
+            }}
+        ]
+    
+    def _encode_cursor(self, listing, sort):
+        value = listing[LISTING_SORTS[sort][0]]
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        raw = json.dumps([sort, value, str(listing['_id'])])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+    
+    def _decode_cursor(self, cursor, sort):
+        try:
+            cursor_sort, value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if cursor_sort != sort:
+                raise ValueError
+            if sort == 'newest':
+                value = datetime.fromisoformat(value)
+            return value, ObjectId(last_id)
+        except (ValueError, TypeError, InvalidId):
+            raise ValueError('Invalid cursor')
     
     def get_listing_by_id(self, listing_id):
         """Get a specific listing by ID"""
         listing = self.collection.find_one({'_id': ObjectId(listing_id)})
         return self._format_listing(listing) if listing else None
     
+    def get_listings_by_ids(self, listing_ids):
+        """
+        Get many listings with one $in query
+        
+        Returns:
+            {listing_id: listing}
+        """
+        oids = list({ObjectId(listing_id) for listing_id in listing_ids})
+        if not oids:
+            return {}
+        return {
+            str(listing['_id']): self._format_listing(listing)
+            for listing in self.collection.find({'_id': {'$in': oids}})
+        }
+    
     def get_user_listings(self, user_id, status=None):
         """
         Get all listings created by a user
         
         Args:
             user_id: User ID
-            status: Optional status filter (active/sold/cancelled)
+            status: Optional status filter (active/sold/cancelled/expired)
         
         Returns:
             List of user's listings
         """
-        query = {'seller_id': user_id}
+        query = {'seller_id': self.seller_match(user_id)}
         if status:
             query['status'] = status
         
         listings = list(self.collection.find(query).sort('created_at', -1))
         return [self._format_listing(l) for l in listings]
     
-    def update_listing_amount(self, listing_id, amount_purchased):
+    @staticmethod
+    def seller_match(user_id):
         """
-        Update listing after partial purchase
+        Filter on a seller's listings
+        
+        seller_id is stored as an ObjectId; listings created before that
+        keep the string form until migrate_seller_ids.py has run.
+        """
+        return {'$in': [ObjectId(user_id), str(user_id)]}
+    
+    def update_listing_amount(self, listing_id, amount_purchased, session=None):
+        """
+        Take a direct purchase off a listing
+        
+        One conditional find_one_and_update: the listing must be active and
+        still hold the amount, so concurrent buyers cannot oversell it. A
+        pipeline update decrements the amount and marks the listing sold
+        when nothing is left.
         
         Args:
             listing_id: Listing ID
             amount_purchased: Amount that was purchased
+            session: Optional transaction session
+        
+        Returns:
+            Updated listing
         """
-        listing = self.collection.find_one({'_id': ObjectId(listing_id)})
-        if not listing:
-            raise ValueError('Listing not found')
+        listing = self.collection.find_one_and_update(
+            *self.take_update(ObjectId(listing_id), amount_purchased),
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if listing:
+            return self._format_listing(listing)
         
-        new_amount = listing['amount_kg_co2'] - amount_purchased
-        sold_amount = listing.get('sold_amount', 0) + amount_purchased
+        # Only the failure path pays for a second read, to explain why
+        current = self.collection.find_one({'_id': ObjectId(listing_id)}, session=session)
+        if not current:
+            raise ValueError('Listing not found')
+        if current['status'] != 'active':
+            raise ValueError('Listing is not active')
+        raise ValueError(f'Insufficient amount available. Available: {current["amount_kg_co2"]} kg')
+    
+    @staticmethod
+    def take_update(listing_oid, amount_kg_co2):
+        """
+        (filter, pipeline update) taking a purchased amount off an active
+        listing that still holds it; the listing is marked sold when
+        nothing is left
+        """
+        remaining = {'$subtract': ['$amount_kg_co2', amount_kg_co2]}
+        sold_out = {'$lte': ['$amount_kg_co2', AMOUNT_EPSILON]}
         
-        update = {
-            'amount_kg_co2': new_amount,
-            'sold_amount': sold_amount,
-            'total_price': new_amount * listing['price_per_kg']
-        }
+        return (
+            {
+                '_id': listing_oid,
+                'status': 'active',
+                'amount_kg_co2': {'$gte': amount_kg_co2 - AMOUNT_EPSILON}
+            },
+            [
+                {'$set': {
+                    'amount_kg_co2': remaining,
+                    'sold_amount': {'$add': [{'$ifNull': ['$sold_amount', 0]}, amount_kg_co2]}
+                }},
+                {'$set': {
+                    'amount_kg_co2': {'$cond': [sold_out, 0.0, '$amount_kg_co2']},
+                    'total_price': {'$cond': [sold_out, 0.0, {'$multiply': ['$amount_kg_co2', '$price_per_kg']}]},
+                    'status': {'$cond': [sold_out, 'sold', '$status']},
+                    'sold_at': {'$cond': [sold_out, '$$NOW', '$$REMOVE']}
+                }}
+            ]
+        )
+    
+    def apply_fill(self, listing_id, amount_kg_co2, price_per_kg, session=None):
+        """
+        Take an order book fill off an active listing
         
-        # Mark as sold if fully purchased
-        if new_amount <= 0:
-            update['status'] = 'sold'
-            update['sold_at'] = datetime.utcnow()
+        Returns:
+            True if the listing still had the amount available
+        """
+        result = self.collection.update_one(
+            {
+                '_id': listing_id,
+                'status': 'active',
+                'amount_kg_co2': {'$gte': amount_kg_co2 - AMOUNT_EPSILON}
+            },
+            {'$inc': {
+                'amount_kg_co2': -amount_kg_co2,
+                'sold_amount': amount_kg_co2,
+                'total_price': -amount_kg_co2 * price_per_kg
+            }},
+            session=session
+        )
+        if not result.matched_count:
+            return False
         
+        self._mark_sold(listing_id, session)
+        return True
+    
+    def revert_fill(self, listing_id, amount_kg_co2, price_per_kg):
+        """Standalone-server rollback of apply_fill"""
         self.collection.update_one(
-            {'_id': ObjectId(listing_id)},
-            {'$set': update}
+            {'_id': listing_id},
+            {
+                '$inc': {
+                    'amount_kg_co2': amount_kg_co2,
+                    'sold_amount': -amount_kg_co2,
+                    'total_price': amount_kg_co2 * price_per_kg
+                },
+                '$set': {'status': 'active'},
+                '$unset': {'sold_at': ''}
+            }
         )
+    
+    def return_unpaid_fill(self, listing_id, amount_kg_co2, session=None):
+        """
+        Put the amount of a cancelled (unpaid) order book fill back on
+        the listing, reopening it if the fill had sold it out
+        
+        Cancelled and expired listings are left alone; their seller gets
+        the amount back through the reservation instead.
         
-        return self.get_listing_by_id(listing_id)
+        Returns:
+            True if the listing took the amount back
+        """
+        result = self.collection.update_one(
+            {'_id': listing_id, 'status': {'$in': ['active', 'sold']}},
+            [
+                {'$set': {
+                    'amount_kg_co2': {'$add': ['$amount_kg_co2', amount_kg_co2]},
+                    'sold_amount': {'$subtract': [{'$ifNull': ['$sold_amount', 0]}, amount_kg_co2]},
+                    'status': 'active',
+                    'sold_at': '$$REMOVE'
+                }},
+                {'$set': {'total_price': {'$multiply': ['$amount_kg_co2', '$price_per_kg']}}}
+            ],
+            session=session
+        )
+        return result.matched_count > 0
+    
+    def _mark_sold(self, listing_id, session=None):
+        """Mark a listing sold once nothing is left"""
+        self.collection.update_one(
+            {'_id': listing_id, 'status': 'active', 'amount_kg_co2': {'$lte': AMOUNT_EPSILON}},
+            {'$set': {'status': 'sold', 'amount_kg_co2': 0.0, 'total_price': 0.0, 'sold_at': datetime.utcnow()}},
+            session=session
+        )
     
     def cancel_listing(self, listing_id, user_id):
         """
@@ -133,26 +380,54 @@ class MarketplaceListing:
         Returns:
             Updated listing
         """
-        listing = self.collection.find_one({
+        seller_filter = {
             '_id': ObjectId(listing_id),
-            'seller_id': user_id
-        })
-        
-        if not listing:
-            raise ValueError('Listing not found or unauthorized')
-        
-        if listing['status'] != 'active':
-            raise ValueError('Can only cancel active listings')
+            'seller_id': self.seller_match(user_id)
+        }
         
-        self.collection.update_one(
-            {'_id': ObjectId(listing_id)},
+        # Conditional on 'active', so a sale, expiry or concurrent cancel
+        # landing first is never overwritten
+        listing = self.collection.find_one_and_update(
+            {**seller_filter, 'status': 'active'},
             {'$set': {
                 'status': 'cancelled',
                 'cancelled_at': datetime.utcnow()
-            }}
+            }},
+            return_document=ReturnDocument.AFTER
         )
         
-        return self.get_listing_by_id(listing_id)
+        if not listing:
+            if not self.collection.find_one(seller_filter, {'_id': 1}):
+                raise ValueError('Listing not found or unauthorized')
+            raise ValueError('Can only cancel active listings')
+        
+        return self._format_listing(listing)
+    
+    def get_expired(self, now, limit):
+        """Active listings past their expiry, oldest expiry first"""
+        return list(self.collection.find(
+            {'status': 'active', 'expires_at': {'$lt': now}},
+            {'credit_type': 1, 'expires_at': 1}
+        ).sort('expires_at', 1).limit(limit))
+    
+    def expire_batch(self, listing_ids, now):
+        """
+        Mark a batch of listings expired with one update_many
+        
+        Listings sold or cancelled since they were read are left alone.
+        
+        Returns:
+            Listings this call expired ({_id, credit_type})
+        """
+        self.collection.update_many(
+            {'_id': {'$in': listing_ids}, 'status': 'active', 'expires_at': {'$lt': now}},
+            {'$set': {'status': 'expired', 'expired_at': now}}
+        )
+        # Read back by expired_at, so listings expired by a concurrent sweep aren't released twice
+        return list(self.collection.find(
+            {'_id': {'$in': listing_ids}, 'status': 'expired', 'expired_at': now},
+            {'credit_type': 1}
+        ))
     
     def increment_views(self, listing_id):
         """Increment view count for a listing"""
@@ -161,6 +436,20 @@ class MarketplaceListing:
             {'$inc': {'views': 1}}
         )
     
+    def add_views(self, counts):
+        """
+        Add buffered view counts in one unordered bulk_write
+        
+        Args:
+            counts: {listing_id: views}
+        """
+        operations = [
+            UpdateOne({'_id': ObjectId(listing_id)}, {'$inc': {'views': views}})
+            for listing_id, views in counts.items()
+        ]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+    
     def _format_listing(self, listing):
         """Format listing for API response"""
         if not listing:
@@ -168,7 +457,7 @@ class MarketplaceListing:
         
         return {
             'listing_id': str(listing['_id']),
-            'seller_id': listing['seller_id'],
+            'seller_id': str(listing['seller_id']),
             'credit_type': listing['credit_type'],
             'amount_kg_co2': listing['amount_kg_co2'],
             'original_amount': listing.get('original_amount', listing['amount_kg_co2']),
@@ -180,5 +469,6 @@ class MarketplaceListing:
             'views': listing.get('views', 0),
             'sold_amount': listing.get('sold_amount', 0.0),
             'sold_at': listing.get('sold_at').isoformat() if listing.get('sold_at') else None,
-            'cancelled_at': listing.get('cancelled_at').isoformat() if listing.get('cancelled_at') else None
+            'cancelled_at': listing.get('cancelled_at').isoformat() if listing.get('cancelled_at') else None,
+            'expired_at': listing.get('expired_at').isoformat() if listing.get('expired_at') else None
         }
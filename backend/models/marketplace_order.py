@@ -0,0 +1,164 @@
+from bson import ObjectId
+from datetime import datetime
+from utils.indexes import ensure_index
+
+# Slack for float rounding of remaining amounts
+AMOUNT_EPSILON = 1e-6
+
+class MarketplaceOrder:
+    """
+    Model for limit buy orders on the marketplace order book
+
+    Sell orders are marketplace listings (their credits are reserved when
+    listed); buy orders rest here until filled or cancelled. Fills are
+    recorded as payments.
+    """
+
+    def __init__(self, db):
+        self.collection = db.marketplace_orders
+        ensure_index(self.collection, [('credit_type', 1), ('created_at', 1)],
+                     name='open_orders', partialFilterExpression={'status': 'open'})
+        ensure_index(self.collection, [('user_id', 1), ('created_at', -1)])
+
+    def create_order(self, user_id, credit_type, price_per_kg, amount_kg_co2):
+        """
+        Create an open buy order
+
+        Returns:
+            Order document
+        """
+        order = {
+            'user_id': user_id,
+            'side': 'buy',
+            'credit_type': credit_type,
+            'price_per_kg': float(price_per_kg),
+            'amount_kg_co2': float(amount_kg_co2),
+            'remaining_kg': float(amount_kg_co2),
+            'filled_kg': 0.0,
+            'status': 'open',
+            'created_at': datetime.utcnow()
+        }
+
+        result = self.collection.insert_one(order)
+        order['_id'] = result.inserted_id
+        return order
+
+    def get_order(self, order_id):
+        """Get an order document by ID"""
+        return self.collection.find_one({'_id': ObjectId(order_id)})
+
+    def get_open_orders(self, credit_type=None):
+        """Open buy orders, oldest first (time priority)"""
+        query = {'status': 'open'}
+        if credit_type:
+            query['credit_type'] = credit_type
+        return self.collection.find(query).sort('created_at', 1)
+
+    def get_user_orders(self, user_id, status=None):
+        """Get a user's buy orders, newest first"""
+        query = {'user_id': user_id}
+        if status:
+            query['status'] = status
+
+        orders = self.collection.find(query).sort('created_at', -1)
+        return [self.format_order(o) for o in orders]
+
+    def apply_fill(self, order_id, amount_kg_co2, session=None):
+        """
+        Take a fill off an open order
+
+        Returns:
+            True if the order still had the amount open
+        """
+        result = self.collection.update_one(
+            {
+                '_id': order_id,
+                'status': 'open',
+                'remaining_kg': {'$gte': amount_kg_co2 - AMOUNT_EPSILON}
+            },
+            {'$inc': {'remaining_kg': -amount_kg_co2, 'filled_kg': amount_kg_co2}},
+            session=session
+        )
+        if not result.matched_count:
+            return False
+
+        self.collection.update_one(
+            {'_id': order_id, 'status': 'open', 'remaining_kg': {'$lte': AMOUNT_EPSILON}},
+            {'$set': {'status': 'filled', 'remaining_kg': 0.0, 'filled_at': datetime.utcnow()}},
+            session=session
+        )
+        return True
+
+    def revert_fill(self, order_id, amount_kg_co2):
+        """Standalone-server rollback of apply_fill"""
+        self.collection.update_one(
+            {'_id': order_id},
+            {
+                '$inc': {'remaining_kg': amount_kg_co2, 'filled_kg': -amount_kg_co2},
+                '$set': {'status': 'open'},
+                '$unset': {'filled_at': ''}
+            }
+        )
+
+    def drop_unpaid_fill(self, order_id, amount_kg_co2, now, session=None):
+        """
+        Take a cancelled (unpaid) fill back off an order
+
+        The buyer defaulted on the fill, so the order is closed rather than
+        left resting with the amount added back.
+        """
+        closing = {'$in': ['$status', ['open', 'filled']]}
+        self.collection.update_one(
+            {'_id': order_id},
+            [{'$set': {
+                'filled_kg': {'$subtract': ['$filled_kg', amount_kg_co2]},
+                'status': {'$cond': [closing, 'cancelled', '$status']},
+                'cancelled_at': {'$cond': [closing, now, {'$ifNull': ['$cancelled_at', '$$REMOVE']}]},
+                'cancel_reason': {'$cond': [closing, 'unpaid_fill', {'$ifNull': ['$cancel_reason', '$$REMOVE']}]}
+            }}],
+            session=session
+        )
+
+    def cancel_order(self, order_id, user_id=None):
+        """
+        Cancel what is left of an open order
+
+        Args:
+            order_id: Order ID
+            user_id: If given, the order must belong to this user
+
+        Returns:
+            Cancelled order document
+        """
+        query = {'_id': ObjectId(order_id), 'status': 'open'}
+        if user_id is not None:
+            query['user_id'] = user_id
+
+        order = self.collection.find_one_and_update(
+            query,
+            {'$set': {'status': 'cancelled', 'cancelled_at': datetime.utcnow()}},
+            return_document=True
+        )
+        if not order:
+            raise ValueError('Order not found, unauthorized or no longer open')
+        return order
+
+    def format_order(self, order):
+        """Format order for API response"""
+        if not order:
+            return None
+
+        return {
+            'order_id': str(order['_id']),
+            'side': order['side'],
+            'user_id': order['user_id'],
+            'credit_type': order['credit_type'],
+            'price_per_kg': order['price_per_kg'],
+            'amount_kg_co2': order['amount_kg_co2'],
+            'remaining_kg': order['remaining_kg'],
+            'filled_kg': order.get('filled_kg', 0.0),
+            'status': order['status'],
+            'created_at': order['created_at'].isoformat(),
+            'filled_at': order.get('filled_at').isoformat() if order.get('filled_at') else None,
+            'cancelled_at': order.get('cancelled_at').isoformat() if order.get('cancelled_at') else None
+        }
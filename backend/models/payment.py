@@ -1,57 +1,77 @@
 from bson import ObjectId
-from datetime import datetime
+from pymongo import ReturnDocument
+from datetime import datetime, timedelta
 import secrets
+from config import Config
+from utils.indexes import ensure_index
+
+# Legacy payments embed their QR code as a data URI; lists never return it
+LIST_PROJECTION = {'qr_code': 0}
 
 class Payment:
     """Model for payment transactions"""
     
     def __init__(self, db):
         self.collection = db.payments
+        ensure_index(self.collection, [('listing_id', 1), ('status', 1)])
+        ensure_index(self.collection, [('buyer_id', 1), ('status', 1), ('created_at', -1)])
+        ensure_index(self.collection, [('settlement_status', 1), ('paid_at', 1)])
+        ensure_index(self.collection, 'pay_by', name='unpaid_fills_by_deadline',
+                     partialFilterExpression={'status': 'pending', 'pay_by': {'$exists': True}})
     
-    def create_payment(self, buyer_id, listing_id, amount_kg_co2, total_amount, payment_method):
+    def create_payment(self, buyer_id, listing_id, amount_kg_co2, total_amount, payment_method,
+                       order_id=None, session=None):
         """
         Create a new payment transaction
         
         Args:
-            buyer_id: User making the purchase
-            listing_id: Marketplace listing ID
+            buyer_id: User making the purchase (stored as an ObjectId)
+            listing_id: Marketplace listing ID (stored as an ObjectId)
             amount_kg_co2: Amount of credits being purchased
             total_amount: Total payment amount
-            payment_method: Payment method (upi/qr/card)
+            payment_method: Payment method (upi/qr/card/order_book)
+            order_id: Buy order ID for order book fills (the listing
+                amount was already taken when the orders matched; the
+                fill must be paid for by 'pay_by' or it is cancelled)
+            session: Optional transaction session
         
         Returns:
             Payment document with transaction ID
         """
         transaction_id = f"TXN{secrets.token_hex(8).upper()}"
+        now = datetime.utcnow()
         
         payment = {
             'transaction_id': transaction_id,
-            'buyer_id': buyer_id,
-            'listing_id': listing_id,
+            'buyer_id': ObjectId(buyer_id),
+            'listing_id': ObjectId(listing_id),
             'amount_kg_co2': float(amount_kg_co2),
             'total_amount': float(total_amount),
             'payment_method': payment_method,
             'status': 'pending',
-            'created_at': datetime.utcnow(),
+            'created_at': now,
             'upi_id': None,
-            'qr_code': None,
-            'payment_link': None
+            'qr_code_id': None,
+            'payment_link': None,
+            'order_id': order_id
         }
+        if order_id is not None:
+            payment['pay_by'] = now + timedelta(seconds=Config.ORDER_BOOK_PAYMENT_WINDOW_SECONDS)
         
-        result = self.collection.insert_one(payment)
+        result = self.collection.insert_one(payment, session=session)
         payment['_id'] = result.inserted_id
         
-        return self._format_payment(payment)
+        return self.format_payment(payment)
     
     def get_payment_by_id(self, payment_id):
         """Get payment by ID"""
         payment = self.collection.find_one({'_id': ObjectId(payment_id)})
-        return self._format_payment(payment) if payment else None
+        return self.format_payment(payment) if payment else None
     
     def get_payment_by_transaction_id(self, transaction_id):
         """Get payment by transaction ID"""
         payment = self.collection.find_one({'transaction_id': transaction_id})
-        return self._format_payment(payment) if payment else None
+        return self.format_payment(payment) if payment else None
     
     def update_payment_status(self, payment_id, status, payment_details=None):
         """
@@ -82,22 +102,100 @@ class Payment:
         
         return self.get_payment_by_id(payment_id)
     
+    def queue_settlement(self, payment_id, payment_reference=None):
+        """
+        Mark a pending payment as paid and queue it for settlement
+        
+        Returns:
+            Payment document, or None if it isn't pending or already queued
+        """
+        update = {'settlement_status': 'queued', 'paid_at': datetime.utcnow()}
+        if payment_reference:
+            update['payment_reference'] = payment_reference
+        
+        return self.collection.find_one_and_update(
+            {'_id': ObjectId(payment_id), 'status': 'pending', 'settlement_status': None},
+            {'$set': update},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    def get_unpaid_fills(self, now, limit):
+        """Order book fills past their payment deadline and not paid, oldest deadline first"""
+        return list(self.collection.find(
+            {'status': 'pending', 'pay_by': {'$lt': now}, 'settlement_status': None},
+            {'listing_id': 1, 'order_id': 1, 'amount_kg_co2': 1, 'pay_by': 1}
+        ).sort('pay_by', 1).limit(limit))
+    
+    def cancel_unpaid(self, payment_oid, now, session=None):
+        """
+        Cancel an order book fill that wasn't paid for by its deadline
+        
+        Conditional on the payment still being unpaid, so a payment
+        arriving at the same moment either queues it or finds it cancelled.
+        
+        Returns:
+            The cancelled payment, or None if it was paid meanwhile
+        """
+        return self.collection.find_one_and_update(
+            {'_id': payment_oid, 'status': 'pending', 'pay_by': {'$lt': now}, 'settlement_status': None},
+            {'$set': {'status': 'cancelled', 'cancelled_at': now}},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+    
     def get_user_payments(self, user_id, status=None):
         """Get all payments by a user"""
-        query = {'buyer_id': user_id}
+        query = {'buyer_id': self.id_match(user_id)}
         if status:
             query['status'] = status
         
-        payments = list(self.collection.find(query).sort('created_at', -1))
-        return [self._format_payment(p) for p in payments]
+        payments = list(self.collection.find(query, LIST_PROJECTION).sort('created_at', -1))
+        return [self.format_payment(p) for p in payments]
+    
+    def get_unsettled_matched_kg(self, listing_id):
+        """Amount of a listing matched by buy orders but not yet paid for"""
+        totals = list(self.collection.aggregate([
+            {'$match': {'listing_id': self.id_match(listing_id), 'status': 'pending', 'order_id': {'$ne': None}}},
+            {'$group': {'_id': None, 'amount_kg_co2': {'$sum': '$amount_kg_co2'}}}
+        ]))
+        return totals[0]['amount_kg_co2'] if totals else 0
+    
+    def get_unsettled_matched_kg_by_listing(self, listing_ids):
+        """get_unsettled_matched_kg for many listings in one aggregation, by listing id string"""
+        totals = self.collection.aggregate([
+            {'$match': {'listing_id': self.ids_match(listing_ids), 'status': 'pending', 'order_id': {'$ne': None}}},
+            {'$group': {'_id': '$listing_id', 'amount_kg_co2': {'$sum': '$amount_kg_co2'}}}
+        ])
+        matched = {}
+        for row in totals:
+            # Old string ids and ObjectIds of the same listing group apart
+            listing_id = str(row['_id'])
+            matched[listing_id] = matched.get(listing_id, 0) + row['amount_kg_co2']
+        return matched
+    
+    @staticmethod
+    def id_match(value):
+        """
+        Filter on a payment's buyer_id or listing_id
+        
+        Both are stored as ObjectIds; payments created before that keep
+        the string form until migrate_seller_ids.py has run.
+        """
+        return {'$in': [ObjectId(value), str(value)]}
+    
+    @staticmethod
+    def ids_match(values):
+        """id_match for several ids"""
+        values = list(values)
+        return {'$in': [ObjectId(value) for value in values] + [str(value) for value in values]}
     
-    def add_payment_details(self, payment_id, upi_id=None, qr_code=None, payment_link=None):
-        """Add payment details (UPI ID, QR code, etc.)"""
+    def add_payment_details(self, payment_id, upi_id=None, qr_code_id=None, payment_link=None):
+        """Add payment details (UPI ID, QR code image digest, etc.)"""
         update = {}
         if upi_id:
             update['upi_id'] = upi_id
-        if qr_code:
-            update['qr_code'] = qr_code
+        if qr_code_id:
+            update['qr_code_id'] = qr_code_id
         if payment_link:
             update['payment_link'] = payment_link
         
@@ -113,13 +211,13 @@ class Payment:
         """
         Get all payments (for admin)
         """
-        payments = list(self.collection.find()
+        payments = list(self.collection.find({}, LIST_PROJECTION)
                        .sort('created_at', -1)
                        .skip(offset)
                        .limit(limit))
-        return [self._format_payment(p) for p in payments]
+        return [self.format_payment(p) for p in payments]
 
-    def _format_payment(self, payment):
+    def format_payment(self, payment):
         """Format payment for API response"""
         if not payment:
             return None
@@ -127,8 +225,8 @@ class Payment:
         return {
             'payment_id': str(payment['_id']),
             'transaction_id': payment['transaction_id'],
-            'buyer_id': payment['buyer_id'],
-            'listing_id': payment['listing_id'],
+            'buyer_id': str(payment['buyer_id']),
+            'listing_id': str(payment['listing_id']),
             'amount_kg_co2': payment['amount_kg_co2'],
             'total_amount': payment['total_amount'],
             'payment_method': payment['payment_method'],
@@ -136,7 +234,13 @@ class Payment:
             'created_at': payment['created_at'].isoformat(),
             'completed_at': payment.get('completed_at').isoformat() if payment.get('completed_at') else None,
             'failed_at': payment.get('failed_at').isoformat() if payment.get('failed_at') else None,
+            'cancelled_at': payment.get('cancelled_at').isoformat() if payment.get('cancelled_at') else None,
+            'pay_by': payment.get('pay_by').isoformat() if payment.get('pay_by') else None,
             'upi_id': payment.get('upi_id'),
+            'qr_code_url': f"/api/marketplace/qr/{payment['qr_code_id']}.png" if payment.get('qr_code_id') else None,
             'qr_code': payment.get('qr_code'),
-            'payment_link': payment.get('payment_link')
+            'payment_link': payment.get('payment_link'),
+            'order_id': payment.get('order_id'),
+            'settlement_status': payment.get('settlement_status'),
+            'settlement_error': payment.get('settlement_error')
         }
@@ -0,0 +1,53 @@
+import hashlib
+from datetime import datetime
+from bson import Binary
+from pymongo.errors import DuplicateKeyError
+from utils.indexes import ensure_index
+
+def qr_digest(payload):
+    """Content key of a QR payload (sha256 hex)"""
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class QRCodeImage:
+    """
+    Model for rendered QR code images
+
+    Images are stored once per payload, keyed by the payload's sha256, and
+    referenced from payments by URL. A document is registered with its
+    payload before the PNG is rendered so a lost render can be redone.
+    """
+
+    def __init__(self, db, retention_days=30):
+        self.collection = db.qr_codes
+        ensure_index(self.collection, [('created_at', 1)],
+                     name='qr_codes_ttl', expireAfterSeconds=retention_days * 86400)
+
+    def register(self, payload):
+        """
+        Register a payload to be rendered
+
+        Returns:
+            (digest, created) - created is False if the payload was already known
+        """
+        digest = qr_digest(payload)
+        try:
+            self.collection.insert_one({
+                '_id': digest,
+                'payload': payload,
+                'image': None,
+                'created_at': datetime.utcnow()
+            })
+            return digest, True
+        except DuplicateKeyError:
+            return digest, False
+
+    def get(self, digest):
+        """Get a QR document (payload and PNG bytes, if rendered) or None"""
+        return self.collection.find_one({'_id': digest})
+
+    def store_image(self, digest, png):
+        """Attach rendered PNG bytes to a registered payload"""
+        self.collection.update_one(
+            {'_id': digest},
+            {'$set': {'image': Binary(png), 'rendered_at': datetime.utcnow()}}
+        )
@@ -0,0 +1,249 @@
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from services.carbon_limit_service import CarbonLimitService
+from utils.indexes import ensure_index
+
+class StatusSnapshot:
+    """
+    Materialized per-user carbon status (read model)
+
+    Holds the inputs of the status computation (household, YTD emission
+    totals, active credits) and the derived status. Write paths apply
+    deltas with $inc and bump 'version'; the derived block is then
+    refreshed under an optimistic version check, so /api/emissions/status
+    is a single primary-key read.
+    """
+
+    MAX_REBUILD_ATTEMPTS = 3
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.status_snapshots
+        ensure_index(self.collection, 'updated_at')
+
+    def _service(self):
+        from models.user import User
+        from models.emission import Emission
+        from models.credit import Credit
+        return CarbonLimitService(User(self.db), Emission(self.db), Credit(self.db))
+
+    def get_status(self, user_id):
+        """
+        Get the user's status from the snapshot, building it if missing
+        or stale (new year, credit lot expired)
+
+        Returns:
+            (status dict, version) or (None, None) if the user doesn't exist
+        """
+        snapshot = self.collection.find_one({'_id': ObjectId(user_id)})
+
+        if snapshot is None or self._is_stale(snapshot):
+            snapshot = self.rebuild(user_id)
+            if snapshot is None:
+                return None, None
+
+        status = snapshot.get('status')
+        if status is None or snapshot.get('status_version') != snapshot['version']:
+            # Derived block lags the inputs (bulk update, or writer died
+            # mid-refresh): derive and store it unless a newer delta landed
+            status = self._derive(snapshot)
+            self.collection.update_one(
+                {'_id': snapshot['_id'], 'version': snapshot['version']},
+                {'$set': {'status': status, 'status_version': snapshot['version']}}
+            )
+
+        return status, snapshot['version']
+
+    def _is_stale(self, snapshot):
+        now = datetime.utcnow()
+        if snapshot.get('year') != now.year:
+            return True
+        next_expiry = snapshot.get('next_credit_expiry')
+        return next_expiry is not None and next_expiry < now
+
+    def rebuild(self, user_id):
+        """
+        Recompute the snapshot from the source collections
+
+        Reads the current version first, then the sources, and only writes
+        if no delta landed in between; otherwise retries.
+
+        Returns:
+            Snapshot document or None if the user doesn't exist
+        """
+        user_oid = ObjectId(user_id)
+        service = self._service()
+
+        for _ in range(self.MAX_REBUILD_ATTEMPTS):
+            current = self.collection.find_one({'_id': user_oid}, {'version': 1})
+            inputs = service._fetch_status_inputs(user_id)
+            if inputs is None:
+                return None
+
+            version = (current['version'] if current else 0) + 1
+            snapshot = {
+                'year': datetime.utcnow().year,
+                'household': {
+                    'area_sqm': inputs['household'].get('area_sqm', 0),
+                    'occupants': inputs['household'].get('occupants', 0)
+                },
+                'emissions': inputs['emissions'],
+                'active_credits_kg': inputs['active_credits_kg'],
+                'version': version,
+                'status_version': version,
+                'updated_at': datetime.utcnow()
+            }
+            snapshot['status'] = self._derive(snapshot, service)
+
+            # Missing (not null) so that a later purchase's $min can set it
+            update = {'$set': snapshot}
+            if inputs['next_credit_expiry']:
+                snapshot['next_credit_expiry'] = inputs['next_credit_expiry']
+            else:
+                update['$unset'] = {'next_credit_expiry': ''}
+
+            if current:
+                result = self.collection.update_one(
+                    {'_id': user_oid, 'version': current['version']},
+                    update
+                )
+                if result.matched_count:
+                    return {'_id': user_oid, **snapshot}
+            else:
+                try:
+                    self.collection.insert_one({'_id': user_oid, **snapshot})
+                    return {'_id': user_oid, **snapshot}
+                except DuplicateKeyError:
+                    pass
+
+        # Heavy write contention: serve the freshest stored state
+        return self.collection.find_one({'_id': user_oid})
+
+    def record_emission(self, user_id, electricity_co2_kg, combustion_co2_kg, timestamp=None, session=None):
+        """
+        Apply a new emission reading to the snapshot
+
+        Pass the session the reading was inserted in, so a concurrent
+        rebuild sees both or neither.
+        """
+        if timestamp is not None and timestamp.year != datetime.utcnow().year:
+            return
+        self._apply({
+            'emissions.total_co2_kg': electricity_co2_kg + combustion_co2_kg,
+            'emissions.electricity_co2_kg': electricity_co2_kg,
+            'emissions.combustion_co2_kg': combustion_co2_kg
+        }, user_id, session=session)
+
+    def record_credits(self, user_id, amount_kg_co2, next_expiry=None, session=None):
+        """
+        Apply a change in active credits (negative for deductions)
+
+        Pass the session the lots were written in, so a concurrent
+        rebuild sees both or neither.
+
+        Args:
+            next_expiry: Earliest expiry of the user's active lots after
+                the change (None if there are none left)
+        """
+        self._apply({'active_credits_kg': amount_kg_co2}, user_id, self._expiry_update(next_expiry), session)
+
+    def record_credit_changes(self, changes, session=None):
+        """
+        Apply credit changes of many users in one bulk_write
+        
+        Only the inputs are updated; the derived status lags the version
+        and is refreshed on the next read.
+        
+        Args:
+            changes: {user ObjectId: (kg change, next expiry or None)}
+            session: Transaction the lots were written in
+        """
+        year = datetime.utcnow().year
+        operations = []
+        for user_oid, (change, next_expiry) in changes.items():
+            update = {
+                '$inc': {'active_credits_kg': change, 'version': 1},
+                '$currentDate': {'updated_at': True},
+                **self._expiry_update(next_expiry)
+            }
+            operations.append(UpdateOne({'_id': user_oid, 'year': year}, update))
+        
+        if operations:
+            self.collection.bulk_write(operations, ordered=False, session=session)
+
+    @staticmethod
+    def _expiry_update(next_expiry):
+        if next_expiry:
+            return {'$set': {'next_credit_expiry': next_expiry}}
+        return {'$unset': {'next_credit_expiry': ''}}
+    
+    def record_household(self, user_id, area_sqm, occupants):
+        """Apply a household profile change"""
+        self._apply({}, user_id, {'$set': {
+            'household.area_sqm': area_sqm,
+            'household.occupants': occupants
+        }})
+
+    def _apply(self, increments, user_id, extra=None, session=None):
+        """
+        Apply a delta and refresh the derived status
+
+        Snapshots that don't exist yet (or belong to last year) are left
+        alone; they are built from the sources on the next read.
+        """
+        update = {
+            '$inc': {**increments, 'version': 1},
+            '$currentDate': {'updated_at': True}
+        }
+        if extra:
+            update.update(extra)
+
+        snapshot = self.collection.find_one_and_update(
+            {'_id': ObjectId(user_id), 'year': datetime.utcnow().year},
+            update,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if snapshot is None:
+            return
+
+        # Only the writer holding the latest version gets to set 'status'
+        self.collection.update_one(
+            {'_id': snapshot['_id'], 'version': snapshot['version']},
+            {'$set': {
+                'status': self._derive(snapshot),
+                'status_version': snapshot['version']
+            }},
+            session=session
+        )
+
+    def _derive(self, snapshot, service=None):
+        service = service or CarbonLimitService(None, None, None)
+        emissions = snapshot['emissions']
+        return service.build_status(
+            snapshot['household'],
+            {k: round(v, 2) for k, v in emissions.items()},
+            round(snapshot['active_credits_kg'], 2)
+        )
+
+    def reconcile(self, batch_size=500):
+        """
+        Rebuild the least recently updated snapshots from the sources
+
+        Catches drift from writes that bypassed the delta hooks and
+        credit lots that expired without a write.
+
+        Returns:
+            Number of snapshots rebuilt
+        """
+        stale = self.collection.find({}, {'_id': 1}).sort('updated_at', 1).limit(batch_size)
+        rebuilt = 0
+        for snapshot in list(stale):
+            if self.rebuild(snapshot['_id']) is not None:
+                rebuilt += 1
+            else:
+                # User no longer exists
+                self.collection.delete_one({'_id': snapshot['_id']})
+        return rebuilt
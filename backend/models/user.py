@@ -1,7 +1,10 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from datetime import datetime
 import bcrypt
-from config import Config
+from services.forecast_cache import forecast_cache
+from utils.indexes import ensure_index
+from models.status_snapshot import StatusSnapshot
+from services.carbon_limit_service import CarbonLimitService
 
 class User:
     """User model for authentication and household management"""
@@ -9,7 +12,7 @@ class User:
     def __init__(self, db):
         self.collection = db.users
         # Create indexes
-        self.collection.create_index('email', unique=True)
+        ensure_index(self.collection, 'email', unique=True)
     
     def create_user(self, email, password, household_data):
         """
@@ -65,6 +68,22 @@ class User:
         from bson import ObjectId
         return self.collection.find_one({'_id': ObjectId(user_id)})
     
+    def get_users_by_ids(self, user_ids, projection=None):
+        """
+        Get many users with one $in query
+        
+        Returns:
+            {user id string: user}
+        """
+        from bson import ObjectId
+        oids = list({ObjectId(user_id) for user_id in user_ids})
+        if not oids:
+            return {}
+        return {
+            str(user['_id']): user
+            for user in self.collection.find({'_id': {'$in': oids}}, projection)
+        }
+    
     def get_user_by_email(self, email):
         """Get user by email"""
         return self.collection.find_one({'email': email})
@@ -75,24 +94,31 @@ class User:
         
         annual_limit = self._calculate_carbon_limit(area_sqm, occupants)
         
-        self.collection.update_one(
+        # Keep the limit bought through the marketplace on top of the formula
+        user = self.collection.find_one_and_update(
             {'_id': ObjectId(user_id)},
-            {'$set': {
+            [{'$set': {
                 'household.area_sqm': area_sqm,
                 'household.occupants': occupants,
-                'household.annual_carbon_limit_kg': annual_limit
-            }}
+                'household.updated_at': datetime.utcnow(),
+                'household.annual_carbon_limit_kg': {'$add': [
+                    annual_limit,
+                    {'$ifNull': ['$household.purchased_limit_kg', 0]}
+                ]}
+            }}],
+            return_document=ReturnDocument.AFTER
         )
+        forecast_cache.invalidate(user_id)
+        StatusSnapshot(self.collection.database).record_household(user_id, area_sqm, occupants)
         
-        return annual_limit
+        return user['household']['annual_carbon_limit_kg'] if user else annual_limit
     
     def _calculate_carbon_limit(self, area_sqm, occupants):
         """
         Calculate annual carbon limit based on household size
         Formula: (area * base_per_sqm) + (occupants * per_occupant)
         """
-        return (area_sqm * Config.CARBON_LIMIT_BASE_PER_SQM) + \
-               (occupants * Config.CARBON_LIMIT_PER_OCCUPANT)
+        return CarbonLimitService.calculate_annual_limit(area_sqm, occupants)
 
     def increase_carbon_limit(self, user_id, amount_kg):
         """Increase user's carbon limit by purchasing credits"""
@@ -100,6 +126,10 @@ class User:
         
         self.collection.update_one(
             {'_id': ObjectId(user_id)},
-            {'$inc': {'household.annual_carbon_limit_kg': amount_kg}}
+            {'$inc': {
+                'household.annual_carbon_limit_kg': amount_kg,
+                'household.purchased_limit_kg': amount_kg
+            }}
         )
+        forecast_cache.invalidate(user_id)
 
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Rebuild the OHLCV candles from completed marketplace payments
+
+Candles are normally kept up to date by the settlement engine; run this
+once to backfill trades settled before candles existed, or to repair
+the series. Existing candles are dropped first.
+
+Usage:
+    python rebuild_candles.py
+    python rebuild_candles.py --batch 5000
+"""
+
+import argparse
+from bson import ObjectId
+from pymongo import MongoClient
+from config import Config
+from models.candle import Candle
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild OHLCV candles from completed payments')
+    parser.add_argument('--batch', type=int, default=2000, help='Payments folded per bulk write')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    db = client.get_database()
+    candle_model = Candle(db)
+    candle_model.collection.delete_many({})
+
+    payments = db.payments.find(
+        {'status': 'completed', 'amount_kg_co2': {'$gt': 0}},
+        {'listing_id': 1, 'amount_kg_co2': 1, 'total_amount': 1, 'completed_at': 1}
+    ).sort('completed_at', 1)
+
+    credit_types = {}
+    recorded = 0
+    batch = []
+
+    def flush():
+        nonlocal recorded
+        missing = {str(p['listing_id']) for p in batch} - set(credit_types)
+        for listing in db.marketplace_listings.find(
+            {'_id': {'$in': [ObjectId(l) for l in missing]}}, {'credit_type': 1}
+        ):
+            credit_types[str(listing['_id'])] = listing['credit_type']
+
+        trades = [
+            (credit_types[str(p['listing_id'])], p['total_amount'] / p['amount_kg_co2'], p['amount_kg_co2'], p['completed_at'])
+            for p in batch if str(p['listing_id']) in credit_types and p.get('completed_at')
+        ]
+        candle_model.record(Candle.aggregate(trades))
+        recorded += len(trades)
+        batch.clear()
+
+    for payment in payments:
+        batch.append(payment)
+        if len(batch) >= args.batch:
+            flush()
+    if batch:
+        flush()
+
+    print(f"Trades recorded: {recorded}, candles stored: {candle_model.collection.count_documents({})}")
+
+if __name__ == "__main__":
+    main()
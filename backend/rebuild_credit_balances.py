@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Rebuild per-user credit balances from the credit transaction ledger
+(and reserved amounts from the held credit reservations)
+
+Usage:
+    python rebuild_credit_balances.py              # rebuild all balances
+    python rebuild_credit_balances.py --backfill   # first write opening entries for pre-ledger lots
+    python rebuild_credit_balances.py --dry-run    # report drift only
+"""
+
+import argparse
+from pymongo import MongoClient
+from config import Config
+from models.credit import Credit, BALANCE_EPSILON
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild credit balances from the ledger')
+    parser.add_argument('--backfill', action='store_true', help='Write opening ledger entries for users without any')
+    parser.add_argument('--dry-run', action='store_true', help='Only report balances that differ from the ledger')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    credit_model = Credit(client.get_database())
+
+    if args.backfill:
+        backfilled = 0
+        for user_id in credit_model.collection.distinct('user_id', {'status': 'active'}):
+            backfilled += credit_model.backfill_ledger(user_id)
+        print(f"Opening entries written: {backfilled}")
+
+    ledger = {
+        row['_id']: row['available_kg']
+        for row in credit_model.transactions.aggregate([
+            {'$group': {'_id': '$user_id', 'available_kg': {'$sum': '$amount_kg_co2'}}}
+        ], allowDiskUse=True)
+    }
+    reserved = {
+        row['_id']: row['reserved_kg']
+        for row in credit_model.reservations.aggregate([
+            {'$match': {'status': 'pending'}},
+            {'$group': {'_id': '$user_id', 'reserved_kg': {'$sum': '$amount_kg_co2'}}}
+        ])
+    }
+    stored = {}
+    stored_reserved = {}
+    for doc in credit_model.balances.find({}, {'available_kg': 1, 'reserved_kg': 1}):
+        stored[doc['_id']] = doc['available_kg']
+        stored_reserved[doc['_id']] = doc.get('reserved_kg', 0)
+
+    drifted = [
+        user_id for user_id in set(ledger) | set(stored) | set(reserved)
+        if abs(ledger.get(user_id, 0) - stored.get(user_id, 0)) > BALANCE_EPSILON
+        or abs(reserved.get(user_id, 0) - stored_reserved.get(user_id, 0)) > BALANCE_EPSILON
+    ]
+    print(f"Users in ledger: {len(ledger)}, balances stored: {len(stored)}, drifted: {len(drifted)}")
+
+    if args.dry_run:
+        for user_id in drifted[:20]:
+            print(f"  {user_id}: stored {stored.get(user_id, 0):.2f}, ledger {ledger.get(user_id, 0):.2f}, "
+                  f"reserved stored {stored_reserved.get(user_id, 0):.2f}, held {reserved.get(user_id, 0):.2f}")
+        return
+
+    # Missing balances are rebuilt too (drift against 0)
+    for user_id in drifted:
+        credit_model.rebuild_balance(user_id)
+    print(f"✅ Rebuilt {len(drifted)} balances")
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,17 @@ from models.admin import Admin
 from models.company import Company
 from models.payment import Payment
 from models.marketplace_listing import MarketplaceListing
+from models.emission import Emission
+from services.pooled_predictor import PooledPredictor
+from services.breach_scanner import BreachRiskScanner
+from services.fleet_recalculator import FleetRecalculator
+from services.credit_expiry_sweeper import CreditExpirySweeper
+from services.listing_expiry_sweeper import ListingExpirySweeper
+from services import background_tasks
+from services.training_jobs import training_jobs, TrainingQueueFull
+from routes.predictions import submit_pooled_training, POOLED_TRAINING_KEY
 from functools import wraps
+import threading
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -149,3 +159,119 @@ def get_stats():
         return jsonify({'success': True, 'stats': stats})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/forecast/pooled', methods=['GET'])
+@admin_required()
+def get_pooled_model():
+    """Get pooled forecast model details"""
+    try:
+        predictor = PooledPredictor(Emission(db))
+        return jsonify({'success': True, 'model': predictor.explain_model()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/forecast/pooled/train', methods=['POST'])
+@admin_required()
+def train_pooled_model():
+    """Queue a retrain of the pooled forecast model"""
+    try:
+        job, created = submit_pooled_training()
+        return jsonify({'success': True, 'job': job, 'deduplicated': not created}), 202
+    except TrainingQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/forecast/pooled/jobs/<job_id>', methods=['GET'])
+@admin_required()
+def get_pooled_training_job(job_id):
+    """Get status of a pooled model training job"""
+    job = training_jobs.get_job(job_id)
+    if not job or job['user_id'] != POOLED_TRAINING_KEY:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@admin_bp.route('/breach-risk', methods=['GET'])
+@admin_required()
+def get_breach_risk():
+    """Get the latest ranked list of households projected to breach"""
+    try:
+        limit = int(request.args.get('limit', 50))
+        offset = int(request.args.get('offset', 0))
+        
+        result = BreachRiskScanner(db).get_latest(limit, offset)
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/breach-risk/scan', methods=['POST'])
+@admin_required()
+def run_breach_scan():
+    """Run a breach-risk scan now"""
+    try:
+        summary = BreachRiskScanner(db).scan()
+        return jsonify({'success': True, 'scan': summary})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/recalculate', methods=['POST'])
+@admin_required()
+def start_recalculation():
+    """Recompute stored limits and statuses for all users in the background"""
+    try:
+        recalculator = FleetRecalculator(db)
+        recalculator.request_run('admin')
+        
+        task = background_tasks.get_task('fleet_recalc')
+        if task:
+            task.wake()
+        else:
+            # Schedule disabled: run on a one-off thread
+            threading.Thread(target=recalculator.run_if_needed, daemon=True).start()
+        
+        return jsonify({'success': True, **recalculator.get_progress()}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/recalculate', methods=['GET'])
+@admin_required()
+def get_recalculation_progress():
+    """Get progress of the latest fleet recalculation"""
+    try:
+        return jsonify({'success': True, **FleetRecalculator(db).get_progress()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/credit-expiry', methods=['GET'])
+@admin_required()
+def get_credit_expiry_sweeps():
+    """Get metrics of recent credit expiry sweeps"""
+    try:
+        limit = int(request.args.get('limit', 20))
+        return jsonify({'success': True, 'sweeps': CreditExpirySweeper(db).get_recent(limit)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/credit-expiry/sweep', methods=['POST'])
+@admin_required()
+def run_credit_expiry_sweep():
+    """Run a credit expiry sweep now"""
+    try:
+        return jsonify({'success': True, 'sweep': CreditExpirySweeper(db).sweep()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/listing-expiry/sweep', methods=['POST'])
+@admin_required()
+def run_listing_expiry_sweep():
+    """Run a marketplace listing expiry sweep now"""
+    try:
+        return jsonify({'success': True, 'sweep': ListingExpirySweeper(db).sweep()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_bp.route('/tasks', methods=['GET'])
+@admin_required()
+def get_background_tasks():
+    """Get status of scheduled background jobs"""
+    return jsonify({'success': True, 'tasks': background_tasks.get_status()})
@@ -63,17 +63,28 @@ def purchase_credits():
 @credits_bp.route('/active', methods=['GET'])
 @jwt_required()
 def get_active_credits():
-    """Get user's active credits"""
+    """
+    Get user's active credits
+    
+    Query params: offset, limit (page of lot details; totals per type
+    always cover every active lot)
+    """
     try:
         user_id = get_jwt_identity()
+        offset = int(request.args.get('offset', 0))
+        limit = request.args.get('limit')
         
         credit_model = Credit(db)
         credit_service = CreditService(credit_model)
         
-        summary = credit_service.get_credit_summary(user_id)
+        summary = credit_service.get_credit_summary(
+            user_id, offset, int(limit) if limit is not None else None
+        )
         
         return jsonify(summary), 200
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -2,8 +2,10 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models.emission import Emission
 from models.user import User
-from models.credit import Credit
+from models.status_snapshot import StatusSnapshot
 from services.carbon_limit_service import CarbonLimitService
+from services.cohort_stats import CohortStats
+import time
 
 emissions_bp = Blueprint('emissions', __name__)
 
@@ -77,17 +79,17 @@ def get_emission_status():
     try:
         user_id = get_jwt_identity()
         
-        # Initialize services
-        user_model = User(db)
-        emission_model = Emission(db)
-        credit_model = Credit(db)
-        
-        carbon_service = CarbonLimitService(user_model, emission_model, credit_model)
-        status = carbon_service.get_user_status(user_id)
+        # Single primary-key read of the materialized status
+        started = time.perf_counter()
+        status, version = StatusSnapshot(db).get_status(user_id)
+        fetched = time.perf_counter()
         
         if not status:
             return jsonify({'error': 'User not found'}), 404
         
+        carbon_service = CarbonLimitService(None, None, None)
+        status['snapshot_version'] = version
+        
         # Add status message and color
         status['status_message'] = carbon_service.get_status_message(
             status['status'], 
@@ -100,14 +102,51 @@ def get_emission_status():
             recommendations = carbon_service.calculate_required_credits(status['excess_co2_kg'])
             status['credit_recommendations'] = recommendations
             
-        # Add smart tips
+        # Add smart tips (peer tips are served by /peers to keep this a single read)
         status['tips'] = carbon_service.get_sustainability_tips(
             status['status'],
             status['electricity_co2_kg'],
             status['combustion_co2_kg']
         )
         
-        return jsonify(status), 200
+        # Expose per-stage latency
+        finished = time.perf_counter()
+        timings = {
+            'db_ms': round((fetched - started) * 1000, 2),
+            'compute_ms': round((finished - fetched) * 1000, 2),
+            'total_ms': round((finished - started) * 1000, 2)
+        }
+        status['latency_breakdown_ms'] = timings
+        response = jsonify(status)
+        response.headers['Server-Timing'] = ', '.join(
+            f"{stage.replace('_ms', '')};dur={ms}" for stage, ms in timings.items()
+        )
+        
+        return response, 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@emissions_bp.route('/peers', methods=['GET'])
+@jwt_required()
+def get_peer_comparison():
+    """Compare emissions per occupant and per m² with similar households"""
+    try:
+        user_id = get_jwt_identity()
+        user = User(db).get_user_by_id(user_id)
+        
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+        
+        comparison = CohortStats(db).compare(user_id, user.get('household', {}))
+        if not comparison:
+            return jsonify({
+                'success': False,
+                'message': 'Not enough data to compare with similar households yet'
+            }), 200
+        
+        comparison['tips'] = CarbonLimitService(None, None, None).get_peer_tips(comparison)
+        return jsonify({'success': True, **comparison}), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,73 @@
+from flask import Blueprint, request, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from models.user import User
+from models.status_snapshot import StatusSnapshot
+from services.leaderboard import leaderboard
+from services import cohorts
+
+leaderboard_bp = Blueprint('leaderboard', __name__)
+
+db = None
+
+def init_leaderboard(database):
+    global db
+    db = database
+
+@leaderboard_bp.route('', methods=['GET'])
+@jwt_required()
+def get_leaderboard():
+    """
+    Get the lowest-usage households
+    
+    Query params:
+        cohort: 'all' (default), 'mine', or a household size band label
+        limit: Number of entries (default 10)
+    """
+    try:
+        cohort = request.args.get('cohort', cohorts.ALL)
+        limit = int(request.args.get('limit', 10))
+        
+        if cohort == 'mine':
+            user = User(db).get_user_by_id(get_jwt_identity())
+            if not user:
+                return jsonify({'error': 'User not found'}), 404
+            cohort = cohorts.cohort_for(user.get('household', {}))
+        
+        result = leaderboard.get_top(db, cohort, limit)
+        return jsonify({'success': True, **result}), 200
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@leaderboard_bp.route('/me', methods=['GET'])
+@jwt_required()
+def get_my_rank():
+    """Get the user's rank and percentile in their cohort and overall"""
+    try:
+        user_id = get_jwt_identity()
+        user = User(db).get_user_by_id(user_id)
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+        
+        # Current usage from the status snapshot, ranked against the last refresh
+        status, _ = StatusSnapshot(db).get_status(user_id)
+        if not status:
+            return jsonify({'error': 'User not found'}), 404
+        
+        result = leaderboard.get_rank(db, user.get('household', {}), status['percentage_used'])
+        return jsonify({'success': True, **result}), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@leaderboard_bp.route('/cohorts', methods=['GET'])
+@jwt_required()
+def get_cohorts():
+    """Get cohort labels and the last refresh summary"""
+    return jsonify({
+        'success': True,
+        'cohorts': cohorts.cohort_labels(),
+        'last_refresh': leaderboard.last_refresh
+    }), 200
@@ -1,6 +1,16 @@
-from flask import Blueprint, request, jsonify
+import re
+from concurrent.futures import TimeoutError as RenderTimeout
+from flask import Blueprint, request, jsonify, Response
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from config import Config
+from datetime import datetime, timezone
+from models.candle import INTERVALS
+from models.marketplace_order import MarketplaceOrder
 from services.marketplace_service import MarketplaceService
+from services.order_book import order_books
+from services.qr_renderer import qr_renderer
+from services.listing_cache import listing_cache
+from services.market_data import candle_tail
 
 marketplace_bp = Blueprint('marketplace', __name__)
 
@@ -9,10 +19,25 @@ db = None
 def init_marketplace(database):
     global db
     db = database
+    
+    # Recover the order books from open orders and active listings
+    summary = order_books.load(db)
+    print("📒 Order books loaded: " + ', '.join(
+        f"{ctype} ({book['bids']} bids, {book['asks']} asks)" for ctype, book in summary.items()
+    ))
 
 @marketplace_bp.route('/listings', methods=['GET'])
 def get_listings():
-    """Get all active marketplace listings with optional filters"""
+    """
+    Get a page of active marketplace listings
+    
+    Query params: credit_type, max_price, min_amount, sort (price_asc,
+    price_desc, amount_desc, newest), limit, cursor (next_cursor of the
+    previous page)
+    
+    Responses carry a strong ETag; sending it back in If-None-Match gets
+    304 Not Modified while the page is unchanged.
+    """
     try:
         filters = {}
         if request.args.get('credit_type'):
@@ -22,15 +47,38 @@ def get_listings():
         if request.args.get('min_amount'):
             filters['min_amount'] = request.args.get('min_amount')
         
-        marketplace_service = MarketplaceService(db)
-        listings = marketplace_service.get_marketplace_listings(filters)
+        sort = request.args.get('sort', 'price_asc')
+        limit = request.args.get('limit')
+        limit = MarketplaceService.page_size(int(limit) if limit is not None else None)
+        cursor = request.args.get('cursor')
         
-        return jsonify({
-            'success': True,
-            'listings': listings,
-            'count': len(listings)
-        }), 200
+        # Repeated polls are served from the cache (no Mongo, no serialization)
+        key = listing_cache.key(filters, sort, limit, cursor)
+        cached = listing_cache.get(key)
+        if cached is None:
+            marketplace_service = MarketplaceService(db)
+            page = marketplace_service.get_marketplace_listings(filters, sort, limit, cursor)
+            
+            cached = listing_cache.put(key, jsonify({
+                'success': True,
+                'listings': page['listings'],
+                'count': len(page['listings']),
+                'sort': sort,
+                'next_cursor': page['next_cursor'],
+                'counts_by_type': page['counts_by_type']
+            }).get_data())
+        body, etag = cached
+        
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, no-cache'
+        return response
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -118,6 +166,8 @@ def initiate_purchase(listing_id):
             float(data['amount_kg_co2']),
             data['payment_method']
         )
+        if payment.get('qr_code_url'):
+            payment['qr_code_url'] = request.host_url.rstrip('/') + payment['qr_code_url']
         
         return jsonify({
             'success': True,
@@ -130,6 +180,31 @@ def initiate_purchase(listing_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@marketplace_bp.route('/qr/<digest>.png', methods=['GET'])
+def get_qr_code(digest):
+    """
+    Payment QR code image
+    
+    Images are content-addressed (sha256 of the payload), so they can be
+    cached forever.
+    """
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        return jsonify({'error': 'QR code not found'}), 404
+    
+    try:
+        png = qr_renderer.get_png(db, digest)
+        if png is None:
+            return jsonify({'error': 'QR code not found'}), 404
+        
+        response = Response(png, mimetype='image/png')
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+        
+    except RenderTimeout:
+        return jsonify({'error': 'QR code is still being rendered, try again'}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @marketplace_bp.route('/payment/<payment_id>/complete', methods=['POST'])
 @jwt_required()
 def complete_payment(payment_id):
@@ -148,7 +223,8 @@ def complete_payment(payment_id):
         marketplace_service = MarketplaceService(db)
         result = marketplace_service.complete_purchase(payment_id, payment_reference)
         
-        return jsonify(result), 200
+        # 202 while the settlement engine still has to move the credits
+        return jsonify(result), 200 if result['payment']['status'] == 'completed' else 202
         
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
@@ -212,3 +288,154 @@ def get_my_trades():
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+@marketplace_bp.route('/orders', methods=['POST'])
+@jwt_required()
+def place_order():
+    """
+    Place a limit order on the order book
+    
+    Sell orders become listings (credits are reserved); buy orders rest
+    until matched. Matches are returned as pending payments.
+    
+    Expected payload:
+    {
+        "side": "buy",
+        "credit_type": "solar",
+        "price_per_kg": 12.5,
+        "amount_kg_co2": 40
+    }
+    """
+    try:
+        user_id = get_jwt_identity()
+        data = request.get_json()
+        
+        required_fields = ['side', 'credit_type', 'price_per_kg', 'amount_kg_co2']
+        for field in required_fields:
+            if field not in data:
+                return jsonify({'error': f'{field} is required'}), 400
+        
+        side = data['side']
+        price_per_kg = float(data['price_per_kg'])
+        amount_kg_co2 = float(data['amount_kg_co2'])
+        if amount_kg_co2 <= 0:
+            return jsonify({'error': 'amount_kg_co2 must be positive'}), 400
+        
+        if side == 'sell':
+            listing = MarketplaceService(db).create_sell_listing(
+                user_id, data['credit_type'], amount_kg_co2, price_per_kg
+            )
+            fills = listing.pop('fills')
+            result = {'listing': listing, 'fills': fills}
+        elif side == 'buy':
+            if price_per_kg < 5:
+                return jsonify({'error': 'Minimum price per kg must be at least 5 Rs'}), 400
+            result = order_books.submit_buy(db, user_id, data['credit_type'], price_per_kg, amount_kg_co2)
+        else:
+            return jsonify({'error': "side must be 'buy' or 'sell'"}), 400
+        
+        return jsonify({'success': True, **result}), 201
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@marketplace_bp.route('/orders/<order_id>', methods=['DELETE'])
+@jwt_required()
+def cancel_order(order_id):
+    """Cancel a buy order, or a sell order (listing)"""
+    try:
+        user_id = get_jwt_identity()
+        result = order_books.cancel(db, order_id, user_id)
+        
+        return jsonify({
+            'success': True,
+            'message': 'Order cancelled successfully',
+            **result
+        }), 200
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@marketplace_bp.route('/my-orders', methods=['GET'])
+@jwt_required()
+def get_my_orders():
+    """Get the current user's buy orders (optional ?status=open)"""
+    try:
+        user_id = get_jwt_identity()
+        orders = MarketplaceOrder(db).get_user_orders(user_id, request.args.get('status'))
+        
+        return jsonify({
+            'success': True,
+            'orders': orders,
+            'count': len(orders)
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@marketplace_bp.route('/orderbook/<credit_type>', methods=['GET'])
+def get_order_book(credit_type):
+    """Aggregated bid/ask depth for a credit type (?levels=10)"""
+    try:
+        levels = int(request.args.get('levels', Config.ORDER_BOOK_DEPTH_LEVELS))
+        depth = order_books.get_depth(db, credit_type, levels)
+        
+        return jsonify({'success': True, **depth}), 200
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def _parse_time(value):
+    """ISO date or datetime as naive UTC (raises ValueError)"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@marketplace_bp.route('/candles', methods=['GET'])
+def get_candles():
+    """
+    OHLCV candles of settled trades
+    
+    Query params: credit_type, interval (1m, 1h, 1d), start and end (ISO
+    dates, optional), limit. Without start the latest candles up to end
+    are returned. Buckets without trades are left out.
+    """
+    try:
+        credit_type = request.args.get('credit_type')
+        if credit_type not in Config.CREDIT_TYPES:
+            raise ValueError(f"Invalid credit type. Must be one of: {', '.join(Config.CREDIT_TYPES)}")
+        interval = request.args.get('interval', '1h')
+        if interval not in INTERVALS:
+            raise ValueError(f"Invalid interval. Must be one of: {', '.join(INTERVALS)}")
+        
+        start = request.args.get('start')
+        end = request.args.get('end')
+        limit = request.args.get('limit')
+        candles = candle_tail.get_range(
+            db,
+            credit_type,
+            interval,
+            _parse_time(start) if start else None,
+            _parse_time(end) if end else None,
+            int(limit) if limit else None
+        )
+        
+        return jsonify({
+            'success': True,
+            'credit_type': credit_type,
+            'interval': interval,
+            'candles': candles,
+            'count': len(candles)
+        }), 200
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
@@ -3,15 +3,55 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from models.user import User
 from models.emission import Emission
 from services.ai_predictor import AIPredictor
+from services.pooled_predictor import PooledPredictor
+from services.forecast_cache import forecast_cache
+from services.training_jobs import training_jobs, TrainingQueueFull
+from config import Config
+from datetime import timedelta
 
 predictions_bp = Blueprint('predictions', __name__)
 
 db = None
 
+# Training-queue key for the shared pooled model
+POOLED_TRAINING_KEY = '__pooled_model__'
+
 def init_predictions(database):
     global db
     db = database
 
+def _get_predictor(model_name):
+    """Build the requested forecast model"""
+    emission_model = Emission(db)
+    
+    if model_name == 'pooled':
+        # Train the shared model in the background when missing or old
+        age = PooledPredictor.model_age()
+        if age is None or age > timedelta(hours=Config.POOLED_MODEL_MAX_AGE_HOURS):
+            try:
+                submit_pooled_training()
+            except TrainingQueueFull:
+                pass  # Keep serving the current model
+        if not PooledPredictor.is_trained():
+            # Serve the per-user model until the first pooled model is
+            # ready; the forecast cache is cleared when training finishes
+            return AIPredictor(emission_model)
+        return PooledPredictor(emission_model)
+    if model_name == 'per_user':
+        return AIPredictor(emission_model)
+    
+    raise ValueError(f"Unknown model '{model_name}'. Use 'per_user' or 'pooled'")
+
+def submit_pooled_training():
+    """Queue a retrain of the pooled model (deduplicated)"""
+    def run():
+        result = PooledPredictor.train_global(db)
+        if result.get('success'):
+            forecast_cache.clear()
+        return result
+    
+    return training_jobs.submit(POOLED_TRAINING_KEY, run)
+
 @predictions_bp.route('/forecast', methods=['GET'])
 @jwt_required()
 def get_forecast():
@@ -19,9 +59,16 @@ def get_forecast():
     try:
         user_id = get_jwt_identity()
         days_ahead = int(request.args.get('days', 7))
+        model_name = request.args.get('model', Config.FORECAST_MODEL)
         
         print(f"[PREDICTIONS] Forecast request for user: {user_id}, days: {days_ahead}")
         
+        # Serve repeated polls from the cache (no Mongo/NumPy work)
+        cache_key = forecast_cache.key(user_id, days_ahead, variant=model_name)
+        cached = forecast_cache.get(cache_key)
+        if cached is not None:
+            return jsonify(cached), 200
+        
         # Get user data
         user_model = User(db)
         user = user_model.get_user_by_id(user_id)
@@ -33,13 +80,14 @@ def get_forecast():
         print(f"[PREDICTIONS] User found: {user.get('email')}")
         
         # Get predictions
-        emission_model = Emission(db)
-        predictor = AIPredictor(emission_model)
+        predictor = _get_predictor(model_name)
         
         result = predictor.get_prediction_with_warning(user_id, user)
         
         print(f"[PREDICTIONS] Prediction result: success={result.get('success')}")
         
+        forecast_cache.put(cache_key, result)
+        
         # Return appropriate status code based on result
         if result.get('success'):
             return jsonify(result), 200
@@ -64,31 +112,72 @@ def get_forecast():
             'message': str(e)
         }), 500
 
+@predictions_bp.route('/cache/stats', methods=['GET'])
+@jwt_required()
+def get_forecast_cache_stats():
+    """Get forecast cache hit/miss counters"""
+    return jsonify(forecast_cache.stats()), 200
+
 @predictions_bp.route('/train', methods=['POST'])
 @jwt_required()
 def train_model():
-    """Train prediction model on user's data"""
+    """
+    Submit a background training job for the user's model
+    
+    Returns immediately with a job ID; poll /jobs/<job_id> for the result.
+    """
     try:
         user_id = get_jwt_identity()
         
-        # Get user data
-        user_model = User(db)
-        user = user_model.get_user_by_id(user_id)
+        job, created = training_jobs.submit(user_id, lambda: _run_training(user_id))
         
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
-        # Train model
-        emission_model = Emission(db)
-        predictor = AIPredictor(emission_model)
+        return jsonify({
+            'success': True,
+            'job': job,
+            'deduplicated': not created,
+            'queue': training_jobs.stats()
+        }), 202
+        
+    except TrainingQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@predictions_bp.route('/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_training_job(job_id):
+    """Get status and result of a training job"""
+    try:
+        user_id = get_jwt_identity()
+        job = training_jobs.get_job(job_id)
         
-        result = predictor.train_model(user_id, user)
+        if not job or job['user_id'] != user_id:
+            return jsonify({'error': 'Job not found'}), 404
         
-        return jsonify(result), 200
+        return jsonify(job), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@predictions_bp.route('/jobs/stats', methods=['GET'])
+@jwt_required()
+def get_training_queue_stats():
+    """Get training queue depth and worker usage"""
+    return jsonify(training_jobs.stats()), 200
+
+def _run_training(user_id):
+    """Train a user's model (runs on the training executor)"""
+    user_model = User(db)
+    user = user_model.get_user_by_id(user_id)
+    
+    if not user:
+        return {'success': False, 'message': 'User not found'}
+    
+    emission_model = Emission(db)
+    predictor = AIPredictor(emission_model)
+    
+    return predictor.train_model(user_id, user)
+
 @predictions_bp.route('/explain', methods=['GET'])
 @jwt_required()
 def explain_model():
@@ -104,13 +193,14 @@ def explain_model():
             return jsonify({'error': 'User not found'}), 404
         
         # Train model first if needed
-        emission_model = Emission(db)
-        predictor = AIPredictor(emission_model)
+        predictor = _get_predictor(request.args.get('model', Config.FORECAST_MODEL))
         predictor.train_model(user_id, user)
         
         explanation = predictor.explain_model()
         
         return jsonify(explanation), 200
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,109 @@
+from utils.periodic import PeriodicTask
+
+# name -> PeriodicTask, filled in by start_background_tasks
+tasks = {}
+
+def register_task(name, interval_seconds, fn):
+    """
+    Register and start a periodic task
+
+    A non-positive interval disables the task.
+    """
+    if interval_seconds <= 0:
+        print(f"⏸️  Background task disabled: {name}")
+        return None
+
+    task = PeriodicTask(name, interval_seconds, fn)
+    tasks[name] = task
+    task.start()
+    print(f"⏱️  Background task started: {name} (every {interval_seconds}s)")
+    return task
+
+def get_task(name):
+    return tasks.get(name)
+
+def get_status():
+    """Status of all registered tasks"""
+    return [task.status() for task in tasks.values()]
+
+def start_background_tasks(db):
+    """Start the application's scheduled jobs"""
+    from config import Config
+    from services.breach_scanner import BreachRiskScanner
+    from models.status_snapshot import StatusSnapshot
+    from services.fleet_recalculator import FleetRecalculator
+    from services.leaderboard import leaderboard
+    from services.cohort_stats import CohortStats
+    from services.credit_expiry_sweeper import CreditExpirySweeper
+    from services.listing_expiry_sweeper import ListingExpirySweeper
+    from services.unpaid_fill_sweeper import UnpaidFillSweeper
+    from services.view_counter import view_counter
+    from services.settlement_engine import SettlementEngine
+    from models.marketplace_listing import MarketplaceListing
+
+    register_task(
+        'breach_scan',
+        Config.BREACH_SCAN_INTERVAL_SECONDS,
+        lambda: BreachRiskScanner(db).scan()
+    )
+
+    register_task(
+        'status_reconcile',
+        Config.STATUS_RECONCILE_INTERVAL_SECONDS,
+        lambda: StatusSnapshot(db).reconcile(Config.STATUS_RECONCILE_BATCH)
+    )
+    
+    leaderboard_task = register_task(
+        'leaderboard_refresh',
+        Config.LEADERBOARD_REFRESH_SECONDS,
+        lambda: leaderboard.refresh(db)
+    )
+    if leaderboard_task:
+        # Build the boards now rather than on the first request
+        leaderboard_task.wake()
+    
+    register_task(
+        'cohort_stats',
+        Config.COHORT_STATS_INTERVAL_SECONDS,
+        lambda: CohortStats(db).refresh()
+    )
+    
+    register_task(
+        'credit_expiry',
+        Config.CREDIT_EXPIRY_SWEEP_INTERVAL_SECONDS,
+        lambda: CreditExpirySweeper(db).sweep()
+    )
+    
+    register_task(
+        'listing_expiry',
+        Config.LISTING_EXPIRY_SWEEP_INTERVAL_SECONDS,
+        lambda: ListingExpirySweeper(db).sweep()
+    )
+    
+    register_task(
+        'unpaid_fills',
+        Config.UNPAID_FILL_SWEEP_INTERVAL_SECONDS,
+        lambda: UnpaidFillSweeper(db).sweep()
+    )
+    
+    register_task(
+        'settlement',
+        Config.SETTLEMENT_INTERVAL_SECONDS,
+        lambda: SettlementEngine(db).run()
+    )
+    
+    listings = MarketplaceListing(db)
+    register_task(
+        'view_flush',
+        Config.VIEW_FLUSH_INTERVAL_SECONDS,
+        lambda: view_counter.flush(listings)
+    )
+    
+    recalc = register_task(
+        'fleet_recalc',
+        Config.RECALC_CHECK_INTERVAL_SECONDS,
+        lambda: FleetRecalculator(db).run_if_needed()
+    )
+    if recalc:
+        # Apply limit/threshold changes from this deploy without waiting
+        recalc.wake()
@@ -0,0 +1,332 @@
+import random
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from numpy.lib.stride_tricks import sliding_window_view
+from services.ai_predictor import AIPredictor
+from utils.demo_data_generator import DemoDataGenerator
+
+PATTERNS = ['gradual_increase', 'stable', 'random']
+
+class FleetRecorder:
+    """
+    In-memory stand-in for the Emission model
+
+    DemoDataGenerator writes through add_emission; the recorder keeps the
+    readings per user instead of inserting them into Mongo.
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def add_emission(self, user_id, electricity_kwh, electricity_co2_kg,
+                     combustion_ppm, combustion_co2_kg, source='iot', timestamp=None):
+        self.records.setdefault(user_id, []).append(
+            (timestamp or datetime.utcnow(), electricity_co2_kg, combustion_co2_kg)
+        )
+
+class WindowEmissionModel:
+    """
+    Emission model serving a fixed window of daily records
+
+    Lets the real AIPredictor run against one backtest window, for parity
+    checks and reference latency.
+    """
+
+    def __init__(self, dates, electricity, combustion):
+        self.records = [
+            {
+                'timestamp': d.isoformat(),
+                'electricity_co2_kg': float(e),
+                'combustion_co2_kg': float(c),
+                'total_co2_kg': float(e + c)
+            }
+            for d, e, c in zip(dates, electricity, combustion)
+        ]
+
+    def get_recent_emissions(self, user_id, days=30):
+        return self.records[-days:]
+
+def generate_fleet(num_users, days, seed=0, patterns=PATTERNS):
+    """
+    Generate a synthetic fleet with DemoDataGenerator
+
+    Args:
+        num_users: Number of households
+        days: Days of history per household
+        seed: Random seed
+        patterns: Demo patterns assigned round-robin
+
+    Returns:
+        Dict of aligned arrays: dates (T,), electricity/combustion (U, T),
+        occupants (U,), pattern (U,) index into patterns
+    """
+    random.seed(seed)
+    recorder = FleetRecorder()
+    generator = DemoDataGenerator(recorder)
+
+    for i in range(num_users):
+        generator.generate_emissions(f'user{i}', days, patterns[i % len(patterns)])
+
+    series = [recorder.records[f'user{i}'] for i in range(num_users)]
+    dates = [r[0].replace(hour=0, minute=0, second=0, microsecond=0) for r in series[0]]
+
+    return {
+        'dates': dates,
+        'electricity': np.array([[r[1] for r in s] for s in series]),
+        'combustion': np.array([[r[2] for r in s] for s in series]),
+        'occupants': np.array([random.randint(1, 6) for _ in range(num_users)], dtype=float),
+        'pattern': np.arange(num_users) % len(patterns)
+    }
+
+def _rolling_mean(windows, span=7):
+    """Trailing mean with min_periods=1 along the last axis (pandas semantics)"""
+    csum = np.cumsum(windows, axis=-1)
+    shifted = np.zeros_like(csum)
+    shifted[..., span:] = csum[..., :-span]
+    counts = np.minimum(np.arange(1, windows.shape[-1] + 1), span)
+    return (csum - shifted) / counts
+
+def build_training_features(fleet, cutoffs, window=60):
+    """
+    Build AIPredictor's training features for every (user, cutoff) window
+
+    Returns:
+        (X (U, C, W, 5), y (U, C, W), electricity windows, combustion windows)
+    """
+    elec, comb = fleet['electricity'], fleet['combustion']
+    starts = np.asarray(cutoffs) - window
+
+    e_win = sliding_window_view(elec, window, axis=1)[:, starts]
+    c_win = sliding_window_view(comb, window, axis=1)[:, starts]
+    y = e_win + c_win
+
+    days_of_month = np.array([d.day for d in fleet['dates']], dtype=float)
+    months = np.array([d.month for d in fleet['dates']], dtype=float)
+    dom_win = sliding_window_view(days_of_month, window)[starts]
+    month_win = sliding_window_view(months, window)[starts]
+
+    U, C = y.shape[:2]
+    X = np.stack([
+        np.broadcast_to(dom_win, (U, C, window)),
+        np.broadcast_to(month_win, (U, C, window)),
+        np.broadcast_to(fleet['occupants'][:, None, None], (U, C, window)),
+        _rolling_mean(e_win),
+        _rolling_mean(c_win)
+    ], axis=-1)
+
+    return X, y, e_win, c_win
+
+def fit_and_forecast(fleet, cutoffs, window=60, horizon=30):
+    """
+    Replicate AIPredictor.train_model/predict_emissions for every
+    (user, cutoff) pair at once
+
+    Returns:
+        (coef (U, C, 5), intercept (U, C), predictions (U, C, H))
+    """
+    X, y, e_win, c_win = build_training_features(fleet, cutoffs, window)
+    U, C = y.shape[:2]
+    days_of_month = np.array([d.day for d in fleet['dates']], dtype=float)
+    months = np.array([d.month for d in fleet['dates']], dtype=float)
+
+    # Ordinary least squares with intercept, as LinearRegression does:
+    # centre, then minimum-norm solution via the pseudo-inverse
+    x_mean = X.mean(axis=2, keepdims=True)
+    y_mean = y.mean(axis=2, keepdims=True)
+    coef = np.einsum('ucfw,ucw->ucf', np.linalg.pinv(X - x_mean), y - y_mean)
+    intercept = y_mean[..., 0] - np.einsum('ucf,ucf->uc', x_mean[:, :, 0, :], coef)
+
+    # Forecast features: calendar of the next H days, latest 7-day averages
+    future = np.asarray(cutoffs)[:, None] + np.arange(horizon)
+    F = np.stack([
+        np.broadcast_to(days_of_month[future], (U, C, horizon)),
+        np.broadcast_to(months[future], (U, C, horizon)),
+        np.broadcast_to(fleet['occupants'][:, None, None], (U, C, horizon)),
+        np.broadcast_to(e_win[..., -7:].mean(axis=-1, keepdims=True), (U, C, horizon)),
+        np.broadcast_to(c_win[..., -7:].mean(axis=-1, keepdims=True), (U, C, horizon))
+    ], axis=-1)
+
+    predictions = np.maximum(intercept[..., None] + np.einsum('ucdf,ucf->ucd', F, coef), 0)
+    return coef, intercept, predictions
+
+def _first_breach(cumulative, limits):
+    """Index of the first day above the limit, -1 if never"""
+    over = cumulative > limits[:, None, None]
+    return np.where(over.any(axis=-1), over.argmax(axis=-1), -1)
+
+def score_forecasts(fleet, cutoffs, predictions, limits, horizon=30):
+    """
+    Score forecasts against actuals
+
+    Returns:
+        Dict of (U, C) arrays: mae, mape, predicted_breach, actual_breach
+    """
+    total = fleet['electricity'] + fleet['combustion']
+    future = np.asarray(cutoffs)[:, None] + np.arange(horizon)
+    actual = total[:, future]
+
+    errors = np.abs(predictions - actual)
+    valid = actual > 1e-6
+    mape = np.where(
+        valid.any(axis=-1),
+        100 * np.sum(np.where(valid, errors / np.where(valid, actual, 1), 0), axis=-1)
+            / np.maximum(valid.sum(axis=-1), 1),
+        np.nan
+    )
+
+    # Emissions to date at each cutoff (series start = start of year)
+    to_date = np.cumsum(total, axis=1)[:, np.asarray(cutoffs) - 1]
+
+    return {
+        'mae': errors.mean(axis=-1),
+        'mape': mape,
+        'predicted_breach': _first_breach(to_date[..., None] + np.cumsum(predictions, axis=-1), limits),
+        'actual_breach': _first_breach(to_date[..., None] + np.cumsum(actual, axis=-1), limits)
+    }
+
+def _evaluate_chunk(args):
+    """Generate and evaluate one chunk of the fleet (runs in a worker process)"""
+    chunk_index, num_users, days, window, horizon, step, limit_spread, seed = args
+    timings = {}
+
+    started = time.perf_counter()
+    fleet = generate_fleet(num_users, days, seed=seed + chunk_index)
+    timings['generate'] = time.perf_counter() - started
+
+    # Limits are drawn around each household's realised total so that
+    # breaches land inside the evaluation horizon
+    rng = np.random.default_rng(seed + chunk_index)
+    totals = (fleet['electricity'] + fleet['combustion']).sum(axis=1)
+    limits = totals * rng.uniform(1 - limit_spread, 1 + limit_spread, num_users)
+
+    cutoffs = list(range(window, days - horizon + 1, step))
+
+    started = time.perf_counter()
+    _, _, predictions = fit_and_forecast(fleet, cutoffs, window, horizon)
+    timings['fit_forecast'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    scores = score_forecasts(fleet, cutoffs, predictions, limits, horizon)
+    timings['score'] = time.perf_counter() - started
+
+    scores['pattern'] = np.broadcast_to(fleet['pattern'][:, None], scores['mae'].shape)
+    return {k: v.ravel() for k, v in scores.items()}, timings
+
+def run_backtest(num_users=1000, days=120, window=60, horizon=30, step=7,
+                 workers=None, chunk_size=250, limit_spread=0.15, seed=42):
+    """
+    Rolling-origin backtest of AIPredictor over a synthetic fleet
+
+    Users are split into chunks evaluated in parallel processes; inside a
+    chunk all (user, cutoff) fits, forecasts and scores are vectorized.
+
+    Returns:
+        Report dict with 'latency' and 'accuracy' tables
+    """
+    if days < window + horizon:
+        raise ValueError(f'days must be at least window + horizon ({window + horizon})')
+
+    chunks = []
+    remaining, index = num_users, 0
+    while remaining > 0:
+        size = min(chunk_size, remaining)
+        chunks.append((index, size, days, window, horizon, step, limit_spread, seed))
+        remaining -= size
+        index += 1
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_evaluate_chunk, chunks))
+    wall_time = time.perf_counter() - started
+
+    scores = {k: np.concatenate([r[0][k] for r in results]) for k in results[0][0]}
+    stage_totals = {k: sum(r[1][k] for r in results) for k in results[0][1]}
+    forecasts = len(scores['mae'])
+
+    latency = [
+        {'stage': stage, 'worker_seconds': round(seconds, 3),
+         'us_per_forecast': round(1e6 * seconds / forecasts, 2)}
+        for stage, seconds in stage_totals.items()
+    ]
+
+    accuracy = []
+    for pattern_index, pattern in enumerate(PATTERNS + ['all']):
+        mask = scores['pattern'] == pattern_index if pattern != 'all' else np.ones(forecasts, bool)
+        if not mask.any():
+            continue
+        predicted, actual = scores['predicted_breach'][mask], scores['actual_breach'][mask]
+        both = (predicted >= 0) & (actual >= 0)
+        accuracy.append({
+            'pattern': pattern,
+            'forecasts': int(mask.sum()),
+            'mae_kg': round(float(np.mean(scores['mae'][mask])), 3),
+            'mape_pct': round(float(np.nanmean(scores['mape'][mask])), 2),
+            'breaches_caught': int(both.sum()),
+            'breach_date_mae_days': round(float(np.mean(np.abs(predicted[both] - actual[both]))), 2) if both.any() else None,
+            'missed_breaches': int(((predicted < 0) & (actual >= 0)).sum()),
+            'false_alarms': int(((predicted >= 0) & (actual < 0)).sum())
+        })
+
+    return {
+        'users': num_users,
+        'cutoffs_per_user': len(range(window, days - horizon + 1, step)),
+        'forecasts': forecasts,
+        'wall_seconds': round(wall_time, 3),
+        'forecasts_per_second': round(forecasts / wall_time, 1),
+        'latency': latency,
+        'accuracy': accuracy
+    }
+
+def reference_check(num_samples=20, days=120, window=60, horizon=30, seed=42):
+    """
+    Run the real AIPredictor on a few windows
+
+    Confirms the vectorized fit matches LinearRegression and measures the
+    per-forecast latency of the looped implementation.
+
+    Returns:
+        Dict with max coefficient difference and ms per forecast
+    """
+    fleet = generate_fleet(num_samples, days, seed=seed)
+    cutoff = window
+    coef, intercept, _ = fit_and_forecast(fleet, [cutoff], window, horizon)
+
+    X, _, _, _ = build_training_features(fleet, [cutoff], window)
+
+    max_diff = 0.0
+    started = time.perf_counter()
+    for u in range(num_samples):
+        predictor = AIPredictor(WindowEmissionModel(
+            fleet['dates'][cutoff - window:cutoff],
+            fleet['electricity'][u, cutoff - window:cutoff],
+            fleet['combustion'][u, cutoff - window:cutoff]
+        ))
+        user_data = {'household': {'occupants': fleet['occupants'][u]}}
+        predictor.predict_emissions(f'user{u}', user_data, days_ahead=horizon)
+
+        # Compare fitted values rather than coefficients, which are not
+        # unique when features are collinear (e.g. constant occupants)
+        theirs = predictor.model.predict(X[u, 0])
+        ours = intercept[u, 0] + X[u, 0] @ coef[u, 0]
+        max_diff = max(max_diff, float(np.max(np.abs(theirs - ours))))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'samples': num_samples,
+        'max_abs_difference': max_diff,
+        'looped_ms_per_forecast': round(1000 * elapsed / num_samples, 3)
+    }
+
+def format_table(rows):
+    """Render a list of dicts as a plain-text table"""
+    if not rows:
+        return ''
+    headers = list(rows[0].keys())
+    cells = [[str(r[h]) for h in headers] for r in rows]
+    widths = [max(len(h), *(len(c[i]) for c in cells)) for i, h in enumerate(headers)]
+    lines = ['  '.join(h.ljust(w) for h, w in zip(headers, widths)),
+             '  '.join('-' * w for w in widths)]
+    lines += ['  '.join(c.ljust(w) for c, w in zip(row, widths)) for row in cells]
+    return '\n'.join(lines)
@@ -0,0 +1,179 @@
+import numpy as np
+import time
+import uuid
+from datetime import datetime, timedelta
+from config import Config
+from utils.indexes import ensure_index
+
+class BreachRiskScanner:
+    """
+    Fleet-wide projection of carbon limit breach dates
+
+    Instead of waiting for each user to open the forecast page, the scan
+    loads year-to-date totals, limits and recent daily rates for every
+    household into arrays and projects all breach dates in one vectorized
+    pass. The ranked at-risk list is written for the admin dashboard.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.risk_collection = db.breach_risk
+        self.scan_collection = db.breach_risk_scans
+        ensure_index(self.risk_collection, [('scan_id', 1), ('rank', 1)])
+
+    @staticmethod
+    def project_breaches(totals, limits, daily_rates):
+        """
+        Project days until each household exceeds its limit
+
+        Args:
+            totals: Year-to-date emissions (kg), shape (N,)
+            limits: Annual limits (kg), shape (N,)
+            daily_rates: Predicted emissions per day (kg), shape (N,)
+
+        Returns:
+            Days until breach, shape (N,); 0 if already exceeded,
+            inf if the rate never reaches the limit
+        """
+        remaining = limits - totals
+        with np.errstate(divide='ignore', invalid='ignore'):
+            days = np.where(daily_rates > 0, np.ceil(remaining / daily_rates), np.inf)
+        return np.where(remaining <= 0, 0, days)
+
+    @staticmethod
+    def rank_at_risk(days_until_breach, percentage_used, horizon_days):
+        """
+        Indices of at-risk households, soonest breach first
+        (ties broken by highest usage)
+        """
+        at_risk = np.flatnonzero(days_until_breach <= horizon_days)
+        order = np.lexsort((-percentage_used[at_risk], days_until_breach[at_risk]))
+        return at_risk[order]
+
+    def _load_fleet(self, now):
+        """Fetch YTD totals, recent rates and limits as arrays"""
+        year_start = datetime(now.year, 1, 1)
+        rate_start = now - timedelta(days=Config.BREACH_SCAN_RATE_WINDOW_DAYS)
+
+        # Users without a household have no limit to breach
+        users = list(self.db.users.find({'household.annual_carbon_limit_kg': {'$gt': 0}}, {
+            'email': 1,
+            'household.annual_carbon_limit_kg': 1
+        }))
+        index = {u['_id']: i for i, u in enumerate(users)}
+
+        totals = np.zeros(len(users))
+        recent = np.zeros(len(users))
+        limits = np.array([
+            u.get('household', {}).get('annual_carbon_limit_kg', 0) for u in users
+        ], dtype=float)
+
+        pipeline = [
+            {'$match': {'timestamp': {'$gte': min(year_start, rate_start)}}},
+            {'$group': {
+                '_id': '$user_id',
+                'ytd_co2_kg': {'$sum': {'$cond': [
+                    {'$gte': ['$timestamp', year_start]}, '$total_co2_kg', 0
+                ]}},
+                'recent_co2_kg': {'$sum': {'$cond': [
+                    {'$gte': ['$timestamp', rate_start]}, '$total_co2_kg', 0
+                ]}}
+            }}
+        ]
+        for row in self.db.emissions.aggregate(pipeline, allowDiskUse=True):
+            i = index.get(row['_id'])
+            if i is not None:
+                totals[i] = row['ytd_co2_kg']
+                recent[i] = row['recent_co2_kg']
+
+        rates = recent / Config.BREACH_SCAN_RATE_WINDOW_DAYS
+        return users, totals, limits, rates
+
+    def scan(self):
+        """
+        Run a full scan and publish the ranked at-risk list
+
+        Returns:
+            Scan summary
+        """
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        scan_id = uuid.uuid4().hex
+        horizon = Config.BREACH_SCAN_HORIZON_DAYS
+
+        users, totals, limits, rates = self._load_fleet(now)
+        loaded = time.perf_counter()
+
+        days = self.project_breaches(totals, limits, rates)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentage = np.where(limits > 0, totals / limits * 100, 0)
+        ranked = self.rank_at_risk(days, percentage, horizon)
+        published = ranked[:Config.BREACH_SCAN_MAX_ENTRIES]
+        computed = time.perf_counter()
+
+        today = datetime(now.year, now.month, now.day)
+        entries = [{
+            'scan_id': scan_id,
+            'scanned_at': now,
+            'rank': rank + 1,
+            'user_id': str(users[i]['_id']),
+            'email': users[i].get('email'),
+            'days_until_breach': int(days[i]),
+            'breach_date': (today + timedelta(days=int(days[i]))).strftime('%Y-%m-%d'),
+            'current_emissions_kg': round(float(totals[i]), 2),
+            'annual_limit_kg': round(float(limits[i]), 2),
+            'percentage_used': round(float(percentage[i]), 2),
+            'daily_rate_kg': round(float(rates[i]), 2),
+            'already_exceeded': bool(days[i] == 0)
+        } for rank, i in enumerate(published)]
+
+        batch_size = Config.BREACH_SCAN_WRITE_BATCH
+        for start in range(0, len(entries), batch_size):
+            self.risk_collection.insert_many(entries[start:start + batch_size], ordered=False)
+
+        summary = {
+            '_id': scan_id,
+            'scanned_at': now,
+            'households': len(users),
+            'at_risk': len(ranked),
+            'published': len(entries),
+            'already_exceeded': int(np.sum(days == 0)),
+            'horizon_days': horizon,
+            'load_ms': round((loaded - started) * 1000, 2),
+            'compute_ms': round((computed - loaded) * 1000, 2),
+            'total_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+        self.scan_collection.insert_one(summary)
+
+        # Publish: drop rows of older scans once the new one is complete.
+        # Scans started later (overlapping runs or workers) are left alone;
+        # rows without scanned_at predate it and are always older
+        self.risk_collection.delete_many({'scanned_at': {'$not': {'$gte': now}}})
+        self.scan_collection.delete_many({'scanned_at': {'$lt': now}})
+
+        print(f"[BREACH_SCAN] {summary['at_risk']}/{summary['households']} households at risk ({summary['total_ms']} ms)")
+        return self._format_summary(summary)
+
+    def get_latest(self, limit=50, offset=0):
+        """
+        Get the latest ranked at-risk list
+
+        Returns:
+            {'scan': summary or None, 'households': [...]}
+        """
+        summary = self.scan_collection.find_one(sort=[('scanned_at', -1)])
+        if not summary:
+            return {'scan': None, 'households': []}
+
+        rows = self.risk_collection.find(
+            {'scan_id': summary['_id'], 'rank': {'$gt': offset}},
+            {'_id': 0, 'scan_id': 0, 'scanned_at': 0}
+        ).sort('rank', 1).limit(limit)
+
+        return {'scan': self._format_summary(summary), 'households': list(rows)}
+
+    def _format_summary(self, summary):
+        formatted = dict(summary)
+        formatted['scan_id'] = formatted.pop('_id')
+        formatted['scanned_at'] = summary['scanned_at'].isoformat()
+        return formatted
@@ -1,4 +1,6 @@
+import time
 from datetime import datetime
+from bson import ObjectId
 from config import Config
 
 class CarbonLimitService:
@@ -10,17 +12,23 @@ class CarbonLimitService:
         self.user_model = user_model
         self.emission_model = emission_model
         self.credit_model = credit_model
+        self.last_timings = {}
     
-    def calculate_annual_limit(self, area_sqm, occupants):
+    @staticmethod
+    def calculate_annual_limit(area_sqm, occupants):
         """
         Calculate annual carbon limit based on house specs.
         Formula: (Area * Base_Per_Sqm) + (Occupants * Per_Occupant)
+        
+        This is the single source of the formula; the stored
+        household.annual_carbon_limit_kg is this value plus purchased credits.
         """
         base_limit = area_sqm * Config.CARBON_LIMIT_BASE_PER_SQM
         occupant_limit = occupants * Config.CARBON_LIMIT_PER_OCCUPANT
         return round(base_limit + occupant_limit, 2)
 
-    def calculate_carbon_score(self, percentage_used, credit_dependency_ratio=0):
+    @staticmethod
+    def calculate_carbon_score(percentage_used, credit_dependency_ratio=0):
         """
         Calculate Carbon Score (A+ to F) based on usage efficiency.
         
@@ -48,27 +56,105 @@ class CarbonLimitService:
     def get_user_status(self, user_id):
         """
         Get comprehensive carbon status for a user
+        
+        User, year-to-date emissions and active credits are fetched in a
+        single aggregation round-trip. Per-stage latency is left in
+        self.last_timings.
+        """
+        started = time.perf_counter()
+        inputs = self._fetch_status_inputs(user_id)
+        fetched = time.perf_counter()
+        
+        if inputs is None:
+            return None
+        
+        status = self.build_status(
+            inputs['household'],
+            inputs['emissions'],
+            inputs['active_credits_kg']
+        )
+        finished = time.perf_counter()
+        
+        self.last_timings = {
+            'db_ms': round((fetched - started) * 1000, 2),
+            'compute_ms': round((finished - fetched) * 1000, 2),
+            'total_ms': round((finished - started) * 1000, 2)
+        }
+        return status
+    
+    def _fetch_status_inputs(self, user_id):
+        """
+        Fetch household, YTD emission totals and the credit balance with
+        one $lookup aggregation rooted at the user document
+        
+        Returns:
+            Dict of inputs or None if the user doesn't exist
         """
-        # Get user and their carbon limit
-        user = self.user_model.get_user_by_id(user_id)
-        if not user:
+        user_oid = ObjectId(user_id)
+        now = datetime.utcnow()
+        year_start = datetime(now.year, 1, 1)
+        
+        pipeline = [
+            {'$match': {'_id': user_oid}},
+            {'$project': {'household': 1}},
+            {'$lookup': {
+                'from': self.emission_model.collection.name,
+                'pipeline': [
+                    {'$match': {'user_id': user_oid, 'timestamp': {'$gte': year_start}}},
+                    {'$group': {
+                        '_id': None,
+                        'total_co2_kg': {'$sum': '$total_co2_kg'},
+                        'electricity_co2_kg': {'$sum': '$electricity_co2_kg'},
+                        'combustion_co2_kg': {'$sum': '$combustion_co2_kg'}
+                    }}
+                ],
+                'as': 'emissions'
+            }},
+            {'$lookup': {
+                'from': self.credit_model.balances.name,
+                'localField': '_id',
+                'foreignField': '_id',
+                'as': 'credits'
+            }}
+        ]
+        
+        result = list(self.user_model.collection.aggregate(pipeline))
+        if not result:
             return None
         
-        household = user.get('household', {})
+        doc = result[0]
+        emissions = doc['emissions'][0] if doc['emissions'] else {}
+        credits = doc['credits'][0] if doc['credits'] else None
+        
+        # Missing (pre-ledger user) or holding expired lots: let the
+        # model build the balance / expire them first
+        if credits is None or (credits.get('next_expiry') and credits['next_expiry'] < now):
+            credits = self.credit_model.get_balance(user_oid)
+        
+        return {
+            'household': doc.get('household', {}),
+            'emissions': {
+                'total_co2_kg': round(emissions.get('total_co2_kg', 0), 2),
+                'electricity_co2_kg': round(emissions.get('electricity_co2_kg', 0), 2),
+                'combustion_co2_kg': round(emissions.get('combustion_co2_kg', 0), 2)
+            },
+            'active_credits_kg': round(credits['available_kg'], 2),
+            'next_credit_expiry': credits.get('next_expiry')
+        }
+    
+    def build_status(self, household, emissions, total_credits):
+        """
+        Derive the carbon status from household data, YTD emission
+        totals and active credits (no database access)
+        """
         area_sqm = household.get('area_sqm', 0)
         occupants = household.get('occupants', 0)
         
         # Calculate limit dynamically to ensure it's always up to date with config
         annual_limit = self.calculate_annual_limit(area_sqm, occupants)
         
-        # Get total emissions for current year
-        year_start = datetime(datetime.utcnow().year, 1, 1)
-        emissions = self.emission_model.get_total_emissions(user_id, year_start)
         total_emitted = emissions['total_co2_kg']
         
-        # Get active credits
-        total_credits = self.credit_model.get_total_active_credits(user_id)
-        
         # Calculate net emissions (after credits)
         net_emissions = max(0, total_emitted - total_credits)
         
@@ -95,6 +181,7 @@ class CarbonLimitService:
             'excess_co2_kg': round(excess_co2, 2),
             'remaining_budget_kg': round(max(0, annual_limit - net_emissions), 2),
             'needs_credits': excess_co2 > 0,
+            'household': {'area_sqm': area_sqm, 'occupants': occupants},
             'limit_explanation': self.explain_limit_formula(area_sqm, occupants)
         }
     
@@ -179,3 +266,21 @@ class CarbonLimitService:
             tips.append("🚗 Verify vehicle emissions or reduce car travel if applicable.")
             
         return tips
+    
+    def get_peer_tips(self, peer_comparison):
+        """
+        Get tips on how the household compares with similar ones
+        
+        Args:
+            peer_comparison: Result of CohortStats.compare
+        """
+        tips = []
+        peers = peer_comparison['households']
+        for metric, source in (('electricity_per_occupant', 'electricity'),
+                               ('combustion_per_occupant', 'combustion')):
+            percentile = peer_comparison['metrics'][metric]['percentile']
+            if percentile >= 75:
+                tips.append(f"📊 Your {source} emissions per person are higher than {percentile:.0f}% of {peers} similar households.")
+            elif percentile <= 25:
+                tips.append(f"🏅 Your {source} emissions per person are lower than {100 - percentile:.0f}% of {peers} similar households.")
+        return tips
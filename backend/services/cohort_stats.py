@@ -0,0 +1,303 @@
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReplaceOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import Config
+from services import cohorts
+from utils.indexes import ensure_index
+from utils.quantile_sketch import QuantileSketch
+
+METRICS = (
+    'electricity_per_occupant',
+    'combustion_per_occupant',
+    'electricity_per_sqm',
+    'combustion_per_sqm'
+)
+
+class CohortStats:
+    """
+    Peer cohort aggregates for household comparisons
+
+    Each household contributes its average daily electricity and
+    combustion emissions this year, per occupant and per m², to one
+    quantile sketch per metric for its cohort. Each household's current
+    contribution is stored, so a refresh only touches households with new
+    readings or a changed profile: their old values are removed from the
+    sketches and the new ones are added. The fleet is aggregated in full
+    only when the year or the cohort definition changes.
+    """
+
+    STATE_ID = 'cohort_stats'
+    LEASE_SECONDS = 600
+    # Re-read a little before the last watermark so readings written while
+    # the previous refresh ran aren't missed (recomputation is idempotent)
+    OVERLAP_SECONDS = 60
+
+    def __init__(self, db):
+        self.db = db
+        self.stats_collection = db.cohort_stats
+        self.contribution_collection = db.cohort_contributions
+        self.state_collection = db.system_state
+        ensure_index(self.db.users, 'household.updated_at', sparse=True)
+
+    @staticmethod
+    def household_metrics(household, electricity_co2_kg, combustion_co2_kg, days):
+        """
+        Comparison metrics (kg CO2 per day) of one household
+
+        Returns:
+            {metric: value}, or None if there is nothing to compare
+        """
+        occupants = household.get('occupants', 0)
+        area = household.get('area_sqm', 0)
+        if days <= 0 or occupants <= 0 or area <= 0:
+            return None
+
+        electricity = electricity_co2_kg / days
+        combustion = combustion_co2_kg / days
+        return {
+            'electricity_per_occupant': electricity / occupants,
+            'combustion_per_occupant': combustion / occupants,
+            'electricity_per_sqm': electricity / area,
+            'combustion_per_sqm': combustion / area
+        }
+
+    def _aggregate_users(self, year_start, user_ids=None):
+        """
+        This year's emission totals and number of days with readings
+
+        Returns:
+            {user ObjectId: (electricity_co2_kg, combustion_co2_kg, days)}
+        """
+        match = {'timestamp': {'$gte': year_start}}
+        if user_ids is not None:
+            match['user_id'] = {'$in': list(user_ids)}
+
+        pipeline = [
+            {'$match': match},
+            {'$group': {
+                '_id': {
+                    'user_id': '$user_id',
+                    'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$timestamp'}}
+                },
+                'electricity_co2_kg': {'$sum': '$electricity_co2_kg'},
+                'combustion_co2_kg': {'$sum': '$combustion_co2_kg'}
+            }},
+            {'$group': {
+                '_id': '$_id.user_id',
+                'electricity_co2_kg': {'$sum': '$electricity_co2_kg'},
+                'combustion_co2_kg': {'$sum': '$combustion_co2_kg'},
+                'days': {'$sum': 1}
+            }}
+        ]
+        return {
+            row['_id']: (row['electricity_co2_kg'], row['combustion_co2_kg'], row['days'])
+            for row in self.db.emissions.aggregate(pipeline, allowDiskUse=True)
+        }
+
+    def _contributions(self, totals, households):
+        """Contribution documents for households with readings"""
+        docs = {}
+        for user_id, (electricity, combustion, days) in totals.items():
+            household = households.get(user_id)
+            metrics = household and self.household_metrics(household, electricity, combustion, days)
+            if metrics:
+                docs[user_id] = {
+                    '_id': user_id,
+                    'cohort': cohorts.cohort_for(household),
+                    'metrics': metrics
+                }
+        return docs
+
+    def _acquire(self, now):
+        try:
+            return self.state_collection.find_one_and_update(
+                {'_id': self.STATE_ID, '$or': [
+                    {'lease_until': None},
+                    {'lease_until': {'$lt': now}}
+                ]},
+                {'$set': {'lease_until': now + timedelta(seconds=self.LEASE_SECONDS)}},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            ) or {}
+        except DuplicateKeyError:
+            return None
+
+    def refresh(self):
+        """
+        Bring the cohort aggregates up to date
+
+        Returns:
+            Refresh summary, or None if another worker is refreshing
+        """
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        state = self._acquire(now)
+        if state is None:
+            return None
+
+        definition = cohorts.definition_fingerprint()
+        full = state.get('year') != now.year or state.get('definition') != definition
+
+        try:
+            if full:
+                households_updated = self._rebuild(now)
+            else:
+                households_updated = self._update(state['watermark'] - timedelta(seconds=self.OVERLAP_SECONDS), now)
+        except Exception:
+            self.state_collection.update_one({'_id': self.STATE_ID}, {'$set': {'lease_until': None}})
+            raise
+
+        self.state_collection.update_one({'_id': self.STATE_ID}, {'$set': {
+            'year': now.year,
+            'definition': definition,
+            'watermark': now,
+            'lease_until': None
+        }})
+
+        summary = {
+            'mode': 'full' if full else 'incremental',
+            'households_updated': households_updated,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+        print(f"[COHORT_STATS] {summary['mode']} refresh: {households_updated} households ({summary['duration_ms']} ms)")
+        return summary
+
+    def _new_sketches(self):
+        return {metric: QuantileSketch(Config.COHORT_STATS_SKETCH_ACCURACY) for metric in METRICS}
+
+    def _rebuild(self, now):
+        """Aggregate the whole fleet into fresh sketches"""
+        totals = self._aggregate_users(datetime(now.year, 1, 1))
+        households = {
+            u['_id']: u.get('household', {})
+            for u in self.db.users.find({}, {'household': 1})
+            if u['_id'] in totals
+        }
+        contributions = self._contributions(totals, households)
+
+        sketches = {}
+        for doc in contributions.values():
+            cohort_sketches = sketches.setdefault(doc['cohort'], self._new_sketches())
+            for metric, value in doc['metrics'].items():
+                cohort_sketches[metric].add(value)
+
+        self.contribution_collection.delete_many({})
+        docs = list(contributions.values())
+        for start in range(0, len(docs), 5000):
+            self.contribution_collection.insert_many(docs[start:start + 5000], ordered=False)
+
+        self.stats_collection.delete_many({})
+        self._save_sketches(sketches, now)
+        return len(docs)
+
+    def _update(self, since, now):
+        """Re-apply contributions of households changed since the watermark"""
+        changed = set(self.db.emissions.distinct('user_id', {'_id': {'$gte': ObjectId.from_datetime(since)}}))
+        changed.update(
+            u['_id'] for u in self.db.users.find({'household.updated_at': {'$gte': since}}, {'_id': 1})
+        )
+        if not changed:
+            return 0
+
+        totals = self._aggregate_users(datetime(now.year, 1, 1), changed)
+        households = {
+            u['_id']: u.get('household', {})
+            for u in self.db.users.find({'_id': {'$in': list(changed)}}, {'household': 1})
+        }
+        contributions = self._contributions(totals, households)
+        previous = {
+            doc['_id']: doc
+            for doc in self.contribution_collection.find({'_id': {'$in': list(changed)}})
+        }
+
+        sketches = {
+            doc['_id']: {metric: QuantileSketch.from_dict(doc['metrics'][metric]) for metric in METRICS}
+            for doc in self.stats_collection.find()
+        }
+        touched = set()
+
+        for user_id, old in previous.items():
+            cohort_sketches = sketches.get(old['cohort'])
+            if cohort_sketches:
+                for metric, value in old['metrics'].items():
+                    cohort_sketches[metric].remove(value)
+                touched.add(old['cohort'])
+
+        for doc in contributions.values():
+            cohort_sketches = sketches.setdefault(doc['cohort'], self._new_sketches())
+            for metric, value in doc['metrics'].items():
+                cohort_sketches[metric].add(value)
+            touched.add(doc['cohort'])
+
+        if contributions:
+            self.contribution_collection.bulk_write(
+                [ReplaceOne({'_id': uid}, doc, upsert=True) for uid, doc in contributions.items()],
+                ordered=False
+            )
+        gone = [uid for uid in previous if uid not in contributions]
+        if gone:
+            self.contribution_collection.delete_many({'_id': {'$in': gone}})
+
+        self._save_sketches({cohort: sketches[cohort] for cohort in touched}, now)
+        return len(changed)
+
+    def _save_sketches(self, sketches, now):
+        for cohort, cohort_sketches in sketches.items():
+            self.stats_collection.replace_one(
+                {'_id': cohort},
+                {
+                    'households': cohort_sketches[METRICS[0]].count,
+                    'metrics': {metric: sketch.to_dict() for metric, sketch in cohort_sketches.items()},
+                    'updated_at': now
+                },
+                upsert=True
+            )
+
+    def compare(self, user_id, household):
+        """
+        Compare a household's metrics with its cohort
+
+        Returns:
+            Comparison dict, or None if the household has no readings this
+            year or the cohort is too small to compare against
+        """
+        user_oid = ObjectId(user_id)
+        cohort = cohorts.cohort_for(household)
+
+        stats = self.stats_collection.find_one({'_id': cohort})
+        if not stats or stats['households'] < Config.COHORT_STATS_MIN_PEERS:
+            return None
+
+        contribution = self.contribution_collection.find_one({'_id': user_oid})
+        if contribution and contribution['cohort'] == cohort:
+            mine = contribution['metrics']
+        else:
+            # Not aggregated yet (first readings or profile just changed)
+            now = datetime.utcnow()
+            totals = self._aggregate_users(datetime(now.year, 1, 1), [user_oid]).get(user_oid)
+            mine = totals and self.household_metrics(household, *totals)
+        if not mine:
+            return None
+
+        metrics = {}
+        for metric in METRICS:
+            sketch = QuantileSketch.from_dict(stats['metrics'][metric])
+            metrics[metric] = {
+                'you': round(mine[metric], 4),
+                'cohort_mean': round(sketch.mean, 4),
+                'cohort_p25': round(sketch.quantile(0.25), 4),
+                'cohort_median': round(sketch.quantile(0.5), 4),
+                'cohort_p75': round(sketch.quantile(0.75), 4),
+                # Share of peers emitting less than you
+                'percentile': round(sketch.rank(mine[metric]) * 100, 1)
+            }
+
+        return {
+            'cohort': cohort,
+            'households': stats['households'],
+            'unit': 'kg CO2 per day',
+            'metrics': metrics,
+            'updated_at': stats['updated_at'].isoformat()
+        }
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import numpy as np
+from config import Config
+
+ALL = 'all'
+
+def _occupant_labels(bounds):
+    labels = []
+    lower = 1
+    for upper in bounds:
+        labels.append(str(upper) if upper == lower else f'{lower}-{upper}')
+        lower = upper + 1
+    labels.append(f'{lower}+')
+    return labels
+
+def _area_labels(bounds):
+    labels = []
+    lower = 0
+    for upper in bounds:
+        labels.append(f'{lower:g}-{upper:g}sqm')
+        lower = upper
+    labels.append(f'{lower:g}+sqm')
+    return labels
+
+def cohort_labels(occupant_bounds=None, area_bounds=None):
+    """
+    Labels of the peer cohorts, in index order
+
+    Cohorts are household size bands by occupant count, optionally split
+    further by floor area. Bounds are inclusive upper limits: occupant
+    bounds [1, 2, 4] give '1', '2', '3-4' and '5+'; with area bounds
+    [80] each of those splits into '<band>_0-80sqm' and '<band>_80+sqm'.
+    """
+    occupant_bounds = occupant_bounds or Config.COHORT_OCCUPANT_BOUNDS
+    area_bounds = Config.COHORT_AREA_BOUNDS if area_bounds is None else area_bounds
+
+    occupant_labels = _occupant_labels(occupant_bounds)
+    if not area_bounds:
+        return occupant_labels
+    return [f'{occ}_{area}' for occ in occupant_labels for area in _area_labels(area_bounds)]
+
+def assign_cohorts(occupants, area_sqm=None, occupant_bounds=None, area_bounds=None):
+    """
+    Cohort index of each household (vectorized)
+
+    Args:
+        occupants: Occupant counts, shape (N,)
+        area_sqm: Floor areas, shape (N,); needed when area bands are configured
+
+    Returns:
+        Indices into cohort_labels(), shape (N,)
+    """
+    occupant_bounds = occupant_bounds or Config.COHORT_OCCUPANT_BOUNDS
+    area_bounds = Config.COHORT_AREA_BOUNDS if area_bounds is None else area_bounds
+
+    index = np.searchsorted(np.asarray(occupant_bounds), np.asarray(occupants), side='left')
+    if not area_bounds:
+        return index
+
+    area_index = np.searchsorted(np.asarray(area_bounds), np.asarray(area_sqm), side='left')
+    return index * (len(area_bounds) + 1) + area_index
+
+def cohort_for(household, occupant_bounds=None, area_bounds=None):
+    """Cohort label of a single household"""
+    index = int(assign_cohorts(
+        [household.get('occupants', 0)],
+        [household.get('area_sqm', 0)],
+        occupant_bounds,
+        area_bounds
+    )[0])
+    return cohort_labels(occupant_bounds, area_bounds)[index]
+
+def definition_fingerprint():
+    """Identifies the configured cohort definition (aggregates built under
+    another definition must be rebuilt)"""
+    definition = {
+        'occupants': Config.COHORT_OCCUPANT_BOUNDS,
+        'area_sqm': Config.COHORT_AREA_BOUNDS
+    }
+    return hashlib.sha256(json.dumps(definition).encode()).hexdigest()[:16]
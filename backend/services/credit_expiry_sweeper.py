@@ -0,0 +1,102 @@
+import time
+from datetime import datetime, timedelta
+from config import Config
+from models.credit import Credit, LotConflict
+
+class CreditExpirySweeper:
+    """
+    Moves credit lots past their expiry date out of 'active'
+
+    Due lots are read in expiry order from the partial index on active
+    lots, a batch at a time, and expired through Credit.expire_batch
+    (lots, ledger, balances and status snapshots). Credit reservations
+    held past their listing's expiry are released in the same run. Each
+    run's metrics are kept in credit_expiry_sweeps.
+    """
+
+    METRICS_RETENTION_DAYS = 30
+
+    def __init__(self, db):
+        self.credit_model = Credit(db)
+        self.sweep_collection = db.credit_expiry_sweeps
+
+    def _due(self, now, limit):
+        return list(self.credit_model.collection.find({
+            'status': 'active',
+            'expiry_date': {'$lt': now}
+        }).sort('expiry_date', 1).limit(limit))
+
+    def sweep(self):
+        """
+        Expire due lots in batches
+
+        Returns:
+            Sweep metrics
+        """
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        metrics = {
+            'swept_at': now,
+            'batches': 0,
+            'lots_expired': 0,
+            'kg_expired': 0.0,
+            'users': 0,
+            'conflicts': 0
+        }
+
+        users = set()
+        for _ in range(Config.CREDIT_EXPIRY_SWEEP_MAX_BATCHES):
+            lots = self._due(now, Config.CREDIT_EXPIRY_SWEEP_BATCH)
+            if not lots:
+                break
+
+            try:
+                changes = self.credit_model.expire_batch(lots, now)
+            except LotConflict:
+                # Another sale or sweeper got there first; re-read the batch
+                metrics['conflicts'] += 1
+                if metrics['conflicts'] >= Config.CREDIT_EXPIRY_SWEEP_MAX_BATCHES:
+                    break
+                continue
+
+            metrics['batches'] += 1
+            metrics['lots_expired'] += len(lots)
+            metrics['kg_expired'] += sum(amount for amount, _ in changes.values())
+            users.update(changes)
+
+            if len(lots) < Config.CREDIT_EXPIRY_SWEEP_BATCH:
+                break
+
+        metrics['reservations_released'], reserved_kg = self.credit_model.release_expired_reservations(
+            now, limit=Config.CREDIT_EXPIRY_SWEEP_BATCH * Config.CREDIT_EXPIRY_SWEEP_MAX_BATCHES
+        )
+        metrics['reserved_kg_released'] = round(reserved_kg, 2)
+
+        metrics['users'] = len(users)
+        metrics['kg_expired'] = round(metrics['kg_expired'], 2)
+        metrics['remaining_due'] = self.credit_model.collection.count_documents({
+            'status': 'active',
+            'expiry_date': {'$lt': now}
+        })
+        metrics['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+        self.sweep_collection.insert_one(dict(metrics))
+        self.sweep_collection.delete_many({
+            'swept_at': {'$lt': now - timedelta(days=self.METRICS_RETENTION_DAYS)}
+        })
+
+        if metrics['lots_expired']:
+            print(f"[CREDIT_EXPIRY] Expired {metrics['lots_expired']} lots ({metrics['kg_expired']} kg) "
+                  f"for {metrics['users']} users in {metrics['duration_ms']} ms")
+        return self._format(metrics)
+
+    def get_recent(self, limit=20):
+        """Most recent sweep metrics, newest first"""
+        sweeps = self.sweep_collection.find({}, {'_id': 0}).sort('swept_at', -1).limit(limit)
+        return [self._format(sweep) for sweep in sweeps]
+
+    def _format(self, metrics):
+        formatted = dict(metrics)
+        formatted.pop('_id', None)
+        formatted['swept_at'] = metrics['swept_at'].isoformat()
+        return formatted
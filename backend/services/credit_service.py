@@ -1,4 +1,4 @@
-
+from datetime import datetime
 from config import Config
 
 class CreditService:
@@ -48,36 +48,65 @@ class CreditService:
             'valid_until': 'Valid for 1 year from purchase date'
         }
     
-    def get_credit_summary(self, user_id):
+    def get_credit_summary(self, user_id, offset=0, limit=None):
         """
         Get summary of user's credits
         
+        Totals per type come from one aggregation; lot details are paged.
+        
+        Args:
+            user_id: User ID
+            offset: Lots to skip
+            limit: Lots per page (defaults to CREDIT_SUMMARY_PAGE_SIZE)
+        
         Returns:
             Active credits and total offset capacity
         """
-        active_credits = self.credit_model.get_active_credits(user_id)
-        total_offset = self.credit_model.get_total_active_credits(user_id)
+        if limit is None:
+            limit = Config.CREDIT_SUMMARY_PAGE_SIZE
+        if offset < 0 or limit < 0:
+            raise ValueError('offset and limit must not be negative')
+        limit = min(limit, Config.CREDIT_SUMMARY_MAX_PAGE_SIZE)
+        
+        summary = self.credit_model.get_credit_summary(user_id, offset, limit)
+        now = datetime.utcnow()
         
-        # Group by type
-        by_type = {}
-        for credit in active_credits:
-            ctype = credit['credit_type']
-            if ctype not in by_type:
-                by_type[ctype] = {
-                    'type': ctype,
-                    'name': Config.CREDIT_TYPES[ctype]['name'],
-                    'icon': Config.CREDIT_TYPES[ctype]['icon'],
-                    'total_kg': 0,
-                    'count': 0
-                }
-            by_type[ctype]['total_kg'] += credit['amount_kg_co2']
-            by_type[ctype]['count'] += 1
+        active_credits = [
+            {
+                'id': str(c['_id']),
+                'credit_type': c['credit_type'],
+                'amount_kg_co2': c['amount_kg_co2'],
+                'purchase_date': c['purchase_date'].isoformat(),
+                'expiry_date': c['expiry_date'].isoformat(),
+                'transaction_id': c['transaction_id'],
+                'days_remaining': (c['expiry_date'] - now).days
+            }
+            for c in summary['lots']
+        ]
+        
+        by_type = []
+        for row in summary['by_type']:
+            info = Config.CREDIT_TYPES.get(row['credit_type'], {})
+            by_type.append({
+                'type': row['credit_type'],
+                'name': info.get('name', row['credit_type']),
+                'icon': info.get('icon'),
+                'total_kg': round(row['total_kg'], 2),
+                'count': row['count'],
+                'next_expiry': row['next_expiry'].isoformat()
+            })
         
         return {
-            'total_active_offset_kg': total_offset,
+            'total_active_offset_kg': summary['total_offset_kg'],
             'active_credits': active_credits,
-            'by_type': list(by_type.values()),
-            'credit_count': len(active_credits)
+            'by_type': by_type,
+            'credit_count': summary['credit_count'],
+            'page': {
+                'offset': offset,
+                'limit': limit,
+                'returned': len(active_credits),
+                'has_more': offset + len(active_credits) < summary['credit_count']
+            }
         }
     
     def get_available_credit_types(self):
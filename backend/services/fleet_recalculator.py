@@ -0,0 +1,336 @@
+import hashlib
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import Config
+from models.payment import Payment
+from models.status_snapshot import StatusSnapshot
+from services.carbon_limit_service import CarbonLimitService
+from services.forecast_cache import forecast_cache
+from utils.indexes import ensure_index
+
+class FleetRecalculator:
+    """
+    Recompute stored carbon limits and derived statuses for all users
+
+    A fingerprint of the inputs (limit formula constants and status
+    thresholds) is stored once a run completes. When it changes, or an
+    admin requests it, the fleet is walked in _id order in batches: each batch is one read and at most two bulk_writes,
+    followed by a short pause so request traffic keeps priority. Progress
+    is kept on the job document, and a run interrupted by a restart
+    resumes from its last processed _id.
+    """
+
+    STATE_ID = 'fleet_recalc'
+
+    def __init__(self, db):
+        self.db = db
+        self.users = db.users
+        self.payments = db.payments
+        self.state_collection = db.system_state
+        self.job_collection = db.recalculation_jobs
+        self.snapshots = StatusSnapshot(db)
+        ensure_index(self.job_collection, 'started_at')
+
+    def fingerprint(self):
+        """Hash of everything that feeds stored limits and statuses"""
+        # Emission factors only apply to new readings; stored totals and
+        # statuses don't change with them
+        inputs = {
+            'limit_base_per_sqm': Config.CARBON_LIMIT_BASE_PER_SQM,
+            'limit_per_occupant': Config.CARBON_LIMIT_PER_OCCUPANT,
+            'safe_threshold': Config.STATUS_SAFE_THRESHOLD,
+            'warning_threshold': Config.STATUS_WARNING_THRESHOLD
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]
+
+    def request_run(self, reason='admin'):
+        """Flag a forced run; picked up by run_if_needed"""
+        self.state_collection.update_one(
+            {'_id': self.STATE_ID},
+            {'$set': {'force_requested': True, 'force_reason': reason}},
+            upsert=True
+        )
+
+    def run_if_needed(self):
+        """
+        Run a recalculation if the inputs changed since the last completed
+        run, a run was requested, or a previous run was interrupted
+
+        Returns:
+            Job summary, or None if nothing to do / another worker holds the lease
+        """
+        current = self.fingerprint()
+        state = self.state_collection.find_one({'_id': self.STATE_ID}) or {}
+
+        if state.get('force_requested'):
+            reason = state.get('force_reason') or 'requested'
+        elif state.get('fingerprint') != current:
+            reason = 'inputs_changed' if state.get('fingerprint') else 'initial'
+        elif state.get('job_id'):
+            reason = 'resume'
+        else:
+            return None
+
+        return self.run(current, reason)
+
+    def _acquire(self, job_id):
+        """
+        Take the run lease; returns the previous state or None if another
+        worker holds an unexpired lease
+        """
+        now = datetime.utcnow()
+        try:
+            previous = self.state_collection.find_one_and_update(
+                {'_id': self.STATE_ID, '$or': [
+                    {'job_id': None},
+                    {'lease_until': {'$lt': now}}
+                ]},
+                {'$set': {
+                    'job_id': job_id,
+                    'lease_until': now + timedelta(seconds=Config.RECALC_LEASE_SECONDS)
+                }},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            return None
+        return previous or {}
+
+    def run(self, fingerprint, reason):
+        """
+        Walk the fleet and rewrite limits and statuses
+
+        Returns:
+            Job summary or None if the lease is held elsewhere
+        """
+        job_id = uuid.uuid4().hex
+        previous = self._acquire(job_id)
+        if previous is None:
+            return None
+
+        job = {
+            '_id': job_id,
+            'status': 'running',
+            'reason': reason,
+            'fingerprint': fingerprint,
+            'total': self.users.estimated_document_count(),
+            'processed': 0,
+            'limits_updated': 0,
+            'statuses_updated': 0,
+            'conflicts': 0,
+            'last_id': None,
+            'started_at': datetime.utcnow(),
+            'updated_at': datetime.utcnow()
+        }
+
+        # Pick up where an interrupted run of the same inputs left off
+        interrupted = previous.get('job_id') and self.job_collection.find_one({
+            '_id': previous['job_id'], 'status': 'running', 'fingerprint': fingerprint
+        })
+        if interrupted:
+            for field in ('processed', 'limits_updated', 'statuses_updated', 'conflicts', 'last_id'):
+                job[field] = interrupted[field]
+            job['resumed_from'] = interrupted['_id']
+            self.job_collection.update_one({'_id': interrupted['_id']}, {'$set': {'status': 'superseded'}})
+
+        self.job_collection.insert_one(job)
+        # A request made while this run is in progress should trigger another one
+        self.state_collection.update_one({'_id': self.STATE_ID}, {'$set': {'force_requested': False}})
+        print(f"[RECALC] Job {job_id} started ({reason}, {job['total']} users)")
+
+        try:
+            conflicted = []
+            while True:
+                batch = list(self.users.find(
+                    {'_id': {'$gt': job['last_id']}} if job['last_id'] else {},
+                    {'household': 1}
+                ).sort('_id', 1).limit(Config.RECALC_BATCH_SIZE))
+                if not batch:
+                    break
+
+                conflicted.extend(self._process_batch(batch, job))
+                job['processed'] += len(batch)
+                job['last_id'] = batch[-1]['_id']
+                self._checkpoint(job)
+
+                if Config.RECALC_BATCH_PAUSE_SECONDS > 0:
+                    time.sleep(Config.RECALC_BATCH_PAUSE_SECONDS)
+
+            # Users whose profile or limit changed under us: one retry on
+            # fresh reads; only those that conflict again stay counted
+            if conflicted:
+                job['conflicts'] -= len(conflicted)
+                retry = list(self.users.find({'_id': {'$in': conflicted}}, {'household': 1}))
+                self._process_batch(retry, job)
+
+            job['status'] = 'completed'
+            job['finished_at'] = datetime.utcnow()
+            self._checkpoint(job)
+            self.state_collection.update_one(
+                {'_id': self.STATE_ID, 'job_id': job_id},
+                {'$set': {'fingerprint': fingerprint, 'job_id': None, 'completed_at': job['finished_at']}}
+            )
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+            job['finished_at'] = datetime.utcnow()
+            self._checkpoint(job)
+            self.state_collection.update_one(
+                {'_id': self.STATE_ID, 'job_id': job_id},
+                {'$set': {'job_id': None}}
+            )
+            raise
+
+        # Forecasts embed the stored limit
+        forecast_cache.clear()
+        self._wake_breach_scan()
+
+        print(f"[RECALC] Job {job_id} completed: {job['limits_updated']} limits, "
+              f"{job['statuses_updated']} statuses updated")
+        return self._format_job(job)
+
+    def _process_batch(self, users, job):
+        """
+        Rewrite limits and statuses for one batch of users
+
+        Returns:
+            _ids whose limit write lost a race with a concurrent update
+        """
+        ids = [u['_id'] for u in users]
+        purchased = self._purchased_limits(ids)
+
+        limit_ops = []
+        expected = {}
+        for user in users:
+            household = user.get('household', {})
+            area = household.get('area_sqm', 0)
+            occupants = household.get('occupants', 0)
+            bonus = purchased.get(str(user['_id']), 0)
+            new_limit = round(CarbonLimitService.calculate_annual_limit(area, occupants) + bonus, 2)
+
+            stored = household.get('annual_carbon_limit_kg')
+            if stored == new_limit and household.get('purchased_limit_kg') == bonus:
+                continue
+
+            # Only write if the household wasn't changed since it was read
+            expected[user['_id']] = new_limit
+            limit_ops.append(UpdateOne(
+                {
+                    '_id': user['_id'],
+                    'household.area_sqm': area,
+                    'household.occupants': occupants,
+                    'household.annual_carbon_limit_kg': stored
+                },
+                {'$set': {
+                    'household.annual_carbon_limit_kg': new_limit,
+                    'household.purchased_limit_kg': bonus
+                }}
+            ))
+
+        conflicted = []
+        if limit_ops:
+            result = self.users.bulk_write(limit_ops, ordered=False)
+            job['limits_updated'] += result.modified_count
+            if result.matched_count < len(limit_ops):
+                current = self.users.find(
+                    {'_id': {'$in': list(expected)}},
+                    {'household.annual_carbon_limit_kg': 1}
+                )
+                conflicted = [
+                    u['_id'] for u in current
+                    if u.get('household', {}).get('annual_carbon_limit_kg') != expected[u['_id']]
+                ]
+                job['conflicts'] += len(conflicted)
+
+        job['statuses_updated'] += self._refresh_statuses(ids)
+        return conflicted
+
+    def _purchased_limits(self, user_ids):
+        """Limit bought through completed marketplace payments, by user id string"""
+        rows = self.payments.aggregate([
+            {'$match': {'buyer_id': Payment.ids_match(user_ids), 'status': 'completed'}},
+            {'$group': {'_id': '$buyer_id', 'amount_kg_co2': {'$sum': '$amount_kg_co2'}}}
+        ])
+        purchased = {}
+        for row in rows:
+            key = str(row['_id'])
+            purchased[key] = purchased.get(key, 0) + row['amount_kg_co2']
+        return purchased
+
+    def _refresh_statuses(self, user_ids):
+        """Re-derive the status block of this year's snapshots"""
+        snapshots = self.snapshots.collection.find({
+            '_id': {'$in': user_ids},
+            'year': datetime.utcnow().year
+        })
+
+        ops = []
+        for snapshot in snapshots:
+            status = self.snapshots._derive(snapshot)
+            if status == snapshot.get('status') and snapshot.get('status_version') == snapshot['version']:
+                continue
+            # Same optimistic check as the write path: a newer delta wins
+            ops.append(UpdateOne(
+                {'_id': snapshot['_id'], 'version': snapshot['version']},
+                {'$set': {'status': status, 'status_version': snapshot['version']}}
+            ))
+
+        if not ops:
+            return 0
+        return self.snapshots.collection.bulk_write(ops, ordered=False).modified_count
+
+    def _checkpoint(self, job):
+        """Persist progress and extend the lease"""
+        now = datetime.utcnow()
+        job['updated_at'] = now
+        self.job_collection.update_one({'_id': job['_id']}, {'$set': {
+            key: value for key, value in job.items() if key != '_id'
+        }})
+        if job['status'] == 'running':
+            self.state_collection.update_one(
+                {'_id': self.STATE_ID, 'job_id': job['_id']},
+                {'$set': {'lease_until': now + timedelta(seconds=Config.RECALC_LEASE_SECONDS)}}
+            )
+
+    def _wake_breach_scan(self):
+        from services import background_tasks
+        task = background_tasks.get_task('breach_scan')
+        if task:
+            task.wake()
+
+    def get_progress(self):
+        """
+        Latest job with progress, plus whether the stored results are
+        current for the configured inputs
+        """
+        job = self.job_collection.find_one(sort=[('started_at', -1)])
+        state = self.state_collection.find_one({'_id': self.STATE_ID}) or {}
+        return {
+            'job': self._format_job(job) if job else None,
+            'fingerprint': self.fingerprint(),
+            'applied_fingerprint': state.get('fingerprint'),
+            'pending': bool(state.get('force_requested')) or state.get('fingerprint') != self.fingerprint()
+        }
+
+    def _format_job(self, job):
+        formatted = dict(job)
+        formatted['job_id'] = formatted.pop('_id')
+        formatted['last_id'] = str(job['last_id']) if job.get('last_id') else None
+
+        total = job.get('total') or 0
+        formatted['percent'] = round(min(job['processed'] / total, 1) * 100, 1) if total else 100.0
+
+        elapsed = ((job.get('finished_at') or datetime.utcnow()) - job['started_at']).total_seconds()
+        rate = job['processed'] / elapsed if elapsed > 0 else 0
+        formatted['users_per_second'] = round(rate, 1)
+        if job['status'] == 'running' and rate > 0:
+            formatted['eta_seconds'] = round(max(total - job['processed'], 0) / rate, 1)
+
+        for key in ('started_at', 'updated_at', 'finished_at'):
+            if formatted.get(key):
+                formatted[key] = formatted[key].isoformat()
+        return formatted
@@ -0,0 +1,71 @@
+import threading
+from datetime import datetime
+from config import Config
+from utils.lru_cache import LRUCache
+
+class ForecastCache:
+    """
+    Response-level cache for AIPredictor.get_prediction_with_warning results
+
+    A forecast only changes when new emissions arrive, the household changes
+    or the UTC day rolls over. Entries are keyed by
+    (user_id, horizon, utc_date, data_watermark) where the watermark is a
+    per-user counter bumped by the ingest path, so a hit needs no Mongo
+    or NumPy work at all.
+
+    The cache is in-process: each worker keeps its own copy.
+    """
+
+    def __init__(self, max_entries=1024):
+        self._cache = LRUCache(max_entries)
+        self._watermarks = {}
+        self._lock = threading.Lock()
+        self.invalidations = 0
+
+    def _watermark(self, user_id):
+        with self._lock:
+            return self._watermarks.get(str(user_id), 0)
+
+    def key(self, user_id, horizon, variant='default'):
+        """
+        Build the cache key for a forecast request
+
+        Take the key before computing the forecast and store the result
+        under that same key, so a result computed while new data arrived
+        is filed under the old watermark and never served.
+        """
+        utc_date = datetime.utcnow().strftime('%Y-%m-%d')
+        return (str(user_id), variant, horizon, utc_date, self._watermark(user_id))
+
+    def get(self, key):
+        """Get a cached forecast or None"""
+        return self._cache.get(key)
+
+    def put(self, key, result):
+        """Cache a forecast result"""
+        self._cache.put(key, result)
+
+    def invalidate(self, user_id):
+        """
+        Invalidate all forecasts of a user (called on data ingest)
+
+        Bumping the watermark makes older keys unreachable even if a
+        forecast computed before the write is stored afterwards. Their
+        entries are left to age out of the LRU rather than scanned for.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            self._watermarks[user_id] = self._watermarks.get(user_id, 0) + 1
+            self.invalidations += 1
+
+    def clear(self):
+        """Drop every cached forecast (e.g. after a model change)"""
+        self._cache.clear()
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats['invalidations'] = self.invalidations
+        return stats
+
+# Shared instance used by routes and the ingest path
+forecast_cache = ForecastCache(Config.FORECAST_CACHE_MAX_ENTRIES)
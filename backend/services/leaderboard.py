@@ -0,0 +1,219 @@
+import threading
+import time
+import numpy as np
+from datetime import datetime
+from bson import ObjectId
+from config import Config
+from services import cohorts
+from services.carbon_limit_service import CarbonLimitService
+
+class Leaderboard:
+    """
+    Precomputed carbon leaderboard per peer cohort
+
+    A refresh loads year-to-date percentage of limit used for every active
+    household (same definition as /api/emissions/status) and keeps, per
+    cohort, the values sorted ascending alongside the matching user ids.
+    Top-N is a slice and a user's rank or percentile is a binary search,
+    so requests never scan the fleet. State is swapped in whole, so
+    readers always see one consistent refresh.
+    """
+
+    def __init__(self):
+        self._state = None
+        self._refresh_lock = threading.Lock()
+        self.last_refresh = None
+
+    @staticmethod
+    def build(user_ids, cohort_index, percentages, labels):
+        """
+        Sort households into per-cohort arrays
+
+        Args:
+            user_ids: User id strings, shape (N,)
+            cohort_index: Cohort of each household (index into labels), shape (N,)
+            percentages: Percentage of limit used, shape (N,)
+            labels: Cohort labels
+
+        Returns:
+            {cohort label: {'percentages': sorted array, 'user_ids': array}},
+            including cohorts.ALL for the whole fleet
+        """
+        user_ids = np.asarray(user_ids, dtype=object)
+        cohort_index = np.asarray(cohort_index)
+        percentages = np.asarray(percentages, dtype=float)
+
+        # One sort: by cohort, then by percentage within the cohort
+        order = np.lexsort((percentages, cohort_index))
+        bounds = np.cumsum(np.bincount(cohort_index, minlength=len(labels)))
+
+        boards = {}
+        start = 0
+        for label, end in zip(labels, bounds):
+            index = order[start:end]
+            boards[label] = {'percentages': percentages[index], 'user_ids': user_ids[index]}
+            start = end
+
+        overall = np.argsort(percentages, kind='stable')
+        boards[cohorts.ALL] = {'percentages': percentages[overall], 'user_ids': user_ids[overall]}
+        return boards
+
+    @staticmethod
+    def rank_in(board, percentage_used):
+        """
+        Rank (1 = lowest usage) and percentile of a value within a board
+
+        The percentile is the share of households in the board using a
+        larger share of their limit.
+        """
+        values = board['percentages']
+        total = len(values)
+        if total == 0:
+            return {'rank': 1, 'total': 0, 'percentile': 100.0}
+
+        better = int(np.searchsorted(values, percentage_used, side='left'))
+        worse = total - int(np.searchsorted(values, percentage_used, side='right'))
+        return {
+            'rank': better + 1,
+            'total': total,
+            'percentile': round(worse / total * 100, 1)
+        }
+
+    def _load_fleet(self, db):
+        """Fetch user ids, occupants, area and percentage of limit used as arrays"""
+        now = datetime.utcnow()
+        year_start = datetime(now.year, 1, 1)
+
+        emitted = {
+            row['_id']: row['total_co2_kg']
+            for row in db.emissions.aggregate([
+                {'$match': {'timestamp': {'$gte': year_start}}},
+                {'$group': {'_id': '$user_id', 'total_co2_kg': {'$sum': '$total_co2_kg'}}}
+            ], allowDiskUse=True)
+        }
+        credited = {
+            row['_id']: row['available_kg']
+            for row in db.credit_balances.find({'available_kg': {'$gt': 0}}, {'available_kg': 1})
+        }
+
+        # Households without readings this year aren't ranked
+        users = [u for u in db.users.find({}, {'household': 1}) if u['_id'] in emitted]
+        user_ids = np.array([str(u['_id']) for u in users], dtype=object)
+        area = np.array([u.get('household', {}).get('area_sqm', 0) for u in users], dtype=float)
+        occupants = np.array([u.get('household', {}).get('occupants', 0) for u in users], dtype=float)
+        totals = np.array([emitted[u['_id']] for u in users], dtype=float)
+        credits = np.array([credited.get(u['_id'], 0) for u in users], dtype=float)
+
+        limits = np.array([
+            CarbonLimitService.calculate_annual_limit(a, o) for a, o in zip(area.tolist(), occupants.tolist())
+        ], dtype=float)
+        net = np.maximum(0, totals - credits)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentages = np.where(limits > 0, net / limits * 100, 0)
+
+        return user_ids, occupants, area, np.round(percentages, 2)
+
+    def refresh(self, db):
+        """
+        Rebuild the leaderboard from the database
+
+        Returns:
+            Refresh summary
+        """
+        with self._refresh_lock:
+            return self._rebuild(db)
+
+    def _rebuild(self, db):
+        """Load and sort the fleet; caller holds _refresh_lock"""
+        started = time.perf_counter()
+        user_ids, occupants, area, percentages = self._load_fleet(db)
+        loaded = time.perf_counter()
+
+        labels = cohorts.cohort_labels()
+        boards = self.build(user_ids, cohorts.assign_cohorts(occupants, area), percentages, labels)
+        built = time.perf_counter()
+
+        self._state = boards
+        self.last_refresh = {
+            'refreshed_at': datetime.utcnow().isoformat(),
+            'households': len(user_ids),
+            'cohorts': {label: len(boards[label]['percentages']) for label in labels},
+            'load_ms': round((loaded - started) * 1000, 2),
+            'build_ms': round((built - loaded) * 1000, 2)
+        }
+
+        print(f"[LEADERBOARD] Refreshed {len(user_ids)} households "
+              f"({self.last_refresh['load_ms']} ms load, {self.last_refresh['build_ms']} ms build)")
+        return self.last_refresh
+
+    def _boards(self, db):
+        if self._state is None:
+            # Normally built by the refresh task woken at startup; requests
+            # arriving before it finishes wait for that build, not a second one
+            with self._refresh_lock:
+                if self._state is None:
+                    self._rebuild(db)
+        return self._state
+
+    def get_top(self, db, cohort=cohorts.ALL, limit=10):
+        """
+        Lowest-usage households of a cohort
+
+        Raises:
+            ValueError: Unknown cohort
+        """
+        boards = self._boards(db)
+        if cohort not in boards:
+            raise ValueError(f'Unknown cohort: {cohort}')
+
+        board = boards[cohort]
+        limit = max(1, min(limit, Config.LEADERBOARD_MAX_TOP))
+        top_ids = list(board['user_ids'][:limit])
+
+        emails = {
+            str(u['_id']): u.get('email', '')
+            for u in db.users.find({'_id': {'$in': [ObjectId(uid) for uid in top_ids]}}, {'email': 1})
+        }
+
+        entries = []
+        for position, (user_id, percentage) in enumerate(zip(top_ids, board['percentages'][:limit])):
+            # Same values share a rank
+            rank = int(np.searchsorted(board['percentages'], percentage, side='left')) + 1
+            entries.append({
+                'rank': rank,
+                'household': self._mask_email(emails.get(user_id, '')) or f'Household {position + 1}',
+                'percentage_used': float(percentage),
+                'carbon_score': CarbonLimitService.calculate_carbon_score(percentage)
+            })
+
+        return {
+            'cohort': cohort,
+            'total': len(board['percentages']),
+            'entries': entries,
+            'refreshed_at': self.last_refresh['refreshed_at']
+        }
+
+    def get_rank(self, db, household, percentage_used):
+        """
+        Rank and percentile of a percentage within the household's cohort
+        and across the fleet
+        """
+        boards = self._boards(db)
+        cohort = cohorts.cohort_for(household)
+        return {
+            'cohort': cohort,
+            'percentage_used': percentage_used,
+            'carbon_score': CarbonLimitService.calculate_carbon_score(percentage_used),
+            'cohort_rank': self.rank_in(boards[cohort], percentage_used),
+            'overall_rank': self.rank_in(boards[cohorts.ALL], percentage_used),
+            'refreshed_at': self.last_refresh['refreshed_at']
+        }
+
+    def _mask_email(self, email):
+        name, _, domain = email.partition('@')
+        if not name:
+            return ''
+        return f"{name[0]}***@{domain}" if domain else f"{name[0]}***"
+
+# Shared instance used by the routes and the refresh task
+leaderboard = Leaderboard()
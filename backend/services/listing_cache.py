@@ -0,0 +1,81 @@
+import hashlib
+import threading
+import time
+from config import Config
+from utils.lru_cache import LRUCache
+
+class ListingCache:
+    """
+    Short-lived cache of serialized marketplace listing pages
+
+    Entries are keyed by (marketplace version, normalized search
+    parameters) and hold the JSON body with its strong ETag (a hash of
+    the body), so a hit needs neither Mongo nor serialization and a
+    matching If-None-Match is answered with 304. The version is bumped
+    by every listing write in this process (create, sale, cancel,
+    expiry), which makes older entries unreachable at once; writes made
+    by other workers show up when the TTL runs out.
+    """
+
+    def __init__(self, max_entries=512, ttl_seconds=5):
+        self.ttl_seconds = ttl_seconds
+        self._cache = LRUCache(max_entries)
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        with self._lock:
+            return self._version
+
+    def bump(self):
+        """Invalidate every cached page (a listing changed)"""
+        with self._lock:
+            self._version += 1
+        self._cache.clear()
+
+    @staticmethod
+    def _number(value):
+        return float(value) if value not in (None, '') else None
+
+    def key(self, filters, sort, limit, cursor=None):
+        """
+        Build the cache key for a search
+
+        Take the key before running the search and store the page under
+        that same key, so a page read while a listing changed is filed
+        under the old version and never served.
+
+        Raises:
+            ValueError: A numeric filter isn't a number
+        """
+        return (
+            self.version,
+            filters.get('credit_type') or None,
+            self._number(filters.get('max_price')),
+            self._number(filters.get('min_amount')),
+            sort,
+            limit,
+            cursor or None
+        )
+
+    def get(self, key):
+        """Cached (body, etag) or None"""
+        entry = self._cache.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1], entry[2]
+
+    def put(self, key, body):
+        """
+        Cache a serialized page
+
+        Returns:
+            (body, etag)
+        """
+        etag = hashlib.sha256(body).hexdigest()
+        self._cache.put(key, (time.monotonic() + self.ttl_seconds, body, etag))
+        return body, etag
+
+# Shared by all requests of this worker process
+listing_cache = ListingCache(Config.MARKETPLACE_CACHE_MAX_ENTRIES, Config.MARKETPLACE_CACHE_TTL_SECONDS)
@@ -0,0 +1,77 @@
+import time
+from datetime import datetime
+from bson import ObjectId
+from config import Config
+from models.credit import Credit
+from models.marketplace_listing import MarketplaceListing
+from models.payment import Payment
+from services.listing_cache import listing_cache
+from services.order_book import order_books
+
+class ListingExpirySweeper:
+    """
+    Moves marketplace listings past expires_at out of 'active'
+
+    Due listings are read in expiry order from the partial index on
+    active listings, a batch at a time, and marked 'expired' with one
+    update_many per batch. Each expired listing leaves its order book and
+    its credit reservation is released like a cancellation (amounts
+    matched by buy orders but not yet paid for stay reserved).
+    """
+
+    def __init__(self, db):
+        self.listing_model = MarketplaceListing(db)
+        self.credit_model = Credit(db)
+        self.payment_model = Payment(db)
+
+    def sweep(self):
+        """
+        Expire due listings in batches
+
+        Returns:
+            Sweep metrics
+        """
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        metrics = {
+            'batches': 0,
+            'listings_expired': 0,
+            'reservations_released': 0,
+            'reserved_kg_released': 0.0
+        }
+
+        for _ in range(Config.LISTING_EXPIRY_SWEEP_MAX_BATCHES):
+            due = self.listing_model.get_expired(now, Config.LISTING_EXPIRY_SWEEP_BATCH)
+            if not due:
+                break
+
+            expired = self.listing_model.expire_batch([listing['_id'] for listing in due], now)
+            metrics['batches'] += 1
+            metrics['listings_expired'] += len(expired)
+            if expired:
+                listing_cache.bump()
+                self._release(expired, metrics)
+
+            if len(due) < Config.LISTING_EXPIRY_SWEEP_BATCH:
+                break
+
+        metrics['reserved_kg_released'] = round(metrics['reserved_kg_released'], 2)
+        metrics['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+        if metrics['listings_expired']:
+            print(f"[LISTING_EXPIRY] Expired {metrics['listings_expired']} listings, released "
+                  f"{metrics['reserved_kg_released']} kg in {metrics['duration_ms']} ms")
+        return metrics
+
+    def _release(self, expired, metrics):
+        """Drop expired listings from the books and release their reservations"""
+        keep = self.payment_model.get_unsettled_matched_kg_by_listing(
+            [str(listing['_id']) for listing in expired]
+        )
+        for listing in expired:
+            listing_id = str(listing['_id'])
+            order_books.remove(listing['credit_type'], listing_id)
+            released = self.credit_model.release_reservation(ObjectId(listing_id), keep_kg=keep.get(listing_id, 0))
+            if released:
+                metrics['reservations_released'] += 1
+                metrics['reserved_kg_released'] += released
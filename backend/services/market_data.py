@@ -0,0 +1,144 @@
+import threading
+import time
+from config import Config
+from models.candle import Candle, bucket_start, merge
+
+class CandleTail:
+    """
+    In-memory tail of the OHLCV candle series
+
+    Keeps the latest `size` candles of each (credit_type, interval)
+    series. Trades settled by this process are merged in as they are
+    recorded; every `refresh_seconds` the series re-reads only its
+    newest bucket onwards, which picks up trades settled by other
+    workers. Ranges inside the tail are served without touching Mongo;
+    older ranges are read from the candles collection.
+
+    Mongo I/O runs outside the lock. Each series carries a version bumped
+    on every change; a write or load that finds it changed meanwhile
+    can't tell whether its data is already in the tail, so it marks the
+    series to be re-read instead of risking counting trades twice.
+    """
+
+    def __init__(self, size=500, refresh_seconds=5):
+        self.size = size
+        self.refresh_seconds = refresh_seconds
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, db, trades):
+        """
+        Record settled trades in the stored candles and the tail
+
+        Args:
+            trades: [(credit_type, price_per_kg, amount_kg_co2, settled_at)]
+        """
+        partials = Candle.aggregate(trades)
+        with self._lock:
+            versions = {key: series['version'] for key, series in self._series.items()}
+
+        Candle(db).record(partials)
+
+        with self._lock:
+            for (credit_type, interval, t), partial in partials.items():
+                key = (credit_type, interval)
+                series = self._series.get(key)
+                if series is None:
+                    continue
+                if series['version'] != versions.get(key):
+                    # Reloaded during the write, maybe with these trades
+                    # already in: re-read the bucket instead of merging
+                    self._mark_stale(series, t)
+                    continue
+                candles = series['candles']
+                if t in candles:
+                    merge(candles[t], partial)
+                else:
+                    candles[t] = {'credit_type': credit_type, 'interval': interval, 't': t, **partial}
+                    self._trim(series)
+            # Bumped once the whole write is merged, so later readers and
+            # writers can tell the tail changed under them
+            for key in {(credit_type, interval) for credit_type, interval, _ in partials}:
+                if key in self._series:
+                    self._series[key]['version'] += 1
+
+    def _mark_stale(self, series, t):
+        """Make the next _load re-read the series from bucket t onwards"""
+        series['loaded_at'] = None
+        if t is not None and (series['reload_from'] is None or t < series['reload_from']):
+            series['reload_from'] = t
+
+    def _trim(self, series):
+        """Drop the oldest candles beyond the tail size"""
+        candles = series['candles']
+        for t in sorted(candles)[:-self.size]:
+            del candles[t]
+            series['complete'] = False
+
+    def _load(self, db, credit_type, interval):
+        """The series' tail, loaded or refreshed from Mongo when stale"""
+        key = (credit_type, interval)
+        with self._lock:
+            series = self._series.get(key)
+            if series and series['loaded_at'] is not None and time.monotonic() - series['loaded_at'] < self.refresh_seconds:
+                return series
+            read_from = max(series['candles']) if series and series['candles'] else None
+            if series and series['reload_from'] is not None and (read_from is None or series['reload_from'] < read_from):
+                read_from = series['reload_from']
+            version = series['version'] if series else 0
+
+        model = Candle(db)
+        if series is None:
+            docs = model.get_range(credit_type, interval, limit=self.size)
+        else:
+            docs = model.get_range(credit_type, interval, start=read_from, limit=self.size)
+
+        with self._lock:
+            series = self._series.setdefault(key, {
+                'candles': {}, 'complete': False, 'version': 0, 'loaded_at': None, 'reload_from': None
+            })
+            if read_from is None:
+                # Fewer candles than the tail holds: the tail is the whole history
+                series['complete'] = len(docs) < self.size
+            for doc in docs:
+                series['candles'][doc['t']] = doc
+            self._trim(series)
+            if series['version'] != version:
+                # Trades were merged (or another load applied) during the
+                # read, so these docs may predate them: read again next time
+                self._mark_stale(series, read_from if read_from is not None else (docs[0]['t'] if docs else None))
+            else:
+                series['loaded_at'] = time.monotonic()
+                series['reload_from'] = None
+            series['version'] += 1
+            return series
+
+    def get_range(self, db, credit_type, interval, start=None, end=None, limit=None):
+        """
+        Candles of one series, oldest first
+
+        Returns:
+            Formatted candles
+        """
+        limit = max(1, min(limit or Config.CANDLE_MAX_POINTS, Config.CANDLE_MAX_POINTS))
+        series = self._load(db, credit_type, interval)
+
+        with self._lock:
+            first = bucket_start(start, interval) if start is not None else None
+            times = [
+                t for t in sorted(series['candles'])
+                if (first is None or t >= first) and (end is None or t <= end)
+            ]
+            if start is not None:
+                in_tail = series['complete'] or (series['candles'] and first >= min(series['candles']))
+                selected = times[:limit]
+            else:
+                in_tail = series['complete'] or len(times) >= limit
+                selected = times[-limit:]
+            if in_tail:
+                return [Candle.format_candle(series['candles'][t]) for t in selected]
+
+        return [Candle.format_candle(c) for c in Candle(db).get_range(credit_type, interval, start, end, limit)]
+
+# Shared by all requests of this worker process
+candle_tail = CandleTail(Config.CANDLE_TAIL_SIZE, Config.CANDLE_TAIL_REFRESH_SECONDS)
@@ -2,9 +2,15 @@ from models.marketplace_listing import MarketplaceListing
 from models.credit import Credit
 from models.payment import Payment
 from models.user import User
-import qrcode
-import io
-import base64
+from services.order_book import order_books
+from services.view_counter import view_counter
+from services.qr_renderer import qr_renderer
+from services.listing_cache import listing_cache
+from services.background_tasks import get_task
+from services.settlement_engine import SettlementEngine
+from config import Config
+from bson import ObjectId
+from datetime import datetime, timedelta
 
 class MarketplaceService:
     """Service for marketplace trading operations"""
@@ -15,36 +21,62 @@ class MarketplaceService:
         self.credit_model = Credit(db)
         self.payment_model = Payment(db)
         self.user_model = User(db)
+        # Users looked up so far; the service is built per request, so
+        # this is a per-request memo
+        self._users = {}
     
     def create_sell_listing(self, seller_id, credit_type, amount_kg_co2, price_per_kg):
         """
         Create a new sell listing
         
-        Validates that seller has enough credits to sell
-        """
-        # Check if user has enough credits
-        user_credits = self.credit_model.get_credit_summary(seller_id)
-        available = user_credits.get('total_offset_kg', 0)
+        The listed amount is reserved against the seller's balance first
+        (keyed by the listing id), so the same credits can't be listed twice.
+        The listing is then a sell order on the order book and is matched
+        against resting buy orders right away.
         
-        if available < amount_kg_co2:
-            raise ValueError(f'Insufficient credits. Available: {available} kg, Requested: {amount_kg_co2} kg')
-            
+        Returns:
+            Listing, with 'fills' (pending payments of matched buy orders)
+        """
         if price_per_kg < 5:
             raise ValueError('Minimum price per kg must be at least 5 Rs')
         
-        # Create listing
-        listing = self.marketplace_model.create_listing(
-            seller_id, credit_type, amount_kg_co2, price_per_kg
-        )
+        listing_id = ObjectId()
+        expires_at = datetime.utcnow() + timedelta(days=MarketplaceListing.LISTING_DAYS)
         
-        # Mark credits as "locked" for this listing
-        # (In a real system, you'd create a separate "locked_credits" collection)
+        # Raises ValueError if the unreserved balance doesn't cover the amount
+        self.credit_model.reserve_credits(seller_id, amount_kg_co2, listing_id, expires_at, credit_type)
         
+        try:
+            listing = self.marketplace_model.create_listing(
+                seller_id, credit_type, amount_kg_co2, price_per_kg, listing_id, expires_at
+            )
+        except Exception:
+            self.credit_model.release_reservation(listing_id)
+            raise
+        listing_cache.bump()
+        
+        fills, status = order_books.submit_listing(self.db, listing)
+        if status == 'cancelled':
+            # Reached the seller's own bid (self-trade prevention)
+            listing = self.cancel_listing(listing['listing_id'], seller_id)
+        elif fills:
+            listing = self.marketplace_model.get_listing_by_id(listing['listing_id'])
+        
+        listing['fills'] = fills
         return listing
     
-    def get_marketplace_listings(self, filters=None):
-        """Get all active marketplace listings"""
-        return self.marketplace_model.get_active_listings(filters)
+    @staticmethod
+    def page_size(limit=None):
+        """Listings per page, clamped to MARKETPLACE_MAX_PAGE_SIZE"""
+        if limit is None:
+            limit = Config.MARKETPLACE_PAGE_SIZE
+        return max(1, min(limit, Config.MARKETPLACE_MAX_PAGE_SIZE))
+    
+    def get_marketplace_listings(self, filters=None, sort='price_asc', limit=None, cursor=None):
+        """Get a page of active marketplace listings, with anonymized sellers"""
+        page = self.marketplace_model.get_active_listings(filters, sort, self.page_size(limit), cursor)
+        self.add_sellers(page['listings'])
+        return page
     
     def get_listing_details(self, listing_id):
         """Get detailed information about a listing"""
@@ -52,16 +84,38 @@ class MarketplaceService:
         if not listing:
             raise ValueError('Listing not found')
         
-        # Increment view count
-        self.marketplace_model.increment_views(listing_id)
-        
-        # Get seller info (anonymized)
-        seller = self.user_model.get_user_by_id(listing['seller_id'])
-        if seller:
-            listing['seller_email'] = seller['email'][:3] + '***@' + seller['email'].split('@')[1]
+        # Views are buffered and flushed in bulk by the view_flush task;
+        # without it running, write through as before
+        if get_task('view_flush'):
+            view_counter.record(listing_id)
+            listing['views'] += view_counter.pending(listing_id)
+        else:
+            self.marketplace_model.increment_views(listing_id)
         
+        self.add_sellers([listing])
         return listing
     
+    def _get_users(self, user_ids):
+        """Users by id string; ones not in the memo are fetched with one $in query"""
+        missing = {str(user_id) for user_id in user_ids} - set(self._users)
+        if missing:
+            found = self.user_model.get_users_by_ids(missing, {'email': 1})
+            for user_id in missing:
+                self._users[user_id] = found.get(user_id)
+        return self._users
+    
+    def add_sellers(self, listings):
+        """
+        Add each listing's seller email (anonymized), looking up all the
+        sellers at once
+        """
+        users = self._get_users(listing['seller_id'] for listing in listings)
+        for listing in listings:
+            seller = users.get(listing['seller_id'])
+            if seller:
+                listing['seller_email'] = seller['email'][:3] + '***@' + seller['email'].split('@')[1]
+        return listings
+    
     def initiate_purchase(self, buyer_id, listing_id, amount_kg_co2, payment_method):
         """
         Initiate a purchase from marketplace
@@ -100,18 +154,18 @@ class MarketplaceService:
         # Generate payment details based on method
         if payment_method == 'upi':
             upi_id = self._generate_upi_id(listing['seller_id'])
-            qr_code = self._generate_upi_qr(upi_id, total_amount, payment['transaction_id'])
+            qr_code_id = self._generate_upi_qr(upi_id, total_amount, payment['transaction_id'])
             
             payment = self.payment_model.add_payment_details(
                 payment['payment_id'],
                 upi_id=upi_id,
-                qr_code=qr_code
+                qr_code_id=qr_code_id
             )
         elif payment_method == 'qr':
-            qr_code = self._generate_payment_qr(total_amount, payment['transaction_id'])
+            qr_code_id = self._generate_payment_qr(total_amount, payment['transaction_id'])
             payment = self.payment_model.add_payment_details(
                 payment['payment_id'],
-                qr_code=qr_code
+                qr_code_id=qr_code_id
             )
         
         return payment
@@ -120,96 +174,97 @@ class MarketplaceService:
         """
         Complete a purchase after payment verification
         
-        In a real system, this would be called by a payment webhook
+        In a real system, this would be called by a payment webhook. The
+        payment is queued for the settlement engine, which moves the
+        credits in batches; without the settlement task running it is
+        settled right away.
         """
-        payment = self.payment_model.get_payment_by_id(payment_id)
-        if not payment:
-            raise ValueError('Payment not found')
-        
-        if payment['status'] != 'pending':
-            raise ValueError(f'Payment already {payment["status"]}')
-        
-        # Get listing
-        listing = self.marketplace_model.get_listing_by_id(payment['listing_id'])
-        if not listing:
-            raise ValueError('Listing not found')
-        
-        # Transfer credits from seller to buyer
-        self._transfer_credits(
-            listing['seller_id'],
-            payment['buyer_id'],
-            listing['credit_type'],
-            payment['amount_kg_co2']
-        )
-        
-        # Update listing amount
-        self.marketplace_model.update_listing_amount(
-            payment['listing_id'],
-            payment['amount_kg_co2']
-        )
-        
-        # Increase buyer's carbon limit
-        self.user_model.increase_carbon_limit(
-            payment['buyer_id'], 
-            payment['amount_kg_co2']
-        )
-        
-        # Update payment status
-        payment_details = {}
-        if payment_reference:
-            payment_details['payment_reference'] = payment_reference
-        
-        payment = self.payment_model.update_payment_status(
-            payment_id, 'completed', payment_details
-        )
+        queued = self.payment_model.queue_settlement(payment_id, payment_reference)
+        if not queued:
+            payment = self.payment_model.get_payment_by_id(payment_id)
+            if not payment:
+                raise ValueError('Payment not found')
+            if payment['status'] != 'pending':
+                raise ValueError(f'Payment already {payment["status"]}')
+            raise ValueError(f'Payment already {payment["settlement_status"]}')
+        
+        task = get_task('settlement')
+        if task:
+            task.wake()
+            payment = self.payment_model.format_payment(queued)
+            return {
+                'success': True,
+                'message': 'Payment received, settlement queued',
+                'payment': payment,
+                'credits_received': payment['amount_kg_co2']
+            }
+        
+        payment = self.payment_model.format_payment(SettlementEngine(self.db).settle_now(queued['_id']))
+        if payment['settlement_status'] == 'failed':
+            raise ValueError(payment['settlement_error'])
+        
+        if payment['status'] == 'completed':
+            message = 'Purchase completed successfully'
+        elif payment['settlement_status'] == 'stuck':
+            message = 'Payment received, settlement is under manual review'
+        else:
+            message = 'Payment received, settlement queued'
         
         return {
             'success': True,
-            'message': 'Purchase completed successfully',
+            'message': message,
             'payment': payment,
             'credits_received': payment['amount_kg_co2']
         }
     
     def cancel_listing(self, listing_id, user_id):
-        """Cancel a user's listing"""
-        return self.marketplace_model.cancel_listing(listing_id, user_id)
+        """
+        Cancel a user's listing and release its credit reservation
+        
+        Amounts already matched by buy orders stay reserved until those
+        payments settle or are cancelled unpaid.
+        """
+        listing = self.marketplace_model.cancel_listing(listing_id, user_id)
+        listing_cache.bump()
+        order_books.remove(listing['credit_type'], listing_id)
+        self.credit_model.release_reservation(
+            ObjectId(listing_id),
+            keep_kg=self.payment_model.get_unsettled_matched_kg(listing_id)
+        )
+        return listing
     
     def get_user_listings(self, user_id):
         """Get all listings created by a user"""
         return self.marketplace_model.get_user_listings(user_id)
     
     def get_user_trades(self, user_id):
-        """Get user's trading history (buys and sells)"""
+        """
+        Get user's trading history (buys and sells)
+        
+        Purchases carry the credit type, price and (anonymized) seller of
+        their listing; the listings and sellers are fetched with one $in
+        query each, however many purchases there are.
+        """
         # Get sell listings
         sell_listings = self.marketplace_model.get_user_listings(user_id)
         
         # Get purchase payments
         purchases = self.payment_model.get_user_payments(user_id, status='completed')
         
+        listings = self.marketplace_model.get_listings_by_ids(p['listing_id'] for p in purchases)
+        self.add_sellers(list(listings.values()))
+        for purchase in purchases:
+            listing = listings.get(purchase['listing_id'])
+            if listing:
+                purchase['credit_type'] = listing['credit_type']
+                purchase['price_per_kg'] = listing['price_per_kg']
+                purchase['seller_email'] = listing.get('seller_email')
+        
         return {
             'sell_listings': sell_listings,
             'purchases': purchases
         }
     
-    def _transfer_credits(self, from_user_id, to_user_id, credit_type, amount_kg_co2):
-        """Transfer credits between users"""
-        # In a real system, this would:
-        # 1. Deduct from seller's credits
-        # 2. Add to buyer's credits
-        # For now, we'll just add to buyer
-        
-        from config import Config
-        credit_info = Config.CREDIT_TYPES.get(credit_type, {})
-        
-        self.credit_model.deduct_credits(from_user_id, amount_kg_co2)
-        
-        self.credit_model.purchase_credit(
-            to_user_id,
-            credit_type,
-            amount_kg_co2,
-            amount_kg_co2 * credit_info.get('price_per_kg', 0.15)
-        )
-    
     def _generate_upi_id(self, seller_id):
         """Generate UPI ID for seller (simulated)"""
         # In a real system, this would be the seller's actual UPI ID
@@ -228,21 +283,10 @@ class MarketplaceService:
         return self._generate_qr_code(payment_string)
     
     def _generate_qr_code(self, data):
-        """Generate QR code and return as base64 image"""
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to base64
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
+        """
+        Queue a QR code for rendering
         
-        return f"data:image/png;base64,{img_str}"
+        Returns:
+            Image digest; the PNG is served by GET /api/marketplace/qr/<digest>.png
+        """
+        return qr_renderer.submit(self.db, data)
@@ -0,0 +1,439 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import namedtuple
+from bson import ObjectId
+from config import Config
+from models.marketplace_listing import MarketplaceListing
+from models.marketplace_order import MarketplaceOrder, AMOUNT_EPSILON
+from models.payment import Payment
+from services.listing_cache import listing_cache
+from utils.transactions import run_in_transaction
+
+BUY = 'buy'
+SELL = 'sell'
+
+Fill = namedtuple('Fill', ['buy_order_id', 'sell_order_id', 'buyer_id', 'seller_id', 'price_per_kg', 'amount_kg_co2'])
+
+class Order:
+    """An order resting in (or submitted to) a book"""
+
+    __slots__ = ('order_id', 'side', 'user_id', 'price', 'remaining', 'seq')
+
+    def __init__(self, order_id, side, user_id, price, remaining, seq):
+        self.order_id = order_id
+        self.side = side
+        self.user_id = user_id
+        self.price = price
+        self.remaining = remaining
+        self.seq = seq
+
+class OrderBook:
+    """
+    Price-time priority limit order book for one credit type
+
+    Bids and asks are binary heaps keyed by (price, arrival sequence), so
+    the best order is always at the top and matching an incoming order
+    costs O(log n) per fill. Cancelled or filled orders are dropped from
+    `orders` and skipped lazily when they surface at the top of a heap.
+    Aggregate quantity per price level is kept alongside for depth
+    snapshots. Purely in-memory; callers serialize access.
+    """
+
+    def __init__(self, credit_type):
+        self.credit_type = credit_type
+        self.orders = {}
+        # (-price, seq, order): highest bid first
+        self._bids = []
+        # (price, seq, order): lowest ask first
+        self._asks = []
+        self._levels = {BUY: {}, SELL: {}}
+        self._seq = itertools.count()
+        self._dead = 0
+
+    def submit(self, order_id, side, user_id, price, amount):
+        """
+        Match an incoming limit order and rest what is left
+
+        Fills are at the resting order's price. An order never trades with
+        the same user's resting orders: on reaching one, the rest of the
+        incoming order is cancelled (self-trade prevention).
+
+        Returns:
+            (order, fills, status) where status is 'resting', 'filled' or
+            'cancelled' (self-trade) for the part not filled
+        """
+        order = Order(order_id, side, user_id, price, amount, next(self._seq))
+        fills = []
+
+        if side == BUY:
+            heap, crosses = self._asks, lambda resting: resting.price <= price
+        else:
+            heap, crosses = self._bids, lambda resting: resting.price >= price
+
+        status = 'resting'
+        while order.remaining > AMOUNT_EPSILON and heap:
+            resting = heap[0][2]
+            if self.orders.get(resting.order_id) is not resting:
+                heapq.heappop(heap)
+                continue
+            if not crosses(resting):
+                break
+            if resting.user_id == user_id:
+                status = 'cancelled'
+                break
+
+            amount = min(order.remaining, resting.remaining)
+            if side == BUY:
+                fills.append(Fill(order_id, resting.order_id, user_id, resting.user_id, resting.price, amount))
+            else:
+                fills.append(Fill(resting.order_id, order_id, resting.user_id, user_id, resting.price, amount))
+
+            order.remaining -= amount
+            resting.remaining -= amount
+            self._add_level(resting.side, resting.price, -amount)
+            if resting.remaining <= AMOUNT_EPSILON:
+                heapq.heappop(heap)
+                del self.orders[resting.order_id]
+
+        if order.remaining <= AMOUNT_EPSILON:
+            status = 'filled'
+        elif status == 'resting':
+            self._rest(order)
+        return order, fills, status
+
+    def rest(self, order_id, side, user_id, price, amount, seq=None):
+        """Add an order without matching it (recovery)"""
+        if seq is None:
+            seq = next(self._seq)
+        order = Order(order_id, side, user_id, price, amount, seq)
+        self._rest(order)
+        return order
+
+    def _rest(self, order):
+        self.orders[order.order_id] = order
+        if order.side == BUY:
+            heapq.heappush(self._bids, (-order.price, order.seq, order))
+        else:
+            heapq.heappush(self._asks, (order.price, order.seq, order))
+        self._add_level(order.side, order.price, order.remaining)
+
+    def _add_level(self, side, price, amount):
+        levels = self._levels[side]
+        total = levels.get(price, 0) + amount
+        if total <= AMOUNT_EPSILON:
+            levels.pop(price, None)
+        else:
+            levels[price] = total
+
+    def cancel(self, order_id):
+        """
+        Remove a resting order
+
+        Returns:
+            The removed order or None
+        """
+        order = self.orders.pop(order_id, None)
+        if order:
+            self._add_level(order.side, order.price, -order.remaining)
+            self._dead += 1
+            if self._dead > 1024 and self._dead > len(self.orders):
+                self._compact()
+        return order
+
+    def _compact(self):
+        """Drop cancelled entries from the heaps once they outnumber live orders"""
+        self._bids = [entry for entry in self._bids if self.orders.get(entry[2].order_id) is entry[2]]
+        self._asks = [entry for entry in self._asks if self.orders.get(entry[2].order_id) is entry[2]]
+        heapq.heapify(self._bids)
+        heapq.heapify(self._asks)
+        self._dead = 0
+
+    def set_remaining(self, order_id, remaining):
+        """Update a resting order's amount after a change made outside the book"""
+        order = self.orders.get(order_id)
+        if not order:
+            return
+        if remaining <= AMOUNT_EPSILON:
+            self.cancel(order_id)
+            return
+        self._add_level(order.side, order.price, remaining - order.remaining)
+        order.remaining = remaining
+
+    def best(self, side):
+        """Best resting price on a side, or None"""
+        heap = self._bids if side == BUY else self._asks
+        while heap and self.orders.get(heap[0][2].order_id) is not heap[0][2]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return heap[0][2].price
+
+    def depth(self, levels=10):
+        """
+        Aggregated price levels, best first
+
+        Returns:
+            {'bids': [{price_per_kg, amount_kg_co2}], 'asks': [...]}
+        """
+        bids = sorted(self._levels[BUY].items(), reverse=True)[:levels]
+        asks = sorted(self._levels[SELL].items())[:levels]
+        return {
+            'bids': [{'price_per_kg': price, 'amount_kg_co2': round(amount, 4)} for price, amount in bids],
+            'asks': [{'price_per_kg': price, 'amount_kg_co2': round(amount, 4)} for price, amount in asks]
+        }
+
+class StaleOrder(Exception):
+    """An order changed in the database behind the book's back"""
+
+class OrderBooks:
+    """
+    The marketplace's order books, one per credit type
+
+    Sell orders are the active listings (credits reserved when listed),
+    buy orders are open documents in marketplace_orders. Each book is
+    rebuilt from Mongo on first use. A submitted order is matched in
+    memory under the book's lock, then every fill is persisted in its own
+    transaction: conditional decrements of the listing and the buy order
+    plus a pending 'order_book' payment for the buyer to settle. If a
+    conditional decrement misses (the listing was bought, cancelled or
+    expired through another path or process), the book is reloaded from
+    Mongo and the rest of the order is matched again. Fills not paid for
+    by their deadline are undone by the unpaid_fills task.
+
+    Books live in this process: run the marketplace API in a single
+    worker process, or the other workers' books go stale until their
+    fills fail and force a reload.
+    """
+
+    MAX_MATCH_ATTEMPTS = 3
+
+    def __init__(self):
+        self._books = {}
+        self._locks = {credit_type: threading.Lock() for credit_type in Config.CREDIT_TYPES}
+        self._load_lock = threading.Lock()
+        self.last_load = {}
+
+    def load(self, db, credit_type=None):
+        """
+        Rebuild books from open buy orders and active listings, in arrival
+        order (resting orders are not re-matched)
+
+        Returns:
+            {credit_type: {'bids': n, 'asks': n, 'load_ms': ms}}
+        """
+        credit_types = [credit_type] if credit_type else list(Config.CREDIT_TYPES)
+        summary = {}
+
+        for ctype in credit_types:
+            started = time.perf_counter()
+            book = OrderBook(ctype)
+
+            resting = []
+            for doc in MarketplaceOrder(db).get_open_orders(ctype):
+                resting.append((doc['created_at'], BUY, str(doc['_id']), doc['user_id'],
+                                doc['price_per_kg'], doc['remaining_kg']))
+            for doc in db.marketplace_listings.find({
+                'credit_type': ctype,
+                'status': 'active',
+                'amount_kg_co2': {'$gt': AMOUNT_EPSILON}
+            }, {'seller_id': 1, 'price_per_kg': 1, 'amount_kg_co2': 1, 'created_at': 1}):
+                resting.append((doc['created_at'], SELL, str(doc['_id']), str(doc['seller_id']),
+                                doc['price_per_kg'], doc['amount_kg_co2']))
+
+            resting.sort(key=lambda r: r[0])
+            for _, side, order_id, user_id, price, amount in resting:
+                book.rest(order_id, side, user_id, price, amount)
+
+            self._books[ctype] = book
+            summary[ctype] = {
+                'bids': sum(1 for o in book.orders.values() if o.side == BUY),
+                'asks': sum(1 for o in book.orders.values() if o.side == SELL),
+                'load_ms': round((time.perf_counter() - started) * 1000, 2)
+            }
+
+        self.last_load.update(summary)
+        return summary
+
+    def _book(self, db, credit_type):
+        if credit_type not in Config.CREDIT_TYPES:
+            raise ValueError(f"Invalid credit type. Must be one of: {', '.join(Config.CREDIT_TYPES.keys())}")
+        if credit_type not in self._books:
+            with self._load_lock:
+                if credit_type not in self._books:
+                    self.load(db, credit_type)
+        return self._books[credit_type]
+
+    def submit_buy(self, db, user_id, credit_type, price_per_kg, amount_kg_co2):
+        """
+        Place a limit buy order and match it against resting listings
+
+        Returns:
+            {'order': formatted order, 'fills': [payments]}
+        """
+        self._book(db, credit_type)
+        order_model = MarketplaceOrder(db)
+        doc = order_model.create_order(user_id, credit_type, price_per_kg, amount_kg_co2)
+
+        try:
+            payments, status = self._match(db, credit_type, str(doc['_id']), BUY, user_id, price_per_kg, amount_kg_co2)
+        except Exception:
+            # The caller gets an error, so don't leave the order open behind
+            # it; fills already persisted keep their pending payments
+            try:
+                order_model.cancel_order(doc['_id'])
+            except ValueError:
+                pass
+            self.remove(credit_type, str(doc['_id']))
+            raise
+        if status == 'cancelled':
+            order_model.cancel_order(doc['_id'])
+
+        return {'order': order_model.format_order(order_model.get_order(doc['_id'])), 'fills': payments}
+
+    def submit_listing(self, db, listing):
+        """
+        Match a newly created listing (a limit sell order) against resting
+        buy orders
+
+        Returns:
+            (fills as payments, status of the unfilled part)
+        """
+        self._book(db, listing['credit_type'])
+        return self._match(
+            db, listing['credit_type'], listing['listing_id'], SELL,
+            listing['seller_id'], listing['price_per_kg'], listing['amount_kg_co2']
+        )
+
+    def _match(self, db, credit_type, order_id, side, user_id, price, amount):
+        payments = []
+        with self._locks[credit_type]:
+            for _ in range(self.MAX_MATCH_ATTEMPTS):
+                book = self._books[credit_type]
+                order, fills, status = book.submit(order_id, side, user_id, price, amount)
+                try:
+                    for fill in fills:
+                        payments.append(self._persist_fill(db, credit_type, fill))
+                    return payments, status
+                except StaleOrder:
+                    # Resync with Mongo; the order is reloaded with what its
+                    # persisted fills left, then matched again
+                    self.load(db, credit_type)
+                    book = self._books[credit_type]
+                    reloaded = book.cancel(order_id)
+                    if not reloaded:
+                        # Nothing of it is open any more
+                        return payments, 'filled'
+                    amount = reloaded.remaining
+                except Exception:
+                    # The book already took the matched liquidity out: resync
+                    # it with what Mongo holds before giving up
+                    self.load(db, credit_type)
+                    raise
+            print(f"[ORDER_BOOK] {credit_type} order {order_id} left resting after {self.MAX_MATCH_ATTEMPTS} stale matches")
+            self._books[credit_type].rest(order_id, side, user_id, price, amount)
+            return payments, 'resting'
+
+    def _persist_fill(self, db, credit_type, fill):
+        """
+        Record one fill: listing and buy order decremented, pending
+        payment created
+
+        Raises:
+            StaleOrder: The listing or order no longer had the amount open
+        """
+        listing_model = MarketplaceListing(db)
+        order_model = MarketplaceOrder(db)
+        payment_model = Payment(db)
+        listing_oid = ObjectId(fill.sell_order_id)
+        order_oid = ObjectId(fill.buy_order_id)
+
+        def write(session):
+            if not listing_model.apply_fill(listing_oid, fill.amount_kg_co2, fill.price_per_kg, session):
+                raise StaleOrder(fill.sell_order_id)
+            if not order_model.apply_fill(order_oid, fill.amount_kg_co2, session):
+                if session is None:
+                    listing_model.revert_fill(listing_oid, fill.amount_kg_co2, fill.price_per_kg)
+                raise StaleOrder(fill.buy_order_id)
+            try:
+                return payment_model.create_payment(
+                    fill.buyer_id,
+                    fill.sell_order_id,
+                    fill.amount_kg_co2,
+                    fill.amount_kg_co2 * fill.price_per_kg,
+                    'order_book',
+                    order_id=fill.buy_order_id,
+                    session=session
+                )
+            except Exception:
+                if session is None:
+                    listing_model.revert_fill(listing_oid, fill.amount_kg_co2, fill.price_per_kg)
+                    order_model.revert_fill(order_oid, fill.amount_kg_co2)
+                raise
+
+        payment = run_in_transaction(db.client, write)
+        listing_cache.bump()
+        payment['credit_type'] = credit_type
+        payment['price_per_kg'] = fill.price_per_kg
+        return payment
+
+    def cancel(self, db, order_id, user_id):
+        """
+        Cancel a buy order or a listing (sell order)
+
+        Returns:
+            {'order': ...} or {'listing': ...}
+        """
+        order_model = MarketplaceOrder(db)
+        doc = order_model.get_order(order_id) if ObjectId.is_valid(order_id) else None
+        if doc is None:
+            # Not a buy order: cancel the listing (releases its reservation)
+            from services.marketplace_service import MarketplaceService
+            return {'listing': MarketplaceService(db).cancel_listing(order_id, user_id)}
+
+        with self._locks[doc['credit_type']]:
+            cancelled = order_model.cancel_order(order_id, user_id)
+            book = self._books.get(doc['credit_type'])
+            if book is not None:
+                book.cancel(order_id)
+        return {'order': order_model.format_order(cancelled)}
+
+    def remove(self, credit_type, order_id):
+        """Drop an order from its book (cancelled, sold or expired elsewhere)"""
+        book = self._books.get(credit_type)
+        if book is None:
+            return
+        with self._locks[credit_type]:
+            book.cancel(order_id)
+
+    def reload(self, db, credit_type):
+        """Rebuild one book from Mongo (orders changed outside the book)"""
+        with self._locks[credit_type]:
+            return self.load(db, credit_type)
+
+    def update_remaining(self, credit_type, order_id, remaining):
+        """Sync a listing's amount after a sale outside the book"""
+        book = self._books.get(credit_type)
+        if book is None:
+            return
+        with self._locks[credit_type]:
+            book.set_remaining(order_id, remaining)
+
+    def get_depth(self, db, credit_type, levels=10):
+        """Aggregated depth snapshot of one book"""
+        book = self._book(db, credit_type)
+        levels = max(1, min(levels, Config.ORDER_BOOK_MAX_DEPTH))
+        with self._locks[credit_type]:
+            depth = book.depth(levels)
+            best_bid = book.best(BUY)
+            best_ask = book.best(SELL)
+        return {
+            'credit_type': credit_type,
+            'best_bid': best_bid,
+            'best_ask': best_ask,
+            'spread': round(best_ask - best_bid, 4) if best_bid is not None and best_ask is not None else None,
+            **depth
+        }
+
+order_books = OrderBooks()
@@ -0,0 +1,93 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import qrcode
+from config import Config
+from models.qr_code import QRCodeImage
+
+def render_qr_png(data):
+    """Render a QR code as PNG bytes"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+class QRRenderer:
+    """
+    Renders payment QR codes on a small background thread pool
+
+    initiate_purchase only registers the payload and gets back its digest;
+    the PNG is rendered off the request thread and stored in qr_codes.
+    Payloads already known are never rendered twice. A request for an
+    image that is not ready waits for the render in flight, or renders it
+    inline if this worker never scheduled it (e.g. after a restart).
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='qr-render'
+        )
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, db, payload):
+        """
+        Schedule rendering of a payload
+
+        Returns:
+            Digest identifying the image
+        """
+        model = QRCodeImage(db, Config.QR_CODE_RETENTION_DAYS)
+        digest, created = model.register(payload)
+        if created:
+            with self._lock:
+                self._in_flight[digest] = self._executor.submit(self._render, model, digest, payload)
+        return digest
+
+    def _render(self, model, digest, payload):
+        try:
+            png = render_qr_png(payload)
+            model.store_image(digest, png)
+            return png
+        finally:
+            with self._lock:
+                self._in_flight.pop(digest, None)
+
+    def get_png(self, db, digest, timeout=None):
+        """
+        Get the PNG bytes of a QR code
+
+        Returns:
+            PNG bytes, or None if the digest is unknown
+        """
+        if timeout is None:
+            timeout = Config.QR_RENDER_TIMEOUT_SECONDS
+
+        model = QRCodeImage(db, Config.QR_CODE_RETENTION_DAYS)
+        doc = model.get(digest)
+        if not doc:
+            return None
+        if doc.get('image'):
+            return bytes(doc['image'])
+
+        with self._lock:
+            future = self._in_flight.get(digest)
+        if future:
+            return future.result(timeout=timeout)
+
+        png = render_qr_png(doc['payload'])
+        model.store_image(digest, png)
+        return png
+
+# Shared by all requests of this worker process
+qr_renderer = QRRenderer(Config.QR_RENDER_WORKERS)
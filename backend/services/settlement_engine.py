@@ -0,0 +1,411 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import UpdateOne
+from config import Config
+from models.credit import Credit, LotConflict
+from models.marketplace_listing import MarketplaceListing
+from models.marketplace_order import AMOUNT_EPSILON
+from models.payment import Payment
+from models.status_snapshot import StatusSnapshot
+from models.user import User
+from services.forecast_cache import forecast_cache
+from services.order_book import order_books
+from services.listing_cache import listing_cache
+from services.market_data import candle_tail
+from utils.transactions import run_in_transaction, supports_transactions
+
+MAX_SETTLE_ATTEMPTS = 3
+
+class SettlementConflict(Exception):
+    """A listing or payment changed while its batch was being settled"""
+
+class SettlementEngine:
+    """
+    Settles paid marketplace payments in batches
+
+    Completing a payment only queues it (settlement_status 'queued'). A
+    run claims queued payments a batch at a time by stamping them with a
+    claim id ('settling'), then applies the whole batch in one
+    transaction: listing amounts (one pipeline update per listing),
+    seller reservations, balances and lots, buyer lots, the ledger and
+    buyer carbon limits are written with bulk writes grouped by listing,
+    seller and buyer, and the payments are marked settled only if they
+    still carry the claim id. A batch is therefore applied exactly once
+    or not at all; claims left behind by a crashed worker are re-queued
+    after SETTLEMENT_LEASE_SECONDS.
+
+    Without transactions (standalone server) payments are settled one at
+    a time through the single-sale paths, and an expired claim, or one
+    that failed after the seller's credits moved, is marked 'stuck' for
+    manual review instead of being re-applied.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.payment_model = Payment(db)
+        self.payments = self.payment_model.collection
+        self.listing_model = MarketplaceListing(db)
+        self.credit_model = Credit(db)
+        self.users = db.users
+        self.conflicts = 0
+
+    def _transactional(self):
+        return supports_transactions(self.db.client)
+
+    def run(self, batch_size=None, max_batches=None):
+        """
+        Drain queued payments
+
+        Returns:
+            Run metrics, including settlements per second
+        """
+        batch_size = batch_size or Config.SETTLEMENT_BATCH_SIZE
+        max_batches = max_batches or Config.SETTLEMENT_MAX_BATCHES
+        started = time.perf_counter()
+        requeued, stuck = self._recover_expired_claims()
+        metrics = {'batches': 0, 'settled': 0, 'failed': 0, 'requeued': requeued, 'stuck': stuck}
+
+        for _ in range(max_batches):
+            payments = self._claim(batch_size)
+            if not payments:
+                break
+
+            settled, failed = self.settle(payments)
+            metrics['batches'] += 1
+            metrics['settled'] += settled
+            metrics['failed'] += failed
+
+            if len(payments) < batch_size:
+                break
+
+        elapsed = time.perf_counter() - started
+        metrics['conflicts'] = self.conflicts
+        metrics['duration_ms'] = round(elapsed * 1000, 2)
+        metrics['settlements_per_sec'] = round(metrics['settled'] / elapsed, 1) if metrics['settled'] else 0.0
+
+        if metrics['settled'] or metrics['failed']:
+            print(f"[SETTLEMENT] Settled {metrics['settled']} payments ({metrics['failed']} failed) in "
+                  f"{metrics['batches']} batches, {metrics['settlements_per_sec']} settlements/s")
+        if stuck:
+            print(f"[SETTLEMENT] {stuck} payments stuck mid-settlement need review")
+        return metrics
+
+    def settle_now(self, payment_oid):
+        """
+        Settle one queued payment on the calling thread
+
+        Returns:
+            Payment document afterwards
+        """
+        payments = self._claim(1, [payment_oid])
+        if payments:
+            self.settle(payments)
+        return self.payments.find_one({'_id': payment_oid})
+
+    def _claim(self, limit, payment_oids=None):
+        """Claim up to `limit` queued payments, oldest paid first"""
+        query = {'settlement_status': 'queued'}
+        if payment_oids is not None:
+            query['_id'] = {'$in': payment_oids}
+        oids = [p['_id'] for p in self.payments.find(query, {'_id': 1}).sort('paid_at', 1).limit(limit)]
+        if not oids:
+            return []
+
+        claim_id = uuid.uuid4().hex
+        self.payments.update_many(
+            {'_id': {'$in': oids}, 'settlement_status': 'queued'},
+            {'$set': {'settlement_status': 'settling', 'settlement_id': claim_id, 'claimed_at': datetime.utcnow()}}
+        )
+        # Payments claimed by another worker in between are left out
+        return list(self.payments.find({'_id': {'$in': oids}, 'settlement_id': claim_id, 'settlement_status': 'settling'}))
+
+    def _release(self, payments):
+        """Put claimed payments back in the queue"""
+        self.payments.bulk_write([
+            UpdateOne(
+                {'_id': p['_id'], 'settlement_id': p['settlement_id'], 'settlement_status': 'settling'},
+                {'$set': {'settlement_status': 'queued'}, '$unset': {'settlement_id': '', 'claimed_at': ''}}
+            )
+            for p in payments
+        ], ordered=False)
+
+    def _recover_expired_claims(self):
+        """
+        Handle claims whose worker died
+
+        Returns:
+            (re-queued, marked stuck)
+        """
+        query = {
+            'settlement_status': 'settling',
+            'claimed_at': {'$lt': datetime.utcnow() - timedelta(seconds=Config.SETTLEMENT_LEASE_SECONDS)}
+        }
+        if self._transactional():
+            # The batch's transaction never committed, so nothing was applied
+            result = self.payments.update_many(
+                query, {'$set': {'settlement_status': 'queued'}, '$unset': {'settlement_id': '', 'claimed_at': ''}}
+            )
+            return result.modified_count, 0
+
+        result = self.payments.update_many(query, {'$set': {'settlement_status': 'stuck'}})
+        return 0, result.modified_count
+
+    def _finish(self, payment, error=None, claim_status='settling'):
+        """Update a claimed payment as settled or failed"""
+        now = datetime.utcnow()
+        if error is None:
+            update = {'status': 'completed', 'completed_at': now, 'settlement_status': 'settled', 'settled_at': now}
+        else:
+            update = {'status': 'failed', 'failed_at': now, 'settlement_status': 'failed', 'settlement_error': error}
+        return UpdateOne(
+            {'_id': payment['_id'], 'settlement_id': payment['settlement_id'], 'settlement_status': claim_status},
+            {'$set': update}
+        )
+
+    def _claim_filter(self, payment):
+        return {'_id': payment['_id'], 'settlement_id': payment['settlement_id'], 'settlement_status': 'settling'}
+
+    def settle(self, payments):
+        """
+        Settle claimed payments
+
+        A batch that keeps conflicting or fails is split into single
+        payments, so one bad payment doesn't hold up the rest.
+
+        Returns:
+            (settled, failed)
+        """
+        if not self._transactional():
+            return self._settle_sequential(payments)
+
+        self._prepare(payments)
+        outcome = None
+        for _ in range(MAX_SETTLE_ATTEMPTS):
+            try:
+                outcome = run_in_transaction(self.db.client, lambda session: self._apply_batch(session, payments))
+                break
+            except (LotConflict, SettlementConflict):
+                self.conflicts += 1
+            except Exception as e:
+                if len(payments) == 1:
+                    print(f"[SETTLEMENT] Payment {payments[0]['_id']} failed: {type(e).__name__}: {e}")
+                    self.payments.bulk_write([self._finish(payments[0], str(e))])
+                    return 0, 1
+                break
+
+        if outcome is None:
+            if len(payments) == 1:
+                # Still conflicting: leave it for the next run
+                self._release(payments)
+                return 0, 0
+            settled = failed = 0
+            for payment in payments:
+                one_settled, one_failed = self.settle([payment])
+                settled += one_settled
+                failed += one_failed
+            return settled, failed
+
+        self._after_commit(outcome)
+        return len(outcome['settled']), len(outcome['failed'])
+
+    def _prepare(self, payments):
+        """Bring the balances of everyone involved up to date (outside the transaction)"""
+        listing_oids = list({ObjectId(p['listing_id']) for p in payments})
+        sellers = {
+            ObjectId(listing['seller_id'])
+            for listing in self.listing_model.collection.find({'_id': {'$in': listing_oids}}, {'seller_id': 1})
+        }
+        for seller_oid in sellers:
+            # Expires the seller's due lots before any are consumed
+            self.credit_model.get_balance(seller_oid)
+        self.credit_model.ensure_balances(ObjectId(p['buyer_id']) for p in payments)
+
+    def _apply_batch(self, session, payments):
+        """Apply a batch of claimed payments inside one transaction"""
+        listing_oids = list({ObjectId(p['listing_id']) for p in payments})
+        listings = {
+            listing['_id']: listing
+            for listing in self.listing_model.collection.find({'_id': {'$in': listing_oids}}, session=session)
+        }
+        reserved = {
+            reservation['_id']: reservation['amount_kg_co2']
+            for reservation in self.credit_model.reservations.find(
+                {'_id': {'$in': listing_oids}, 'status': 'pending'}, session=session
+            )
+        }
+        available = {
+            oid: listing['amount_kg_co2'] if listing['status'] == 'active' else 0
+            for oid, listing in listings.items()
+        }
+
+        settled, failed, transfers = [], [], []
+        taken = {}
+        limits = {}
+        for payment in sorted(payments, key=lambda p: p['created_at']):
+            listing_oid = ObjectId(payment['listing_id'])
+            listing = listings.get(listing_oid)
+            amount = payment['amount_kg_co2']
+            # Order book fills took their amount off the listing when they matched
+            direct = not payment.get('order_id')
+
+            if not listing:
+                failed.append((payment, 'Listing not found'))
+                continue
+            if direct and available[listing_oid] < amount - AMOUNT_EPSILON:
+                failed.append((payment, 'Listing is not active' if listing['status'] != 'active' else
+                               f'Insufficient amount available. Available: {round(available[listing_oid], 2)} kg'))
+                continue
+            if reserved.get(listing_oid, 0) < amount - AMOUNT_EPSILON:
+                failed.append((payment, "Seller's credits for this listing are no longer reserved"))
+                continue
+
+            if direct:
+                available[listing_oid] -= amount
+                taken[listing_oid] = taken.get(listing_oid, 0) + amount
+            reserved[listing_oid] -= amount
+            buyer_oid = ObjectId(payment['buyer_id'])
+            limits[buyer_oid] = limits.get(buyer_oid, 0) + amount
+            transfers.append({
+                'seller_oid': ObjectId(listing['seller_id']),
+                'buyer_oid': buyer_oid,
+                'reservation_id': listing_oid,
+                'credit_type': listing['credit_type'],
+                'amount_kg_co2': amount,
+                'reference': payment['transaction_id']
+            })
+            settled.append(payment)
+
+        # The claim guard goes first: a payment re-claimed elsewhere aborts the batch
+        operations = [self._finish(p) for p in settled] + [self._finish(p, error) for p, error in failed]
+        result = self.payments.bulk_write(operations, ordered=False, session=session)
+        if result.matched_count != len(operations):
+            raise SettlementConflict('Payment claimed by another settlement run')
+
+        if taken:
+            result = self.listing_model.collection.bulk_write(
+                [UpdateOne(*self.listing_model.take_update(oid, amount)) for oid, amount in taken.items()],
+                ordered=False,
+                session=session
+            )
+            if result.matched_count != len(taken):
+                raise SettlementConflict('Listing changed during settlement')
+
+        if transfers:
+            # In the same transaction, so a snapshot rebuild sees all or none of it
+            StatusSnapshot(self.db).record_credit_changes(self.credit_model.transfer_batch(session, transfers), session)
+
+        if limits:
+            self.users.bulk_write([
+                UpdateOne({'_id': buyer_oid}, {'$inc': {
+                    'household.annual_carbon_limit_kg': amount,
+                    'household.purchased_limit_kg': amount
+                }})
+                for buyer_oid, amount in limits.items()
+            ], ordered=False, session=session)
+
+        return {
+            'settled': settled,
+            'failed': failed,
+            'taken': {oid: (listings[oid], amount) for oid, amount in taken.items()},
+            'buyers': list(limits),
+            'trades': [
+                (listings[ObjectId(p['listing_id'])]['credit_type'], p['total_amount'] / p['amount_kg_co2'], p['amount_kg_co2'])
+                for p in settled
+            ]
+        }
+
+    def _after_commit(self, outcome):
+        """Derived state updated once the batch is committed"""
+        for buyer_id in outcome['buyers']:
+            forecast_cache.invalidate(buyer_id)
+        self._record_trades(outcome['trades'])
+        if outcome['taken']:
+            listing_cache.bump()
+        for listing_oid, (listing, amount) in outcome['taken'].items():
+            remaining = listing['amount_kg_co2'] - amount
+            order_books.update_remaining(
+                listing['credit_type'], str(listing_oid), remaining if remaining > AMOUNT_EPSILON else 0.0
+            )
+
+    def _record_trades(self, trades):
+        """Update the OHLCV candles; a failure there never fails a settlement"""
+        if not trades:
+            return
+        settled_at = datetime.utcnow()
+        try:
+            candle_tail.record(self.db, [trade + (settled_at,) for trade in trades])
+        except Exception as e:
+            print(f"[SETTLEMENT] Candle update failed: {type(e).__name__}: {e}")
+
+    def _settle_sequential(self, payments):
+        """
+        Standalone-server fallback: settle claimed payments one by one
+
+        A payment whose settlement raised before the seller's credits moved
+        has had nothing applied and is marked failed; one that raised
+        afterwards was already marked 'stuck' by _settle_one.
+        """
+        settled = failed = 0
+        for payment in payments:
+            try:
+                self._settle_one(payment)
+                settled += 1
+            except LotConflict:
+                self.conflicts += 1
+                self._release([payment])
+            except SettlementConflict as e:
+                print(f"[SETTLEMENT] Payment {payment['_id']} skipped: {e}")
+            except Exception as e:
+                if not isinstance(e, ValueError):
+                    print(f"[SETTLEMENT] Payment {payment['_id']} failed: {type(e).__name__}: {e}")
+                failed += self.payments.bulk_write([self._finish(payment, str(e))]).matched_count
+        return settled, failed
+
+    def _settle_one(self, payment):
+        # Renew the lease, so a long run isn't marked 'stuck' under us
+        renewed = self.payments.update_one(self._claim_filter(payment), {'$set': {'claimed_at': datetime.utcnow()}})
+        if not renewed.matched_count:
+            raise SettlementConflict('Claim expired before settlement')
+
+        listing_oid = ObjectId(payment['listing_id'])
+        listing = self.listing_model.collection.find_one({'_id': listing_oid})
+        if not listing:
+            raise ValueError('Listing not found')
+        amount = payment['amount_kg_co2']
+
+        direct = not payment.get('order_id')
+        if direct:
+            listing = self.listing_model.update_listing_amount(payment['listing_id'], amount)
+
+        # Credits come out of the listing's reservation
+        try:
+            self.credit_model.deduct_credits(
+                listing['seller_id'], amount, reference=payment['transaction_id'], reservation_id=listing_oid
+            )
+        except Exception:
+            if direct:
+                self.listing_model.revert_fill(listing_oid, amount, listing['price_per_kg'])
+            raise
+
+        try:
+            self.credit_model.purchase_credit(payment['buyer_id'], listing['credit_type'], amount)
+            User(self.db).increase_carbon_limit(payment['buyer_id'], amount)
+        except Exception as e:
+            # The seller's credits already moved: leave it for manual review
+            self.payments.update_one(
+                self._claim_filter(payment),
+                {'$set': {'settlement_status': 'stuck', 'settlement_error': str(e)}}
+            )
+            raise
+
+        if not self.payments.bulk_write([self._finish(payment)]).matched_count:
+            # Marked 'stuck' by lease recovery while it was being applied
+            if not self.payments.bulk_write([self._finish(payment, claim_status='stuck')]).matched_count:
+                print(f"[SETTLEMENT] Payment {payment['_id']} settled but its claim was taken over")
+        self._record_trades([(listing['credit_type'], payment['total_amount'] / amount, amount)])
+
+        if direct:
+            listing_cache.bump()
+            order_books.update_remaining(listing['credit_type'], listing['listing_id'], listing['amount_kg_co2'])
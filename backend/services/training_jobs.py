@@ -0,0 +1,133 @@
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from config import Config
+
+class TrainingQueueFull(Exception):
+    """Raised when the training queue is at capacity"""
+    pass
+
+class TrainingJobManager:
+    """
+    Runs model training on a bounded background executor
+
+    Training used to run inside the request thread; a slow Mongo fetch
+    then held a Flask worker hostage. Jobs are now queued on a small
+    thread pool and polled by ID. Concurrent submissions for the same
+    user are deduplicated onto the job already in flight.
+    """
+
+    def __init__(self, max_workers=2, max_queued=50, max_finished=500):
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='training'
+        )
+        self._jobs = OrderedDict()
+        self._active_by_user = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, train_fn):
+        """
+        Submit a training job for a user
+
+        Args:
+            user_id: User ID (used for deduplication)
+            train_fn: Callable returning the training result dict
+
+        Returns:
+            (job, created) - created is False if an active job was reused
+        """
+        with self._lock:
+            active_id = self._active_by_user.get(user_id)
+            if active_id:
+                return self._public(self._jobs[active_id]), False
+
+            if self._queue_depth() >= self.max_queued:
+                raise TrainingQueueFull('Training queue is full, try again later')
+
+            job = {
+                'job_id': uuid.uuid4().hex,
+                'user_id': user_id,
+                'status': 'queued',
+                'submitted_at': datetime.utcnow(),
+                'started_at': None,
+                'finished_at': None,
+                'result': None,
+                'error': None
+            }
+            self._jobs[job['job_id']] = job
+            self._active_by_user[user_id] = job['job_id']
+
+        self._executor.submit(self._run, job['job_id'], train_fn)
+        return self._public(job), True
+
+    def get_job(self, job_id):
+        """Get a job's public view or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job else None
+
+    def stats(self):
+        """Queue metrics"""
+        with self._lock:
+            running = sum(1 for j in self._jobs.values() if j['status'] == 'running')
+            return {
+                'queue_depth': self._queue_depth(),
+                'running': running,
+                'max_queued': self.max_queued,
+                'tracked_jobs': len(self._jobs)
+            }
+
+    def _run(self, job_id, train_fn):
+        with self._lock:
+            job = self._jobs[job_id]
+            job['status'] = 'running'
+            job['started_at'] = datetime.utcnow()
+
+        try:
+            result = train_fn()
+            status, error = 'completed', None
+        except Exception as e:
+            print(f"[TRAINING] Job {job_id} failed: {type(e).__name__}: {e}")
+            result, status, error = None, 'failed', str(e)
+
+        with self._lock:
+            job['status'] = status
+            job['result'] = result
+            job['error'] = error
+            job['finished_at'] = datetime.utcnow()
+            if self._active_by_user.get(job['user_id']) == job_id:
+                del self._active_by_user[job['user_id']]
+            self._prune()
+
+    def _queue_depth(self):
+        return sum(1 for j in self._jobs.values() if j['status'] == 'queued')
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond max_finished"""
+        finished = [jid for jid, j in self._jobs.items()
+                    if j['status'] in ('completed', 'failed')]
+        for jid in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[jid]
+
+    def _public(self, job):
+        return {
+            'job_id': job['job_id'],
+            'user_id': job['user_id'],
+            'status': job['status'],
+            'submitted_at': job['submitted_at'].isoformat(),
+            'started_at': job['started_at'].isoformat() if job['started_at'] else None,
+            'finished_at': job['finished_at'].isoformat() if job['finished_at'] else None,
+            'result': job['result'],
+            'error': job['error']
+        }
+
+# Shared instance used by the predictions routes
+training_jobs = TrainingJobManager(
+    max_workers=Config.TRAINING_WORKERS,
+    max_queued=Config.TRAINING_MAX_QUEUED
+)
@@ -0,0 +1,93 @@
+import time
+from datetime import datetime
+from bson import ObjectId
+from config import Config
+from models.credit import Credit
+from models.marketplace_listing import MarketplaceListing
+from models.marketplace_order import MarketplaceOrder
+from models.payment import Payment
+from services.listing_cache import listing_cache
+from services.order_book import order_books
+from utils.transactions import run_in_transaction
+
+class UnpaidFillSweeper:
+    """
+    Cancels order book fills that weren't paid for by their deadline
+
+    A match takes the amount off the listing and the buy order at once
+    and leaves a pending payment with a 'pay_by' deadline. Past it, the
+    payment is cancelled (conditionally, so a payment arriving at the
+    same moment wins or loses cleanly), the amount goes back on the
+    listing and the buyer's order is closed. If the listing was
+    cancelled or expired meanwhile, the amount is released from the
+    seller's reservation instead. Affected books are reloaded from Mongo.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.payment_model = Payment(db)
+        self.listing_model = MarketplaceListing(db)
+        self.order_model = MarketplaceOrder(db)
+        self.credit_model = Credit(db)
+
+    def sweep(self):
+        """
+        Cancel overdue unpaid fills
+
+        Returns:
+            Sweep metrics
+        """
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        metrics = {'fills_cancelled': 0, 'kg_returned': 0.0, 'kg_released': 0.0}
+
+        due = self.payment_model.get_unpaid_fills(now, Config.UNPAID_FILL_SWEEP_BATCH)
+        listings = self.listing_model.get_listings_by_ids(p['listing_id'] for p in due)
+        credit_types = set()
+
+        for payment in due:
+            returned = run_in_transaction(self.db.client, lambda session: self._cancel(session, payment, now))
+            if returned is None:
+                # Paid meanwhile
+                continue
+
+            metrics['fills_cancelled'] += 1
+            listing = listings.get(str(payment['listing_id']))
+            if listing:
+                credit_types.add(listing['credit_type'])
+            if returned:
+                metrics['kg_returned'] += payment['amount_kg_co2']
+            else:
+                # Listing closed: its reservation only has to keep what is still matched
+                metrics['kg_released'] += self.credit_model.release_reservation(
+                    ObjectId(payment['listing_id']),
+                    keep_kg=self.payment_model.get_unsettled_matched_kg(payment['listing_id'])
+                )
+
+        if metrics['fills_cancelled']:
+            listing_cache.bump()
+            for credit_type in credit_types:
+                order_books.reload(self.db, credit_type)
+
+        metrics['kg_returned'] = round(metrics['kg_returned'], 2)
+        metrics['kg_released'] = round(metrics['kg_released'], 2)
+        metrics['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        if metrics['fills_cancelled']:
+            print(f"[UNPAID_FILLS] Cancelled {metrics['fills_cancelled']} unpaid fills "
+                  f"({metrics['kg_returned']} kg back on listings) in {metrics['duration_ms']} ms")
+        return metrics
+
+    def _cancel(self, session, payment, now):
+        """
+        Cancel one fill
+
+        Returns:
+            None if it was paid meanwhile, else whether the listing took
+            the amount back
+        """
+        if not self.payment_model.cancel_unpaid(payment['_id'], now, session):
+            return None
+        amount = payment['amount_kg_co2']
+        returned = self.listing_model.return_unpaid_fill(ObjectId(payment['listing_id']), amount, session)
+        self.order_model.drop_unpaid_fill(ObjectId(payment['order_id']), amount, now, session)
+        return returned
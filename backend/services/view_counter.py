@@ -0,0 +1,108 @@
+import threading
+from config import Config
+
+class ViewCounter:
+    """
+    In-process buffer of marketplace listing view increments
+
+    Listing detail reads only bump a counter in memory; a background task
+    flushes the counts as one bulk_write of $inc operations. Counts are
+    best-effort: views buffered in a worker that exits, or dropped when
+    the buffer is full or a flush fails, are lost rather than retried
+    forever. The stored `views` field still means total detail views,
+    just up to one flush interval behind.
+    """
+
+    def __init__(self, max_listings=50000):
+        self.max_listings = max_listings
+        self._counts = {}
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+
+    def record(self, listing_id):
+        """
+        Count one view of a listing
+
+        Returns:
+            False if the view was dropped because the buffer is full
+        """
+        listing_id = str(listing_id)
+        with self._lock:
+            if listing_id not in self._counts and len(self._counts) >= self.max_listings:
+                self.dropped += 1
+                return False
+            self._counts[listing_id] = self._counts.get(listing_id, 0) + 1
+            self.recorded += 1
+            return True
+
+    def pending(self, listing_id):
+        """Views of a listing not yet written to Mongo"""
+        with self._lock:
+            return self._counts.get(str(listing_id), 0)
+
+    def _take(self, limit):
+        """Remove and return up to `limit` buffered counts"""
+        with self._lock:
+            if len(self._counts) <= limit:
+                batch, self._counts = self._counts, {}
+                return batch
+            batch = {}
+            for listing_id in list(self._counts)[:limit]:
+                batch[listing_id] = self._counts.pop(listing_id)
+            return batch
+
+    def _restore(self, batch):
+        """Put back the counts of a failed flush, as far as there is room"""
+        lost = 0
+        with self._lock:
+            for listing_id, count in batch.items():
+                if listing_id in self._counts or len(self._counts) < self.max_listings:
+                    self._counts[listing_id] = self._counts.get(listing_id, 0) + count
+                else:
+                    lost += count
+            self.dropped += lost
+        return lost
+
+    def flush(self, listing_model, max_listings=None):
+        """
+        Write buffered views with one bulk_write
+
+        At most max_listings listings are written per call; the rest stay
+        buffered for the next run. A failed batch is merged back once and
+        then retried with the next flush.
+
+        Args:
+            listing_model: MarketplaceListing model
+            max_listings: Listings per flush (defaults to VIEW_FLUSH_MAX_LISTINGS)
+
+        Returns:
+            Flush statistics
+        """
+        if max_listings is None:
+            max_listings = Config.VIEW_FLUSH_MAX_LISTINGS
+
+        batch = self._take(max_listings)
+        views = sum(batch.values())
+        if batch:
+            try:
+                listing_model.add_views(batch)
+            except Exception:
+                lost = self._restore(batch)
+                print(f"[VIEW_FLUSH] Flush of {len(batch)} listings failed ({lost} views dropped)")
+                raise
+            with self._lock:
+                self.flushed += views
+
+        with self._lock:
+            buffered = len(self._counts)
+        return {
+            'listings': len(batch),
+            'views': views,
+            'buffered_listings': buffered,
+            'dropped_total': self.dropped
+        }
+
+# Shared by all requests of this worker process
+view_counter = ViewCounter(Config.VIEW_BUFFER_MAX_LISTINGS)
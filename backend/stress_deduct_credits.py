@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for Credit.deduct_credits
+
+Many threads sell from one user at once; demand exceeds the user's
+credits. Checks that nothing is over-deducted and that the balance,
+the ledger and the lots agree afterwards. Uses (and drops) a scratch
+database on the configured server.
+
+Usage:
+    python stress_deduct_credits.py --threads 32 --sales 400
+"""
+
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo import MongoClient
+from config import Config
+from models.credit import Credit, LotConflict, BALANCE_EPSILON
+from utils.transactions import supports_transactions
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress concurrent credit deductions')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--sales', type=int, default=400)
+    parser.add_argument('--amount', type=float, default=7.5, help='kg CO2 per sale')
+    parser.add_argument('--lots', type=int, default=40)
+    parser.add_argument('--lot-size', type=float, default=25.0)
+    parser.add_argument('--db', default='carbon_stress_test', help='Scratch database (dropped)')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    client.drop_database(args.db)
+    db = client[args.db]
+    credit_model = Credit(db)
+
+    user_id = str(ObjectId())
+    for _ in range(args.lots):
+        credit_model.purchase_credit(user_id, 'solar', args.lot_size)
+    initial = args.lots * args.lot_size
+
+    print(f"Transactions: {'yes' if supports_transactions(client) else 'no (standalone fallback)'}")
+    print(f"Initial: {initial:.2f} kg in {args.lots} lots; {args.sales} sales of {args.amount} kg on {args.threads} threads")
+
+    def sell(_):
+        try:
+            Credit(db).deduct_credits(user_id, args.amount)
+            return 'ok'
+        except ValueError:
+            return 'insufficient'
+        except LotConflict:
+            return 'conflict'
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        outcomes = list(pool.map(sell, range(args.sales)))
+
+    succeeded = outcomes.count('ok')
+    deducted = succeeded * args.amount
+    balance = credit_model.balances.find_one({'_id': ObjectId(user_id)})['available_kg']
+    ledger = sum(t['amount_kg_co2'] for t in credit_model.transactions.find({'user_id': ObjectId(user_id)}))
+    lots = sum(l['amount_kg_co2'] for l in credit_model.collection.find({'user_id': ObjectId(user_id), 'status': 'active'}))
+
+    print(f"Succeeded: {succeeded}, insufficient: {outcomes.count('insufficient')}, conflicts: {outcomes.count('conflict')}")
+    print(f"Deducted: {deducted:.2f} kg, balance: {balance:.4f}, ledger: {ledger:.4f}, active lots: {lots:.4f}")
+
+    checks = {
+        'no over-deduction': deducted <= initial + BALANCE_EPSILON,
+        'balance matches deductions': abs(balance - (initial - deducted)) < 1e-4,
+        'ledger matches balance': abs(ledger - balance) < 1e-4,
+        'lots match balance': abs(lots - balance) < 1e-4,
+        'balance non-negative': balance >= -BALANCE_EPSILON
+    }
+    for name, passed in checks.items():
+        print(f"  {'✅' if passed else '❌'} {name}")
+
+    client.drop_database(args.db)
+    sys.exit(0 if all(checks.values()) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for MarketplaceListing.update_listing_amount
+
+Many threads buy from one listing at once; demand exceeds what is
+listed. Checks that the listing is never oversold, that the amount and
+sold amount add up afterwards, and that the listing is marked sold
+exactly when it runs out. Uses (and drops) a scratch database on the
+configured server.
+
+Usage:
+    python stress_listing_purchases.py --threads 32 --buyers 400
+"""
+
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo import MongoClient
+from config import Config
+from models.marketplace_listing import MarketplaceListing
+from models.marketplace_order import AMOUNT_EPSILON
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress concurrent purchases from one listing')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--buyers', type=int, default=400)
+    parser.add_argument('--amount', type=float, default=2.5, help='kg CO2 per purchase')
+    parser.add_argument('--listed', type=float, default=500.0, help='kg CO2 listed')
+    parser.add_argument('--db', default='carbon_stress_test', help='Scratch database (dropped)')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    client.drop_database(args.db)
+    db = client[args.db]
+    listing_model = MarketplaceListing(db)
+
+    listing = listing_model.create_listing(str(ObjectId()), 'solar', args.listed, 10.0)
+    listing_id = listing['listing_id']
+
+    print(f"Listed: {args.listed:.2f} kg; {args.buyers} purchases of {args.amount} kg on {args.threads} threads")
+
+    def buy(_):
+        try:
+            MarketplaceListing(db).update_listing_amount(listing_id, args.amount)
+            return 'ok'
+        except ValueError:
+            return 'rejected'
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        outcomes = list(pool.map(buy, range(args.buyers)))
+
+    succeeded = outcomes.count('ok')
+    bought = succeeded * args.amount
+    doc = listing_model.collection.find_one({'_id': ObjectId(listing_id)})
+    expected_sales = min(args.buyers, int((args.listed + AMOUNT_EPSILON) // args.amount))
+
+    print(f"Succeeded: {succeeded}, rejected: {outcomes.count('rejected')}")
+    print(f"Bought: {bought:.2f} kg, left: {doc['amount_kg_co2']:.4f}, sold_amount: {doc['sold_amount']:.4f}, status: {doc['status']}")
+
+    checks = {
+        'no overselling': bought <= args.listed + AMOUNT_EPSILON,
+        'every available unit sold': succeeded == expected_sales,
+        'amount left matches purchases': abs(doc['amount_kg_co2'] - (args.listed - bought)) < 1e-4,
+        'sold amount matches purchases': abs(doc['sold_amount'] - bought) < 1e-4,
+        'amount non-negative': doc['amount_kg_co2'] >= 0,
+        'sold exactly when empty': (doc['status'] == 'sold') == (doc['amount_kg_co2'] <= AMOUNT_EPSILON)
+    }
+    for name, passed in checks.items():
+        print(f"  {'✅' if passed else '❌'} {name}")
+
+    client.drop_database(args.db)
+    sys.exit(0 if all(checks.values()) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,7 @@ class DemoDataGenerator:
             Number of records created
         """
         records_created = 0
+        today = datetime.utcnow()
         
         for i in range(days):
             # Calculate date (going backwards from today)
@@ -59,7 +60,8 @@ class DemoDataGenerator:
                 electricity_co2_kg=emissions['electricity_co2_kg'],
                 combustion_ppm=combustion_ppm,
                 combustion_co2_kg=emissions['combustion_co2_kg'],
-                source='simulated'
+                source='simulated',
+                timestamp=today - timedelta(days=date_offset)
             )
             
             records_created += 1
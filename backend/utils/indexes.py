@@ -0,0 +1,42 @@
+import threading
+from pymongo.errors import OperationFailure
+
+_ensured = set()
+_lock = threading.Lock()
+
+def ensure_index(collection, keys, **kwargs):
+    """
+    Create an index once per process
+
+    Models are constructed on every request; calling create_index each
+    time costs a round-trip per index. This remembers which indexes were
+    already ensured for a given database/collection.
+    """
+    marker = (collection.database.name, collection.name, repr(keys), repr(sorted(kwargs.items())))
+    if marker in _ensured:
+        return
+
+    collection.create_index(keys, **kwargs)
+    with _lock:
+        _ensured.add(marker)
+
+def drop_legacy_index(collection, name):
+    """
+    Drop an index that a newer one replaces, once per process
+
+    Must run before the replacement is created: MongoDB before 5.0
+    rejects an index on the same keys that differs only in its options
+    (e.g. a partial filter). A missing index is ignored.
+    """
+    marker = (collection.database.name, collection.name, 'drop', name)
+    if marker in _ensured:
+        return
+
+    if name in collection.index_information():
+        try:
+            collection.drop_index(name)
+        except OperationFailure:
+            # Dropped concurrently by another worker
+            pass
+    with _lock:
+        _ensured.add(marker)
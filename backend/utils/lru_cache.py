@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU cache with hit/miss accounting.
+
+    Entries are evicted least-recently-used first once max_entries is
+    reached, so memory stays bounded no matter how many keys are seen.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return cached value (and mark it recently used) or default"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Insert or replace a value, evicting the LRU entry if full"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove a single entry"""
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Get cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,75 @@
+import threading
+import time
+from datetime import datetime
+
+class PeriodicTask:
+    """
+    Runs a function on a daemon thread every interval_seconds
+
+    Errors are logged and recorded but never stop the loop. wake() runs
+    the next iteration immediately.
+    """
+
+    def __init__(self, name, interval_seconds, fn):
+        self.name = name
+        self.interval_seconds = interval_seconds
+        self.fn = fn
+        self.runs = 0
+        self.failures = 0
+        self.last_run_at = None
+        self.last_duration_ms = None
+        self.last_result = None
+        self.last_error = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._loop, name=f'periodic-{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Run the next iteration now instead of waiting for the interval"""
+        self._wake.set()
+
+    def run_once(self):
+        """Run one iteration on the calling thread"""
+        started = time.perf_counter()
+        try:
+            self.last_result = self.fn()
+            self.last_error = None
+        except Exception as e:
+            self.failures += 1
+            self.last_error = f'{type(e).__name__}: {e}'
+            print(f"[{self.name.upper()}] Run failed: {self.last_error}")
+        finally:
+            self.runs += 1
+            self.last_run_at = datetime.utcnow()
+            self.last_duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        return self.last_result
+
+    def status(self):
+        return {
+            'name': self.name,
+            'interval_seconds': self.interval_seconds,
+            'running': bool(self._thread and self._thread.is_alive()),
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+            'last_duration_ms': self.last_duration_ms,
+            'last_error': self.last_error
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval_seconds)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.run_once()
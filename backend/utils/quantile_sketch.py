@@ -0,0 +1,137 @@
+import math
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative-error guarantees
+
+    Values are counted in logarithmic buckets (as in DDSketch): every
+    quantile is returned within relative_accuracy of the true value, the
+    size grows with the log of the value range rather than the count, and
+    two sketches merge by adding bucket counts. Because buckets are plain
+    counts, a value can also be removed, which lets aggregates be kept up
+    to date incrementally when a member's value changes.
+    """
+
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, index):
+        # Midpoint (in relative terms) of the bucket's range
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        """Add a non-negative value"""
+        value = max(value, 0.0)
+        if value <= self.MIN_VALUE:
+            self.zero_count += count
+        else:
+            index = self._index(value)
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += count
+        self.sum += value * count
+
+    def remove(self, value, count=1):
+        """
+        Remove a value previously added
+
+        Removing a value that isn't in the sketch is ignored.
+        """
+        value = max(value, 0.0)
+        if value <= self.MIN_VALUE:
+            removed = min(count, self.zero_count)
+            self.zero_count -= removed
+        else:
+            index = self._index(value)
+            removed = min(count, self.bins.get(index, 0))
+            if removed:
+                self.bins[index] -= removed
+                if self.bins[index] == 0:
+                    del self.bins[index]
+        self.count -= removed
+        self.sum -= value * removed
+        if self.count == 0:
+            self.sum = 0.0
+
+    def merge(self, other):
+        """Add another sketch's counts into this one"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different accuracy')
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """
+        Approximate q-quantile (0 <= q <= 1)
+
+        Returns:
+            Value or None if the sketch is empty
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.bins))
+
+    def rank(self, value):
+        """
+        Approximate fraction of values below the given value (0-1)
+
+        Values in the same bucket count as half below.
+
+        Returns:
+            Fraction or None if the sketch is empty
+        """
+        if self.count == 0:
+            return None
+
+        value = max(value, 0.0)
+        if value <= self.MIN_VALUE:
+            return self.zero_count / 2 / self.count
+
+        target = self._index(value)
+        below = self.zero_count + sum(c for i, c in self.bins.items() if i < target)
+        return (below + self.bins.get(target, 0) / 2) / self.count
+
+    def to_dict(self):
+        """Serializable form (MongoDB needs string keys)"""
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'bins': {str(index): count for index, count in self.bins.items()},
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'sum': self.sum
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_accuracy'])
+        sketch.bins = {int(index): count for index, count in data['bins'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        return sketch
@@ -0,0 +1,38 @@
+import threading
+
+_support = {}
+_lock = threading.Lock()
+
+def supports_transactions(client):
+    """
+    Whether the deployment supports multi-document transactions
+    (replica set or sharded cluster); checked once per client
+    """
+    key = id(client)
+    if key not in _support:
+        try:
+            hello = client.admin.command('hello')
+            supported = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+        except Exception:
+            supported = False
+        with _lock:
+            _support[key] = supported
+    return _support[key]
+
+def run_in_transaction(client, fn):
+    """
+    Run fn(session) in a multi-document transaction
+
+    with_transaction retries fn on transient errors, so fn must be safe
+    to re-run. On a standalone server fn(None) runs without a transaction:
+    callers order their writes so that the guarding conditional update
+    comes first.
+
+    Returns:
+        fn's return value
+    """
+    if not supports_transactions(client):
+        return fn(None)
+
+    with client.start_session() as session:
+        return session.with_transaction(fn)
@@ -29,23 +29,16 @@ export default function MarketplacePage() {
 
     useEffect(() => {
         loadListings();
-    }, [filter]);
+    }, [filter, sortBy]);
 
     const loadListings = async () => {
         try {
             setLoading(true);
-            const filters = filter !== 'all' ? { credit_type: filter } : {};
+            // Sorted server-side (indexed)
+            const sort = sortBy === 'amount' ? 'amount_desc' : 'price_asc';
+            const filters = filter !== 'all' ? { credit_type: filter, sort } : { sort };
             const response = await marketplaceAPI.getListings(filters);
-            let data = response.data.listings || [];
-
-            // Sort listings
-            if (sortBy === 'price') {
-                data.sort((a: Listing, b: Listing) => a.price_per_kg - b.price_per_kg);
-            } else if (sortBy === 'amount') {
-                data.sort((a: Listing, b: Listing) => b.amount_kg_co2 - a.amount_kg_co2);
-            }
-
-            setListings(data);
+            setListings(response.data.listings || []);
         } catch (error) {
             console.error('Error loading listings:', error);
         } finally {
@@ -114,10 +107,7 @@ export default function MarketplacePage() {
 
                     <select
                         value={sortBy}
-                        onChange={(e) => {
-                            setSortBy(e.target.value);
-                            loadListings();
-                        }}
+                        onChange={(e) => setSortBy(e.target.value)}
                         className="px-4 py-2 rounded-lg bg-white/10 text-white border border-white/20 focus:outline-none focus:ring-2 focus:ring-purple-500"
                     >
                         <option value="price">Sort by Price</option>
@@ -361,9 +351,9 @@ function BuyModal({ listing, onClose, onSuccess }: any) {
                     <div className="text-center">
                         <p className="text-gray-300 mb-4">Scan QR Code to Pay</p>
 
-                        {payment.qr_code && (
+                        {payment.qr_code_url && (
                             <div className="mb-4 p-4 bg-white rounded-lg">
-                                <img src={payment.qr_code} alt="Payment QR" className="w-64 h-64 mx-auto" />
+                                <img src={payment.qr_code_url} alt="Payment QR" className="w-64 h-64 mx-auto" />
                             </div>
                         )}
 